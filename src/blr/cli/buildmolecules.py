@@ -7,24 +7,41 @@ Molecules are a set of reads that:
     2) have no neighbouring reads further appart then a specified window (set using -w/--window)
     2) have minimum number of reads (set using -t/--threshold)
 
+With --streaming the input is read once and reads are written tagged as soon as the molecule for their read name is
+known, see build_and_tag_molecules. With --threads, regions of an indexed input are processed in parallel in this way,
+see build_molecules_parallel.
 """
 
-from collections import defaultdict, OrderedDict
-import logging
-import statistics
+from collections import deque
 from itertools import chain
+import logging
+from multiprocessing import get_context
+import os
 from pathlib import Path
+import shutil
+import sys
+import tempfile
 
-import pandas as pd
+import numpy as np
 import pysam
 
-from blr.utils import PySAMIO, get_bamtag, Summary, calculate_N50, tqdm, ACCEPTED_LIBRARY_TYPES, LastUpdatedOrderedDict
+from blr.utils import PySAMIO, get_bamtag, Summary, tqdm, ACCEPTED_LIBRARY_TYPES, \
+    LastUpdatedOrderedDict, make_header, FragmentStats
 
 logger = logging.getLogger(__name__)
 
 # For reads not associated to a specific molecule the molecule id is set to -1.
 DEFAULT_MOLECULE_ID = -1
 
+# Distance in bp between attempts to write buffered reads when streaming.
+FLUSH_STEP = 1000
+
+# Target number of regions per worker process when building molecules in parallel.
+REGIONS_PER_THREAD = 4
+
+# Set in each worker process by _init_worker
+_worker_state = {}
+
 
 def main(args):
     run_buildmolecules(
@@ -37,7 +54,10 @@ def main(args):
         bed_file=args.bed,
         molecule_tag=args.molecule_tag,
         min_mapq=args.min_mapq,
-        library_type=args.library_type
+        library_type=args.library_type,
+        streaming=args.streaming,
+        threads=args.threads,
+        tmpdir=args.tmpdir,
     )
 
 
@@ -51,65 +71,76 @@ def run_buildmolecules(
     bed_file: Path,
     molecule_tag: str,
     min_mapq: int,
-    library_type: str
+    library_type: str,
+    streaming: bool = False,
+    threads: int = 1,
+    tmpdir: str = None,
 ):
     summary = Summary()
 
-    # Build molecules from BCs and reads
-    save = pysam.set_verbosity(0)  # Fix for https://github.com/pysam-developers/pysam/issues/939
-    with pysam.AlignmentFile(input, "rb") as infile:
-        barcode_to_mol, header_to_mol_id = build_molecules(pysam_openfile=infile,
-                                                           barcode_tag=barcode_tag,
-                                                           window=window,
-                                                           min_reads=threshold,
-                                                           library_type=library_type,
-                                                           min_mapq=min_mapq,
-                                                           summary=summary)
-    pysam.set_verbosity(save)
-
-    # Writes filtered out
-    with PySAMIO(input, output, __name__) as (openin, openout):
-        logger.info("Writing filtered bam file")
-        for read in tqdm(openin.fetch(until_eof=True)):
-            header = read.query_name
-
-            molecule_id = header_to_mol_id.get(header, DEFAULT_MOLECULE_ID)
-            read.set_tag(molecule_tag, molecule_id)
-
-            openout.write(read)
-
-    header_to_mol_id.clear()
-
-    # Make list of molecules
-    molecules = [molecule for molecule in chain.from_iterable(barcode_to_mol.values())]
-    del barcode_to_mol
-
-    # Generate dataframe with molecule information
-    df = pd.DataFrame(molecules)
-    if not df.empty:
-        update_summary_from_molecule_stats(df, summary)
-
-        # Write molecule/barcode file stats
+    if threads > 1:
+        molecules = build_molecules_parallel(input=input,
+                                             output=output,
+                                             barcode_tag=barcode_tag,
+                                             window=window,
+                                             min_reads=threshold,
+                                             library_type=library_type,
+                                             min_mapq=min_mapq,
+                                             molecule_tag=molecule_tag,
+                                             threads=threads,
+                                             summary=summary,
+                                             tmpdir=tmpdir)
+    elif streaming:
+        with PySAMIO(input, output, __name__) as (openin, openout):
+            logger.info("Building molecules and writing tagged bam file")
+            molecules = build_and_tag_molecules(reads=tqdm(openin.fetch(until_eof=True)),
+                                                openout=openout,
+                                                barcode_tag=barcode_tag,
+                                                window=window,
+                                                min_reads=threshold,
+                                                library_type=library_type,
+                                                min_mapq=min_mapq,
+                                                molecule_tag=molecule_tag,
+                                                summary=summary)
+    else:
+        # Build molecules from BCs and reads
+        save = pysam.set_verbosity(0)  # Fix for https://github.com/pysam-developers/pysam/issues/939
+        with pysam.AlignmentFile(input, "rb") as infile:
+            molecules, header_to_mol_id = build_molecules(pysam_openfile=infile,
+                                                          barcode_tag=barcode_tag,
+                                                          window=window,
+                                                          min_reads=threshold,
+                                                          library_type=library_type,
+                                                          min_mapq=min_mapq,
+                                                          summary=summary)
+        pysam.set_verbosity(save)
+
+        # Writes filtered out
+        with PySAMIO(input, output, __name__) as (openin, openout):
+            logger.info("Writing filtered bam file")
+            for read in tqdm(openin.fetch(until_eof=True)):
+                header = hash(read.query_name)
+
+                molecule_id = header_to_mol_id.get(header, DEFAULT_MOLECULE_ID)
+                read.set_tag(molecule_tag, molecule_id)
+
+                openout.write(read)
+
+        header_to_mol_id.clear()
+
+    if len(molecules) > 0:
+        update_summary_from_molecule_stats(molecules, summary)
+
+        # Write molecule/barcode file stats grouped by barcode
         if stats_tsv:
             logger.info(f"Writing {stats_tsv}")
-            stats_columns = ["MoleculeID", "Barcode", "Reads", "Length", "BpCovered"]
-            df.loc[:, stats_columns].to_csv(stats_tsv, sep="\t", index=False)
+            with open(stats_tsv, "w") as file:
+                molecules.write_tsv(file, order=np.argsort(molecules["barcode"], kind="stable"))
 
-        # Write BED file
+        # Write BED file sorted by chromosome and start position
         if bed_file:
-            # Create DataFrame with 6 columns in bed-like order
-            #   1. Chromosome
-            #   2. Start position of molecule
-            #   3. End position of molecule
-            #   4. Molecule index integer
-            #   5. Barcode string
-            #   6. Misc information about molecule i.e. Nr Reads, Length in bp, bp covered with reads.
-            bed = df.loc[:, ["Chromsome", "StartPosition", "EndPosition", "MoleculeID", "Barcode"]]
-            bed["Info"] = "Reads=" + df["Reads"].astype(str) + ";Length=" + df["Length"].astype(str) + \
-                          ";BpCovered=" + df["BpCovered"].astype(str)
-            del df
-            bed.sort_values(by=["Chromsome", "StartPosition"], inplace=True)
-            bed.to_csv(bed_file, sep="\t", index=False, header=False)
+            with open(bed_file, "w") as file:
+                molecules.write_bed(file, order=molecules.sorted_by_position())
     else:
         # Touch output files if no molecules
         if stats_tsv:
@@ -122,31 +153,38 @@ def run_buildmolecules(
 
 def parse_reads(pysam_openfile, barcode_tag, min_mapq, summary):
     for read in tqdm(pysam_openfile.fetch(until_eof=True)):
-        summary["Total reads"] += 1
-        if read.is_duplicate or read.is_unmapped or read.mapping_quality < min_mapq:
-            summary["Non analyced reads"] += 1
-            continue
+        barcode = get_analysed_barcode(read, barcode_tag, min_mapq, summary)
+        if barcode is not None:
+            yield barcode, read
+
 
-        barcode = get_bamtag(pysam_read=read, tag=barcode_tag)
-        if not barcode:
-            summary["Non analyced reads"] += 1
-            continue
+def get_analysed_barcode(read, barcode_tag, min_mapq, summary):
+    """Return barcode for read used to build molecules, or None if the read is not analysed"""
+    summary["Total reads"] += 1
+    if read.is_duplicate or read.is_unmapped or read.mapping_quality < min_mapq:
+        summary["Non analyced reads"] += 1
+        return None
 
-        yield barcode, read
+    barcode = get_bamtag(pysam_read=read, tag=barcode_tag)
+    if not barcode:
+        summary["Non analyced reads"] += 1
+        return None
+
+    return barcode
 
 
 def build_molecules(pysam_openfile, barcode_tag, window, min_reads, library_type, min_mapq, summary):
     """
-    Builds all_molecules.barcode_to_mol ([barcode][moleculeID] = molecule) and
-    all_molecules.header_to_mol ([read_name]=mol_ID)
+    Builds all_molecules.molecules (MoleculeStore) and
+    all_molecules.header_to_mol ([hash(read_name)]=mol_ID)
     :param pysam_openfile: Pysam open file instance.
     :param barcode_tag: Tag used to store barcode in bam file.
     :param window: Max distance between reads to include in the same molecule.
-    :param min_reads: Minimum reads to include molecule in all_molecules.barcode_to_mol
+    :param min_reads: Minimum reads to include molecule in all_molecules.molecules
     :param library_type: str. Library construction method.
     :param min_mapq: int
     :param summary: dict for stats collection
-    :return: dict[barcode][molecule] = moleculeInstance, dict[read_name] = mol_ID
+    :return: MoleculeStore with molecules, dict[hash(read_name)] = mol_ID
     """
 
     all_molecules = AllMolecules(min_reads=min_reads, window=window, library_type=library_type)
@@ -168,7 +206,221 @@ def build_molecules(pysam_openfile, barcode_tag, window, min_reads, library_type
 
     all_molecules.report_and_remove_all()
 
-    return all_molecules.barcode_to_mol, all_molecules.header_to_mol_id
+    return all_molecules.molecules, all_molecules.header_to_mol_id
+
+
+def build_and_tag_molecules(reads, openout, barcode_tag, window, min_reads, library_type, min_mapq, molecule_tag,
+                            summary):
+    """
+    Single-pass version of build_molecules that also writes all reads tagged with molecule ID to openout. Reads are
+    held in a buffer in input order, together with the molecule they were assigned to, until the scan has moved more
+    than a window past them, so that reads sharing their name (e.g. mates) have been assigned, and until it is known
+    whether their molecule is reported. Memory is thereby bounded by the window and coverage rather than by the number
+    of reads in molecules. Unlike the two-pass mode, reads that are not part of a reported molecule are only tagged
+    with the molecule holding their name if they are within a window of it, so e.g. discordant mates are not tagged.
+    :return: MoleculeStore with molecules
+    """
+    all_molecules = AllMolecules(min_reads=min_reads, window=window, library_type=library_type, streaming=True)
+    buffer = deque()
+    write = openout.write
+
+    def flush(horizon=None):
+        # Write buffered reads starting before horizon that can be tagged. All reads are written if horizon is None.
+        get_molecule_id = all_molecules.get_molecule_id
+        popleft = buffer.popleft
+        while buffer:
+            read, molecule = buffer[0]
+            if horizon is not None and read.reference_start >= horizon:
+                break
+
+            molecule_id = get_molecule_id(read, molecule)
+            if molecule_id is None:
+                break
+
+            read.set_tag(molecule_tag, molecule_id)
+            write(read)
+            popleft()
+
+        if buffer:
+            all_molecules.forget_closed(buffer[0][0].reference_start - window)
+
+    prev_chrom = None
+    prev_window_stop = window
+    logger.info("Dividing barcodes into molecules")
+    for read in reads:
+        # Commit molecules between chromosomes
+        if prev_chrom != read.reference_id:
+            all_molecules.report_and_remove_all()
+            flush()
+            all_molecules.forget_closed()
+            prev_chrom = read.reference_id
+            prev_window_stop = window
+            next_flush = FLUSH_STEP
+
+        molecule = None
+        barcode = get_analysed_barcode(read, barcode_tag, min_mapq, summary)
+        if barcode is not None:
+            molecule = all_molecules.assign_read(read, barcode, summary)
+
+            if read.reference_start > prev_window_stop:
+                all_molecules.update_cache(read.reference_start)
+                prev_window_stop = read.reference_start + window
+
+        buffer.append((read, molecule))
+        if read.reference_id >= 0:
+            if read.reference_start > next_flush:
+                flush(horizon=read.reference_start - window)
+                next_flush = read.reference_start + FLUSH_STEP
+        else:
+            # Unplaced reads can be written directly as all molecules have been reported.
+            flush()
+
+    all_molecules.report_and_remove_all()
+    flush()
+
+    return all_molecules.molecules
+
+
+def build_molecules_parallel(input, output, barcode_tag, window, min_reads, library_type, min_mapq, molecule_tag,
+                             threads, summary, tmpdir=None):
+    """
+    Build molecules and write reads tagged with molecule ID as in build_and_tag_molecules but using worker processes
+    for separate regions of the indexed input. Regions are split at gaps in coverage wider than the window, so no
+    molecule can span two regions (see find_regions) and reads are tagged as in a single pass. Each worker writes a
+    temporary BAM for its region which are concatenated to the output. To write reads with their final molecule IDs,
+    each region is given a separate range of IDs (see get_molecule_id_bases), so IDs are unique but not numbered
+    consecutively as in a single pass.
+    :return: MoleculeStore with molecules
+    """
+    if tmpdir is None:
+        # Temporary files hold a copy of the input so are kept next to the output rather than in the system default.
+        tmpdir = os.path.dirname(os.path.abspath(output)) if output != "-" else os.getcwd()
+    tmpdir = tempfile.mkdtemp(prefix="buildmolecules.", dir=tmpdir)
+    try:
+        with pysam.AlignmentFile(input, "rb") as openin:
+            if not openin.has_index():
+                sys.exit(f"Input {input} must be indexed to use multiple threads.")
+            header = make_header(openin, __name__)
+            region_size = max(sum(openin.lengths) // (REGIONS_PER_THREAD * threads), 10 * window)
+            mapped_reads = {stats.contig: stats.mapped for stats in openin.get_index_statistics()}
+
+        settings = dict(barcode_tag=barcode_tag, window=window, min_reads=min_reads, library_type=library_type,
+                        min_mapq=min_mapq, molecule_tag=molecule_tag)
+        with get_context("fork").Pool(threads, initializer=_init_worker,
+                                      initargs=(input, header.to_dict(), tmpdir, settings)) as workers:
+            regions = find_regions(input, window, region_size, workers)
+            logger.info(f"Building molecules in {len(regions)} regions")
+            id_bases = get_molecule_id_bases(regions, mapped_reads)
+
+            molecules = MoleculeStore()
+            parts = []
+            for part, region_molecules, region_summary in tqdm(
+                    workers.imap(_build_region, zip(range(len(regions)), regions, id_bases)), total=len(regions),
+                    desc="Regions"):
+                molecules.extend(region_molecules)
+                summary.update(region_summary)
+                parts.append(part)
+
+        logger.info("Writing tagged bam file")
+        pysam.cat("-o", output, *parts, catch_stdout=False)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return molecules
+
+
+def get_molecule_id_bases(regions, mapped_reads):
+    """
+    Return the molecule ID preceding the first molecule ID of each region such that regions have separate ranges of
+    IDs. Each molecule has at least one mapped read so the number of molecules in a region is bounded by the number of
+    mapped reads on its contigs, given by mapped_reads.
+    """
+    bases = []
+    total = 0
+    for region in regions:
+        bases.append(total)
+        total += sum(mapped_reads.get(contig, 0) for contig, _, _ in region)
+
+    if total >= 2 ** 31:
+        sys.exit("Too many reads to give each region a separate range of molecule IDs. Use fewer threads.")
+    return bases
+
+
+def find_regions(input, window, region_size, workers):
+    """
+    Split contigs in input into regions that can be processed independently. A split is made at the first gap in
+    coverage wider than window after each multiple of region_size along the contig, so no molecule can span two
+    regions. Consecutive contigs are grouped to regions of at least region_size. Regions are lists of (contig, start,
+    stop) segments where unplaced reads are included in the last region as ("*", None, None).
+    """
+    with pysam.AlignmentFile(input, "rb") as openin:
+        contigs = list(zip(openin.references, openin.lengths))
+
+    candidates = [(contig, start, min(start + region_size, length))
+                  for contig, length in contigs for start in range(region_size, length, region_size)]
+    gaps = dict(zip(candidates, workers.starmap(_find_gap, candidates)))
+
+    regions = []
+    region = []
+    region_length = 0
+    for contig, length in contigs:
+        start = 0
+        for candidate in range(region_size, length, region_size):
+            split = gaps[contig, candidate, min(candidate + region_size, length)]
+            if split is not None:
+                regions.append(region + [(contig, start, split)])
+                region = []
+                region_length = 0
+                start = split
+
+        region.append((contig, start, length))
+        region_length += length - start
+        if region_length >= region_size:
+            regions.append(region)
+            region = []
+            region_length = 0
+
+    region.append(("*", None, None))
+    regions.append(region)
+    return regions
+
+
+def find_gap(openin, contig, start, stop, window):
+    """
+    Return position between start and stop in contig where no read is within window / 2 or None if there is no such
+    gap.
+    """
+    step = max(window // 2, 1)
+    for position in range(start, stop - window, step):
+        if openin.count(contig, position, position + window + 1) == 0:
+            return position + step
+
+    return None
+
+
+def _init_worker(input, header, tmpdir, settings):
+    _worker_state["openin"] = pysam.AlignmentFile(input, "rb")
+    _worker_state["header"] = pysam.AlignmentHeader.from_dict(header)
+    _worker_state["tmpdir"] = tmpdir
+    _worker_state["settings"] = settings
+
+
+def _find_gap(contig, start, stop):
+    return find_gap(_worker_state["openin"], contig, start, stop, _worker_state["settings"]["window"])
+
+
+def _build_region(indexed_region):
+    index, region, id_base = indexed_region
+    openin = _worker_state["openin"]
+    reads = chain.from_iterable(openin.fetch("*") if contig == "*" else openin.fetch(contig, start, stop)
+                                for contig, start, stop in region)
+    part = os.path.join(_worker_state["tmpdir"], f"region{index}.bam")
+    summary = Summary()
+    Molecule.molecule_counter = id_base
+    with pysam.AlignmentFile(part, "wb", header=_worker_state["header"]) as openout:
+        molecules = build_and_tag_molecules(reads=reads, openout=openout, summary=summary,
+                                            **_worker_state["settings"])
+    return part, molecules, summary
 
 
 class Molecule:
@@ -176,6 +428,8 @@ class Molecule:
     A Splitting of barcode read groups into several molecules based on mapping proximity. Equivalent to several
     molecules being barcoded simultaneously in the same emulsion droplet (meaning with the same barcode).
     """
+    __slots__ = ("barcode", "chromosome", "start", "stop", "read_headers", "nr_reads", "bp_covered", "index",
+                 "closed")
     molecule_counter = 0
 
     def __init__(self, read, barcode, index=None):
@@ -187,12 +441,14 @@ class Molecule:
         self.chromosome = read.reference_name
         self.start = read.reference_start
         self.stop = read.reference_end
-        self.read_headers = {read.query_name}
+        # Read names are stored as 64-bit hashes to save memory.
+        self.read_headers = {hash(read.query_name)}
         self.nr_reads = 1
         self.bp_covered = self.stop - self.start
 
         Molecule.molecule_counter += 1
         self.index = Molecule.molecule_counter if index is None else index
+        self.closed = False
 
     def length(self):
         return self.stop - self.start
@@ -203,12 +459,12 @@ class Molecule:
         """
         self.bp_covered += max(read.reference_end - max(read.reference_start, self.stop), 0)
         self.stop = max(read.reference_end, self.stop)
-        self.read_headers.add(read.query_name)
+        self.read_headers.add(hash(read.query_name))
 
         self.nr_reads += 1
 
     def has_acceptable_overlap(self, read, library_type, summary):
-        if read.query_name in self.read_headers:  # Within pair
+        if hash(read.query_name) in self.read_headers:  # Within pair
             return True
 
         if self.stop < read.reference_start:  # No overlap
@@ -231,24 +487,96 @@ class Molecule:
         summary["Overlapping reads in molecule"] += 1
         return False
 
-    def to_dict(self):
-        return OrderedDict({
-            "MoleculeID": self.index,
-            "Barcode": self.barcode,
-            "Reads": self.nr_reads,
-            "Length": self.length(),
-            "BpCovered": self.bp_covered,
-            "Chromsome": self.chromosome,
-            "StartPosition": self.start,
-            "EndPosition": self.stop,
-        })
-
-    def to_tsv(self):
-        return "{index}\t{barcode}\t{nr_reads}\t{length}\t{bp_covered}".format(**vars(self), length=self.length())
-
-    def to_bed(self):
+
+class MoleculeStore:
+    """
+    Columnar store of finished molecules. Numeric fields are kept in growable numpy arrays while barcodes and
+    chromosomes are stored as integer codes into lists of unique values.
+    """
+    FIELDS = ("index", "barcode", "nr_reads", "bp_covered", "chromosome", "start", "stop")
+
+    def __init__(self, capacity=1024):
+        self._size = 0
+        self._arrays = {field: np.empty(capacity, dtype=np.int64) for field in self.FIELDS}
+        self.barcodes = []
+        self.chromosomes = []
+        self._barcode_codes = {}
+        self._chromosome_codes = {}
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, field):
+        """Return array of field for all stored molecules"""
+        return self._arrays[field][:self._size]
+
+    def append(self, molecule):
+        if self._size == len(self._arrays["index"]):
+            self._grow()
+
+        i = self._size
+        arrays = self._arrays
+        arrays["index"][i] = molecule.index
+        arrays["barcode"][i] = self._get_code(molecule.barcode, self._barcode_codes, self.barcodes)
+        arrays["nr_reads"][i] = molecule.nr_reads
+        arrays["bp_covered"][i] = molecule.bp_covered
+        arrays["chromosome"][i] = self._get_code(molecule.chromosome, self._chromosome_codes, self.chromosomes)
+        arrays["start"][i] = molecule.start
+        arrays["stop"][i] = molecule.stop
+        self._size += 1
+
+    @staticmethod
+    def _get_code(value, codes, values):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+        return code
+
+    def _grow(self):
+        for field, array in self._arrays.items():
+            grown = np.empty(2 * len(array), dtype=array.dtype)
+            grown[:self._size] = array[:self._size]
+            self._arrays[field] = grown
+
+    def extend(self, other):
+        """Append molecules in other store"""
+        size = self._size + len(other)
+        while size > len(self._arrays["index"]):
+            self._grow()
+
+        barcode_codes = np.array([self._get_code(barcode, self._barcode_codes, self.barcodes)
+                                  for barcode in other.barcodes], dtype=np.int64)
+        chromosome_codes = np.array([self._get_code(chromosome, self._chromosome_codes, self.chromosomes)
+                                     for chromosome in other.chromosomes], dtype=np.int64)
+        for field, array in self._arrays.items():
+            values = other[field]
+            if field == "barcode":
+                values = barcode_codes[values]
+            elif field == "chromosome":
+                values = chromosome_codes[values]
+            array[self._size:size] = values
+        self._size = size
+
+    def lengths(self):
+        return self["stop"] - self["start"]
+
+    def sorted_by_position(self):
+        """Return indices of molecules sorted by chromosome name and start position"""
+        chromosome_ranks = np.argsort(np.argsort(np.array(self.chromosomes, dtype=object), kind="stable"))
+        return np.lexsort((self["start"], chromosome_ranks[self["chromosome"]]))
+
+    def write_tsv(self, file, order=None):
+        """Write molecule stats in TSV format with header. Molecules are written in order if given."""
+        print("MoleculeID", "Barcode", "Reads", "Length", "BpCovered", sep="\t", file=file)
+        columns = self._columns(order, "index", "barcode", "nr_reads", "bp_covered", "start", "stop")
+        barcodes = self.barcodes
+        for index, barcode, nr_reads, bp_covered, start, stop in zip(*columns):
+            print(index, barcodes[barcode], nr_reads, stop - start, bp_covered, sep="\t", file=file)
+
+    def write_bed(self, file, order=None):
         """
-        Create a bed entry for the molecule with 6-columns.
+        Write a bed entry for each molecule with 6-columns. Molecules are written in order if given.
            1. Chromosome
            2. Start position of molecule
            3. End position of molecule
@@ -256,21 +584,32 @@ class Molecule:
            5. Barcode string
            6. Misc information about molecule i.e. Nr Reads, Length in bp, bp covered with reads.
         """
-        return "{chromosome}\t{start}\t{stop}\t{index}\t{barcode}\tReads={nr_reads};Length={length};" \
-               "BpCovered={bp_covered}".format(**vars(self), length=self.length())
+        columns = self._columns(order, "chromosome", "start", "stop", "index", "barcode", "nr_reads", "bp_covered")
+        chromosomes = self.chromosomes
+        barcodes = self.barcodes
+        for chromosome, start, stop, index, barcode, nr_reads, bp_covered in zip(*columns):
+            print(chromosomes[chromosome], start, stop, index, barcodes[barcode],
+                  f"Reads={nr_reads};Length={stop - start};BpCovered={bp_covered}", sep="\t", file=file)
+
+    def _columns(self, order, *fields):
+        if order is None:
+            return [self[field].tolist() for field in fields]
+        return [self[field][order].tolist() for field in fields]
 
 
 class AllMolecules:
     """
-    Tracks all molecule information, with finished molecules in .barcode_to_mol, and molecules which still might get
+    Tracks all molecule information, with finished molecules in .molecules, and molecules which still might get
     more reads in .molecule_cache.
     """
 
-    def __init__(self, min_reads, window, library_type):
+    def __init__(self, min_reads, window, library_type, streaming=False):
         """
-        :param min_reads: Minimum reads required to add molecule to .barcode_to_mol from .cache_dict
+        :param min_reads: Minimum reads required to add molecule to .molecules from .cache_dict
         :param window: Current window for detecting molecules.
         :param library_type: str. Library construction method
+        :param streaming: bool. Track molecules of recent read names in .header_to_molecule instead of collecting all
+                          read names in .header_to_mol_id.
         """
 
         # Min required reads for calling proximal reads a molecule
@@ -285,27 +624,35 @@ class AllMolecules:
         # Molecule tracking system
         self.molecule_cache = LastUpdatedOrderedDict()
 
-        # Dict for finding mols belonging to the same BC
-        self.barcode_to_mol = defaultdict(list)
+        # Store of reported molecules
+        self.molecules = MoleculeStore()
 
-        # Dict for finding mol ID when writing out
+        # Dict for finding mol ID from hashed read name when writing out
         self.header_to_mol_id = {}
 
+        # For streaming, dict for finding the latest molecule of recent hashed read names and closed molecules in the
+        # order they were reported.
+        self.streaming = streaming
+        self.header_to_molecule = {}
+        self.closed_molecules = deque()
+
     def assign_read(self, read, barcode, summary):
         """
-        Assign read to current molecule while checking for overlaps or start new molecule.
+        Assign read to current molecule while checking for overlaps or start new molecule. Returns the molecule the
+        read was added to or None if it was not added due to overlaps.
         """
         if barcode in self.molecule_cache:
             if self.read_is_in_window(read, barcode):
                 if self.check_overlaps_ok(read, barcode, summary):
-                    self.add_read_to_molecule(read, barcode)
+                    return self.add_read_to_molecule(read, barcode)
+                return None
             else:
                 self.report(barcode)
                 self.terminate(barcode)
 
-                self.create_new_molecule(read, barcode)
+                return self.create_new_molecule(read, barcode)
         else:
-            self.create_new_molecule(read, barcode)
+            return self.create_new_molecule(read, barcode)
 
     def check_overlaps_ok(self, read, barcode, summary):
         """
@@ -324,14 +671,22 @@ class AllMolecules:
         """
         Add read to existing molecule
         """
-        self.molecule_cache[barcode].add_read(read)
+        molecule = self.molecule_cache[barcode]
+        molecule.add_read(read)
         self.molecule_cache.move_to_end(barcode)
+        if self.streaming:
+            self.header_to_molecule[hash(read.query_name)] = molecule
+        return molecule
 
     def create_new_molecule(self, read, barcode):
         """
         Create new molecule and add to cache
         """
-        self.molecule_cache[barcode] = Molecule(read=read, barcode=barcode)
+        molecule = Molecule(read=read, barcode=barcode)
+        self.molecule_cache[barcode] = molecule
+        if self.streaming:
+            self.header_to_molecule[hash(read.query_name)] = molecule
+        return molecule
 
     def update_cache(self, current_start):
         """
@@ -351,15 +706,20 @@ class AllMolecules:
 
     def report(self, barcode):
         """
-        Commit molecule to .barcode_to_mol, if molecule.reads >= min_reads. If molecule in cache only barcode is
+        Commit molecule to .molecules, if molecule.reads >= min_reads. If molecule in cache only barcode is
         required.
         """
         molecule = self.molecule_cache[barcode]
+        molecule.closed = True
         if molecule.nr_reads >= self.min_reads:
-            self.barcode_to_mol[barcode].append(molecule.to_dict())
-            self.header_to_mol_id.update(
-                {header: molecule.index for header in molecule.read_headers}
-            )
+            self.molecules.append(molecule)
+            if not self.streaming:
+                self.header_to_mol_id.update(
+                    {header: molecule.index for header in molecule.read_headers}
+                )
+
+        if self.streaming:
+            self.closed_molecules.append(molecule)
 
     def terminate(self, barcode):
         """
@@ -369,21 +729,50 @@ class AllMolecules:
 
     def report_and_remove_all(self):
         """
-        Commit all .molecule_cache molecules to .barcode_to_mol and empty .molecule_cache (provided they meet
+        Commit all .molecule_cache molecules to .molecules and empty .molecule_cache (provided they meet
         criterias by report function).
         """
         for barcode in self.molecule_cache:
             self.report(barcode)
         self.molecule_cache.clear()
 
+    def get_molecule_id(self, read, molecule=None):
+        """
+        Return molecule ID for read when streaming or None if not yet known, i.e. the molecule is still open with
+        fewer than min_reads reads. Reads are tagged with the molecule they were assigned to if it is reported.
+        Otherwise, e.g. for mates that were not analysed, the latest molecule of the read name is used provided that
+        the read is within a window of it.
+        """
+        if molecule is None or (molecule.closed and molecule.nr_reads < self.min_reads):
+            molecule = self.header_to_molecule.get(hash(read.query_name))
+            if molecule is None or not \
+                    molecule.start - self.window <= read.reference_start <= molecule.stop + self.window:
+                return DEFAULT_MOLECULE_ID
+
+        if molecule.nr_reads >= self.min_reads:
+            return molecule.index
+
+        if molecule.closed:
+            return DEFAULT_MOLECULE_ID
 
-def update_summary_from_molecule_stats(df, summary):
-    summary["Fragment N50 (bp)"] = calculate_N50(df["Length"])
-    summary["Mean fragment size (bp)"] = statistics.mean(df["Length"])
-    summary["Median fragment size (bp)"] = statistics.median(df["Length"])
-    summary["Longest fragment (bp)"] = max(df["Length"])
-    summary["Mean fragment read coverage (%)"] = statistics.mean(100 * df["BpCovered"] / df["Length"])
-    summary["Median fragment read coverage (%)"] = statistics.median(100 * df["BpCovered"] / df["Length"])
+        return None
+
+    def forget_closed(self, position=None):
+        """
+        Remove read names of closed molecules stopping before position from .header_to_molecule. All are removed if
+        position is None.
+        """
+        while self.closed_molecules and (position is None or self.closed_molecules[0].stop < position):
+            molecule = self.closed_molecules.popleft()
+            for header in molecule.read_headers:
+                if self.header_to_molecule.get(header) is molecule:
+                    del self.header_to_molecule[header]
+
+
+def update_summary_from_molecule_stats(molecules, summary):
+    stats = FragmentStats(capacity=len(molecules))
+    stats.extend(molecules.lengths(), molecules["bp_covered"], molecules["nr_reads"])
+    stats.update_summary(summary)
 
 
 def add_arguments(parser):
@@ -430,3 +819,19 @@ def add_arguments(parser):
         "-l", "--library-type", default="dbs", choices=ACCEPTED_LIBRARY_TYPES,
         help="Select library type from currently available technologies: %(choices)s. Default: %(default)s."
     )
+    parser.add_argument(
+        "--streaming", action="store_true", default=False,
+        help="Read input once and write reads as soon as their molecule is known instead of storing all read names "
+             "in molecules. Uses memory bounded by window size and coverage but reads further than a window from the "
+             "molecule holding their name, e.g. discordant mates, are not tagged with its ID."
+    )
+    parser.add_argument(
+        "--threads", type=int, default=1,
+        help="Number of worker processes building molecules in separate regions of the input which must then be "
+             "indexed. Implies --streaming. Default: %(default)s."
+    )
+    parser.add_argument(
+        "--tmpdir",
+        help="Directory for temporary BAM files of each region when using multiple threads. Default: directory of "
+             "the output."
+    )
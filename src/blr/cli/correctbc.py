@@ -2,16 +2,26 @@
 Correct single count barcodes by finding matching multiple count barcodes within hamming distance of one.
 
 This is the method used in Chen et al. 2019 (doi: 10.1101/gr.260380.119) to correct TELL-seq barcodes which are
-partialy degenerate.
+partialy degenerate. With '--max-dist 2' singles are also corrected to multiples within hamming distance two, in
+which case singles are corrected to the closest multiple if it is unique.
+
+Barcodes are counted in shards on disk (see ShardedBarcodeCounter) so that memory usage scales with the number of
+unique barcodes rather than the total number of barcodes.
 """
 from collections import Counter
 from dataclasses import dataclass
+from itertools import chain, combinations
 import logging
+from multiprocessing import get_context
+from pathlib import Path
+import shutil
+import tempfile
 from typing import List
 
 import dnaio
+import numpy as np
 
-from blr.utils import tqdm, Summary, smart_open
+from blr.utils import tqdm, Summary, smart_open, encode_sequences, decode_sequences, code_lengths
 
 
 logger = logging.getLogger(__name__)
@@ -20,30 +30,39 @@ logger = logging.getLogger(__name__)
 def main(args):
     summary = Summary()
 
-    barcodes = count_barcodes(args.uncorrected_barcodes)
-    summary["Total barcodes "] += len(barcodes)
-    singles, multiples = split_by_count(barcodes, count=1)
-
-    summary["Barcodes with count > 1"] = len(multiples)
-    summary["Barcodes with count = 1"] = len(singles)
+    with ShardedBarcodeCounter(nr_shards=args.nr_shards, tmpdir=args.tmpdir) as counter:
+        count_barcodes(args.uncorrected_barcodes, counter)
+        multiples = counter.merge()
+        summary["Total barcodes "] += len(multiples) + counter.nr_singles
+        summary["Barcodes with count > 1"] = len(multiples)
+        summary["Barcodes with count = 1"] = counter.nr_singles
 
-    correct_singles(singles, multiples, summary)
+        corrected, remaining = correct_sharded_singles(counter, multiples, summary, threads=args.threads,
+                                                       max_dist=args.max_dist)
 
     summary["Corrected singles (%)"] = 100*summary["Corrected singles"] / summary["Barcodes with count = 1"]
 
     with smart_open(args.output) as output:
-        for barcode, cluster in sorted(multiples.items(), key=lambda x: x[1], reverse=True):
+        for cluster in multiples.clusters(*corrected):
             print(cluster, file=output)
 
-        for barcode in singles:
+        for barcode in multiples.get_sequences(*remaining):
             print(f"{barcode}\t1\t{barcode}", file=output)
 
     summary.print_stats(__name__)
 
 
-def count_barcodes(file):
+def count_barcodes(file, counter, batch_size=1_000_000):
     with dnaio.open(file) as barcodes:
-        return Counter([barcode.sequence for barcode in tqdm(barcodes, desc="Count barcodes")])
+        batch = []
+        for barcode in tqdm(barcodes, desc="Count barcodes"):
+            batch.append(barcode.sequence)
+            if len(batch) == batch_size:
+                counter.add(batch)
+                batch = []
+
+        if batch:
+            counter.add(batch)
 
 
 @dataclass(order=False)
@@ -62,26 +81,437 @@ class Cluster:
         return f"{self.barcodes[0]}\t{self.count}\t{','.join(self.barcodes)}"
 
 
-def split_by_count(barcodes, count=1):
-    singles = {barcode for barcode, count in barcodes.items() if count == 1}
-    multiples = {barcode: Cluster(count, [barcode]) for barcode, count in barcodes.items() if count > 1}
-    return singles, multiples
+class ShardedBarcodeCounter:
+    """
+    Count barcodes in shards on disk so that memory usage scales with the number of unique barcodes in a shard rather
+    than with the total number of barcodes.
+
+    Barcodes are 2-bit encoded (see blr.utils.encode_sequence) and identified by the index of their first occurrence
+    which is used to output barcodes in the order they were first seen. Each added batch of barcodes is counted and
+    appended to the shard of each code. Once all barcodes are added, shards are merged one at a time with the
+    multiples collected in a MultiplesIndex and the singles written back to disk for correction shard-wise. Barcodes
+    that cannot be encoded, e.g. containing N, are counted in memory.
+    """
+    RECORD = np.dtype([("code", "<u8"), ("count", "<i8"), ("first", "<i8")])
+    SINGLE = np.dtype([("code", "<u8"), ("first", "<i8")])
+
+    def __init__(self, nr_shards=64, tmpdir=None):
+        """
+        :param nr_shards: Number of shards to split barcodes into.
+        :param tmpdir: Directory in which to create the shard files. Default is the system default.
+        """
+        self._tmpdir = Path(tempfile.mkdtemp(prefix="correctbc", dir=tmpdir))
+        self._paths = [self._tmpdir / f"shard_{i}.bin" for i in range(nr_shards)]
+        self.nr_shards = nr_shards
+        self.nr_barcodes = 0
+        self.nr_singles = 0
+        self._other_counts = Counter()
+        self._other_first = {}
+
+    def add(self, sequences):
+        codes = encode_sequences(sequences)
+        for i in np.flatnonzero(codes == 0).tolist():
+            sequence = sequences[i].decode() if isinstance(sequences[i], bytes) else sequences[i]
+            self._other_counts[sequence] += 1
+            self._other_first.setdefault(sequence, self.nr_barcodes + i)
+
+        encoded = np.flatnonzero(codes != 0)
+        unique_codes, first, counts = np.unique(codes[encoded], return_index=True, return_counts=True)
+        records = np.empty(len(unique_codes), dtype=self.RECORD)
+        records["code"] = unique_codes
+        records["count"] = counts
+        records["first"] = encoded[first] + self.nr_barcodes
+        self.nr_barcodes += len(sequences)
+
+        shards = self._get_shards(unique_codes)
+        order = np.argsort(shards, kind="stable")
+        bounds = np.searchsorted(shards[order], np.arange(self.nr_shards + 1))
+        for path, start, stop in zip(self._paths, bounds[:-1], bounds[1:]):
+            if start < stop:
+                with open(path, "ab") as file:
+                    records[order[start:stop]].tofile(file)
+
+    def _get_shards(self, codes):
+        # Multiplicative hashing spreads codes evenly over shards regardless of barcode composition.
+        hashes = (codes * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+        return (hashes % np.uint64(self.nr_shards)).astype(np.int64)
+
+    def merge(self):
+        """Merge counts within each shard. Returns MultiplesIndex of barcodes with count > 1."""
+        codes, counts, firsts = [], [], []
+        for path in tqdm(self._paths, desc="Merge shards"):
+            if not path.exists():
+                continue
+            records = np.fromfile(path, dtype=self.RECORD)
+            unique_codes, inverse = np.unique(records["code"], return_inverse=True)
+            unique_counts = np.bincount(inverse, weights=records["count"], minlength=len(unique_codes))
+            unique_counts = unique_counts.astype(np.int64)
+            first = np.full(len(unique_codes), np.iinfo(np.int64).max, dtype=np.int64)
+            np.minimum.at(first, inverse, records["first"])
+
+            is_multiple = unique_counts > 1
+            codes.append(unique_codes[is_multiple])
+            counts.append(unique_counts[is_multiple])
+            firsts.append(first[is_multiple])
+
+            singles = np.empty(np.count_nonzero(~is_multiple), dtype=self.SINGLE)
+            singles["code"] = unique_codes[~is_multiple]
+            singles["first"] = first[~is_multiple]
+            singles.tofile(path)
+            self.nr_singles += len(singles)
+
+        other_multiples = {}
+        for sequence, count in self._other_counts.items():
+            if count > 1:
+                other_multiples[sequence] = (count, self._other_first[sequence])
+            else:
+                self.nr_singles += 1
+
+        return MultiplesIndex(
+            np.concatenate(codes) if codes else np.zeros(0, dtype=np.uint64),
+            np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64),
+            np.concatenate(firsts) if firsts else np.zeros(0, dtype=np.int64),
+            other_multiples,
+            {first: sequence for sequence, first in self._other_first.items()},
+        )
+
+    def singles(self):
+        """Generate arrays of codes and first occurrences of encoded singles for each shard"""
+        for path in self._paths:
+            if path.exists():
+                singles = np.fromfile(path, dtype=self.SINGLE)
+                yield singles["code"], singles["first"]
+
+    def other_singles(self):
+        """Generate sequence and first occurrence of singles that could not be encoded"""
+        for sequence, count in self._other_counts.items():
+            if count == 1:
+                yield sequence, self._other_first[sequence]
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
-def correct_singles(singles, multiples, summary):
+    def close(self):
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+
+class MultiplesIndex:
+    """
+    Compact index of barcodes with count > 1. Encoded barcodes are kept in arrays sorted by code and barcodes that
+    could not be encoded in dicts. Each multiple has an integer index, those that could not be encoded come after the
+    encoded ones. Barcodes are identified by their code or, if not encoded, by the index of their first occurrence.
+    """
+    def __init__(self, codes, counts, firsts, other_multiples, other_sequences):
+        """
+        :param codes: Array of codes of encoded multiples.
+        :param counts: Array of counts of encoded multiples.
+        :param firsts: Array of first occurrences of encoded multiples.
+        :param other_multiples: Dict with count and first occurrence for each multiple that could not be encoded.
+        :param other_sequences: Dict with sequence for the first occurrence of each barcode that could not be encoded.
+        """
+        order = np.argsort(codes)
+        self.codes = codes[order]
+        other_counts, other_firsts = zip(*other_multiples.values()) if other_multiples else ((), ())
+        self._counts = np.concatenate([counts[order], np.array(other_counts, dtype=np.int64)])
+        self._firsts = np.concatenate([firsts[order], np.array(other_firsts, dtype=np.int64)])
+        self._other_index = {sequence: len(self.codes) + i for i, sequence in enumerate(other_multiples)}
+        self._other_sequences = other_sequences
+
+    def __len__(self):
+        return len(self._counts)
+
+    def indices(self, sequences):
+        """Return array with index of each sequence that is a multiple and NO_MATCH for other sequences"""
+        codes = encode_sequences(sequences)
+        indices = np.full(len(sequences), NO_MATCH, dtype=np.int64)
+        if len(self.codes) > 0:
+            positions = np.minimum(self.codes.searchsorted(codes), len(self.codes) - 1)
+            found = (self.codes[positions] == codes) & (codes != 0)
+            indices[found] = positions[found]
+        for i in np.flatnonzero(codes == 0).tolist():
+            indices[i] = self._other_index.get(sequences[i], NO_MATCH)
+        return indices
+
+    def get_sequences(self, codes, firsts):
+        """Return list of sequences for arrays of codes and first occurrences"""
+        sequences = decode_sequences(codes)
+        for i in np.flatnonzero(codes == 0).tolist():
+            sequences[i] = self._other_sequences[int(firsts[i])]
+        return sequences
+
+    def clusters(self, matches, codes, firsts, batch_size=100_000):
+        """
+        Generate clusters of multiples with the corrected singles given by arrays of the index of the matching
+        multiple, code and first occurrence of each single. Clusters are ordered by decreasing count and first
+        occurrence of the multiple with singles in order of first occurrence. Sequences are decoded for batches of
+        clusters at a time.
+        """
+        totals = self._counts + np.bincount(matches, minlength=len(self))
+        order = np.lexsort((firsts, matches))
+        codes, firsts = codes[order], firsts[order]
+        starts = np.searchsorted(matches[order], np.arange(len(self)))
+        multiple_codes = np.concatenate([self.codes, np.zeros(len(self) - len(self.codes), dtype=np.uint64)])
+        cluster_order = np.lexsort((self._firsts, -totals))
+        for batch_start in range(0, len(cluster_order), batch_size):
+            batch = cluster_order[batch_start:batch_start + batch_size]
+            multiples = self.get_sequences(multiple_codes[batch], self._firsts[batch])
+            # Corrected singles of the batch are selected by expanding the range of singles for each cluster.
+            sizes = totals[batch] - self._counts[batch]
+            offsets = np.cumsum(sizes)
+            singles = np.repeat(starts[batch], sizes) + np.arange(offsets[-1]) - np.repeat(offsets - sizes, sizes)
+            singles = self.get_sequences(codes[singles], firsts[singles])
+            offsets = offsets.tolist()
+            for multiple, total, start, stop in zip(multiples, totals[batch].tolist(), [0] + offsets, offsets):
+                yield Cluster(total, [multiple] + singles[start:stop])
+
+
+# Values returned by find_matches for singles without a unique match.
+NO_MATCH = -1
+MULTIPLE_MATCHES = -2
+
+
+def correct_sharded_singles(counter, multiples, summary, threads=1, chunk_size=None, max_dist=1):
+    """
+    Correct singles from a ShardedBarcodeCounter one shard at a time to the closest multiple in the MultiplesIndex
+    within Hamming distance max_dist if there is exactly one such multiple. Returns arrays of matching multiple index,
+    code and first occurrence for corrected singles and arrays of first occurrence and code for the remaining singles
+    sorted by first occurrence.
+    """
+    # Singles that could not be encoded have code 0.
+    corrected_matches, corrected_codes, corrected_firsts = [], [], []
+    remaining_firsts, remaining_codes = [], []
+    with SinglesMatcher(multiples.codes, threads=threads, chunk_size=chunk_size, max_dist=max_dist) as matcher:
+        for codes, firsts in tqdm(counter.singles(), desc="Correcting singles", total=counter.nr_shards):
+            matches = matcher.match(codes)
+            is_corrected = matches >= 0
+            corrected_matches.append(matches[is_corrected])
+            corrected_codes.append(codes[is_corrected])
+            corrected_firsts.append(firsts[is_corrected])
+            remaining_firsts.append(firsts[~is_corrected])
+            remaining_codes.append(codes[~is_corrected])
+            summary["Corrected singles"] += int(np.count_nonzero(is_corrected))
+            summary["Singles matching multiple"] += int(np.count_nonzero(matches == MULTIPLE_MATCHES))
+
+    other_singles = list(counter.other_singles())
+    sequences = [sequence for sequence, _ in other_singles]
+    firsts = np.array([first for _, first in other_singles], dtype=np.int64)
+    matches = match_unencoded(sequences, multiples, max_dist)
+    is_corrected = matches >= 0
+    corrected_matches.append(matches[is_corrected])
+    corrected_codes.append(np.zeros(np.count_nonzero(is_corrected), dtype=np.uint64))
+    corrected_firsts.append(firsts[is_corrected])
+    remaining_firsts.append(firsts[~is_corrected])
+    remaining_codes.append(np.zeros(np.count_nonzero(~is_corrected), dtype=np.uint64))
+    summary["Corrected singles"] += int(np.count_nonzero(is_corrected))
+    summary["Singles matching multiple"] += int(np.count_nonzero(matches == MULTIPLE_MATCHES))
+
+    corrected = tuple(map(np.concatenate, (corrected_matches, corrected_codes, corrected_firsts)))
+    firsts, codes = np.concatenate(remaining_firsts), np.concatenate(remaining_codes)
+    order = np.argsort(firsts)
+    return corrected, (codes[order], firsts[order])
+
+
+def match_unencoded(sequences, multiples, max_dist, chunk_size=10_000):
+    """
+    Find the closest multiple in a MultiplesIndex within Hamming distance max_dist for sequences that could not be
+    encoded by generating all neighbours of increasing distance using mutate. Sequences are matched in batches of
+    chunk_size. Returns array with the index of the matching multiple, NO_MATCH or MULTIPLE_MATCHES for each sequence.
+    """
+    matches = [np.zeros(0, dtype=np.int64)]
+    for start in range(0, len(sequences), chunk_size):
+        matches.append(_match_unencoded(sequences[start:start + chunk_size], multiples, max_dist))
+    return np.concatenate(matches)
+
+
+def _match_unencoded(sequences, multiples, max_dist):
     nucleotides = {"A", "T", "C", "G"}
-    singles_corrected = set()
-    for sequence in tqdm(singles, desc="Correcting singles"):
-        matched = [mut_seq for mut_seq in mutate(sequence, nucleotides) if mut_seq in multiples]
+    matches = np.full(len(sequences), NO_MATCH, dtype=np.int64)
+    neighbours = [{sequence} for sequence in sequences]
+    unmatched = np.arange(len(sequences))
+    for _ in range(max_dist):
+        owners, mutants = [], []
+        for i in unmatched.tolist():
+            neighbours[i] = {mut_seq for neighbour in neighbours[i] for mut_seq in mutate(neighbour, nucleotides)}
+            owners.extend([i] * len(neighbours[i]))
+            mutants.extend(neighbours[i])
+
+        owners = np.array(owners, dtype=np.int64)
+        found = multiples.indices(mutants)
+        nr_found = np.bincount(owners[found >= 0], minlength=len(sequences))
+        matches[owners[found >= 0]] = found[found >= 0]
+        matches[nr_found > 1] = MULTIPLE_MATCHES
+        unmatched = unmatched[nr_found[unmatched] == 0]
+    return matches
 
-        if len(matched) == 1:
-            multiples[matched[0]].add(sequence)
-            singles_corrected.add(sequence)
-            summary["Corrected singles"] += 1
-        elif len(matched) > 1:
-            summary["Singles matching multiple"] += 1
 
-    singles -= singles_corrected
+class SinglesMatcher:
+    """
+    Find matching multiples for arrays of encoded singles. The neighbours of singles within Hamming distance one are
+    generated with bit operations and looked up in the sorted array of encoded multiples. For max_dist > 1, candidates
+    are instead found using a pigeonhole index of the multiples, see build_index. Singles are matched in batches by a
+    pool of workers if threads > 1.
+    """
+    def __init__(self, sorted_codes, threads=1, chunk_size=None, max_dist=1):
+        """
+        :param sorted_codes: Sorted array of encoded multiples.
+        :param threads: Number of worker processes.
+        :param chunk_size: Number of singles matched per batch.
+        :param max_dist: Maximum Hamming distance for matches.
+        """
+        self._chunk_size = chunk_size if chunk_size is not None else 100_000 if max_dist == 1 else 10_000
+        index = None
+        self._function = find_matches
+        if max_dist > 1:
+            index = build_index(sorted_codes, code_lengths(sorted_codes), max_dist)
+            self._function = find_matches_indexed
+
+        self._workers = None
+        if threads > 1:
+            self._workers = get_context("fork").Pool(threads, initializer=_init_worker,
+                                                     initargs=(sorted_codes, index, max_dist))
+        else:
+            _init_worker(sorted_codes, index, max_dist)
+
+    def match(self, codes):
+        """
+        Returns index of the matching multiple in the sorted array, NO_MATCH or MULTIPLE_MATCHES for each code. Codes
+        of 0, i.e. barcodes that could not be encoded, get NO_MATCH.
+        """
+        lengths = code_lengths(codes)
+        matches = np.full(len(codes), NO_MATCH, dtype=np.int64)
+        tasks = []
+        for length in np.unique(lengths[codes != 0]):
+            indices = np.flatnonzero((lengths == length) & (codes != 0))
+            for start in range(0, len(indices), self._chunk_size):
+                tasks.append((indices[start:start + self._chunk_size], int(length)))
+
+        chunks = ((codes[indices], length) for indices, length in tasks)
+        results = self._workers.imap(self._function, chunks) if self._workers else map(self._function, chunks)
+        for (indices, _), chunk_matches in zip(tasks, results):
+            matches[indices] = chunk_matches
+        return matches
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._workers:
+            self._workers.close()
+            self._workers.join()
+
+
+# Set in each worker process by _init_worker
+_worker_state = {}
+
+
+def _init_worker(sorted_codes, index=None, max_dist=1):
+    _worker_state["sorted_codes"] = sorted_codes
+    _worker_state["index"] = index
+    _worker_state["max_dist"] = max_dist
+
+
+def find_matches(chunk):
+    """
+    Find the encoded multiples within Hamming distance one of each encoded single of the given length in chunk. Returns
+    the index of the matching multiple in the sorted array, NO_MATCH or MULTIPLE_MATCHES for each single.
+    """
+    codes, length = chunk
+    sorted_codes = _worker_state["sorted_codes"]
+    # XOR with 1, 2 or 3 at the bits of a base gives the codes for the other three bases.
+    masks = np.array([delta << 2 * position for position in range(length) for delta in (1, 2, 3)], dtype=np.uint64)
+    neighbours = codes[:, None] ^ masks[None, :]
+    if len(sorted_codes) == 0:
+        return np.full(len(codes), NO_MATCH, dtype=np.int64)
+
+    positions = np.minimum(np.searchsorted(sorted_codes, neighbours), len(sorted_codes) - 1)
+    found = sorted_codes[positions] == neighbours
+    nr_found = found.sum(axis=1)
+    first_found = positions[np.arange(len(codes)), found.argmax(axis=1)]
+    return np.where(nr_found == 1, first_found, np.where(nr_found > 1, MULTIPLE_MATCHES, NO_MATCH))
+
+
+def build_index(sorted_codes, lengths, max_dist):
+    """
+    Build pigeonhole index of encoded multiples for finding candidates within Hamming distance max_dist.
+
+    Barcodes of each length are split into max_dist + 2 segments. Two barcodes within distance max_dist differ in at
+    most max_dist segments and so are identical in at least two segments. For each pair of segments the multiples are
+    sorted by the bases in the two segments. Candidates for a single are the multiples sharing the bases of either pair
+    of segments which are found using binary search. Returns a dict with lists of (mask, sorted keys, indices into
+    sorted_codes) for each barcode length.
+    """
+    index = {}
+    for length in np.unique(lengths):
+        members = np.flatnonzero(lengths == length)
+        segments = np.array_split(np.arange(length), max_dist + 2)
+        entries = []
+        for combination in combinations(segments, 2):
+            # Keep the length marking bit so that only barcodes of the same length match.
+            mask = np.uint64(sum(3 << 2 * int(position) for position in chain(*combination)) | 1 << 2 * int(length))
+            keys = sorted_codes[members] & mask
+            order = np.argsort(keys, kind="stable")
+            entries.append((mask, keys[order], members[order]))
+        index[int(length)] = entries
+    return index
+
+
+def find_matches_indexed(chunk):
+    """
+    Find the closest encoded multiples within Hamming distance max_dist of each encoded single of the given length in
+    chunk using the pigeonhole index. Returns the index of the matching multiple in the sorted array, NO_MATCH or
+    MULTIPLE_MATCHES for each single.
+    """
+    codes, length = chunk
+    sorted_codes = _worker_state["sorted_codes"]
+    matches = np.full(len(codes), NO_MATCH, dtype=np.int64)
+    pairs = []
+    for mask, keys, members in _worker_state["index"].get(length, []):
+        queries = codes & mask
+        starts = np.searchsorted(keys, queries, side="left")
+        counts = np.searchsorted(keys, queries, side="right") - starts
+        # Expand ranges of matching keys to pairs encoded as single index * nr multiples + multiple index.
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = members[np.repeat(starts, counts) + offsets]
+        pairs.append(np.repeat(np.arange(len(codes)), counts) * len(sorted_codes) + candidates)
+
+    if not pairs:
+        return matches
+
+    single_indices, candidates = np.divmod(np.unique(np.concatenate(pairs)), len(sorted_codes))
+    distances = hamming_distance(codes[single_indices], sorted_codes[candidates])
+    within = distances <= _worker_state["max_dist"]
+    single_indices, candidates, distances = single_indices[within], candidates[within], distances[within]
+    if len(single_indices) == 0:
+        return matches
+
+    # Pairs are sorted by single index so sort by distance within each single and find the closest candidates.
+    order = np.lexsort((distances, single_indices))
+    single_indices, candidates, distances = single_indices[order], candidates[order], distances[order]
+    starts = np.flatnonzero(np.r_[True, single_indices[1:] != single_indices[:-1]])
+    sizes = np.diff(np.r_[starts, len(single_indices)])
+    closest = distances == np.repeat(distances[starts], sizes)
+    nr_closest = np.add.reduceat(closest.astype(np.int64), starts)
+    matches[single_indices[starts]] = np.where(nr_closest == 1, candidates[starts], MULTIPLE_MATCHES)
+    return matches
+
+
+_EVEN_BITS = np.uint64(0x5555555555555555)
+
+
+def hamming_distance(codes1, codes2):
+    """Hamming distance between arrays of 2-bit encoded sequences of the same length"""
+    diff = codes1 ^ codes2
+    # Set the low bit for each base that differs and count the set bits.
+    diff = (diff | (diff >> np.uint64(1))) & _EVEN_BITS
+    diff = (diff & np.uint64(0x3333333333333333)) + ((diff >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    diff = (diff + (diff >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    return ((diff * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.int64)
 
 
 def mutate(sequence, nucleotides):
@@ -105,3 +535,21 @@ def add_arguments(parser):
         help="Output tab separated file for error corrected barcodes. Columns are: corrected barcode sequence, count, "
              "comma-separate barcodes that were corrected to the sequence. Default: write to stdout."
     )
+    parser.add_argument(
+        "-t", "--threads", type=int, default=1,
+        help="Number of worker processes used to correct singles. Default: %(default)s."
+    )
+    parser.add_argument(
+        "--nr-shards", type=int, default=64,
+        help="Number of shards on disk that barcodes are split into for counting and correction. Memory usage "
+             "scales with the number of unique barcodes per shard. Default: %(default)s."
+    )
+    parser.add_argument(
+        "--tmpdir",
+        help="Directory for temporary shard files. Default: system default temporary directory."
+    )
+    parser.add_argument(
+        "-d", "--max-dist", type=int, default=1, choices=[1, 2],
+        help="Maximum Hamming distance for correcting singles to multiples. Singles are corrected to the closest "
+             "multiple if unique. Default: %(default)s."
+    )
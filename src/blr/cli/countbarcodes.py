@@ -0,0 +1,134 @@
+"""
+Count occurrences of each barcode sequence in FASTA/FASTQ for clustering with starcode.
+
+The input is read in chunks of complete records which are parsed by a pool of workers. Each worker 2-bit encodes the
+barcodes (see blr.utils.encode_sequence) and counts them. The counts per chunk are merged into a single table of
+unique encoded barcodes and counts. Barcodes that cannot be encoded, e.g. containing N, are counted separately. Output
+is tab-separated with barcode sequence and count for each unique barcode. FASTA input must have single-line sequences.
+"""
+from collections import Counter
+import logging
+from multiprocessing import Pool
+
+import dnaio
+import numpy as np
+from xopen import xopen
+
+from blr.utils import Summary, smart_open, encode_sequences, decode_sequence
+
+logger = logging.getLogger(__name__)
+
+
+def main(args):
+    run_countbarcodes(
+        uncorrected_barcodes=args.uncorrected_barcodes,
+        output=args.output,
+        threads=args.threads,
+        buffer_size=args.buffer_size,
+    )
+
+
+def run_countbarcodes(
+        uncorrected_barcodes: str,
+        output: str,
+        threads: int = 1,
+        buffer_size: int = 4 * 1024 ** 2,
+):
+    logger.info("Starting")
+    summary = Summary()
+
+    with xopen(uncorrected_barcodes, mode="rb") as file:
+        chunks = (bytes(chunk) for chunk in dnaio.read_chunks(file, buffer_size))
+        if threads > 1:
+            with Pool(threads) as workers:
+                counts = merge_counts(workers.imap_unordered(count_chunk, chunks), summary)
+        else:
+            counts = merge_counts(map(count_chunk, chunks), summary)
+
+    codes, code_counts, other_counts = counts
+    summary["Unique barcodes"] = len(codes) + len(other_counts)
+
+    logger.info("Writing barcode counts")
+    with smart_open(output) as file:
+        for code, count in zip(codes.tolist(), code_counts.tolist()):
+            print(f"{decode_sequence(code)}\t{count}", file=file)
+
+        for sequence, count in other_counts.items():
+            print(f"{sequence.decode()}\t{count}", file=file)
+
+    summary.print_stats(__name__)
+    logger.info("Finished")
+
+
+def count_chunk(chunk: bytes):
+    """
+    Count barcodes in chunk of complete FASTA or FASTQ records. Returns unique codes, their counts, a Counter for
+    sequences that could not be encoded and the number of barcodes in the chunk.
+    """
+    sequences = parse_sequences(chunk)
+    codes = encode_sequences(sequences)
+    invalid = np.flatnonzero(codes == 0)
+    other_counts = Counter(sequences[i] for i in invalid)
+    unique_codes, counts = np.unique(codes[codes != 0], return_counts=True)
+    return unique_codes, counts, other_counts, len(sequences)
+
+
+def parse_sequences(chunk: bytes):
+    """Return list of sequences as bytes from chunk of complete FASTA or FASTQ records"""
+    lines = chunk.splitlines()
+    if chunk.startswith(b"@"):
+        return lines[1::4]
+    elif len(lines) == 2 * (chunk.count(b"\n>") + 1):
+        # Each FASTA record has a header and single sequence line.
+        return lines[1::2]
+    return [line for line in lines if line and not line.startswith(b">")]
+
+
+def merge_counts(chunk_counts, summary, max_pending=50_000_000):
+    """
+    Merge counts from chunks into single array of unique codes and counts. Chunk counts are merged once the number
+    of unmerged entries reaches max_pending to bound memory usage.
+    """
+    codes = [np.zeros(0, dtype=np.uint64)]
+    counts = [np.zeros(0, dtype=np.int64)]
+    pending = 0
+    other_counts = Counter()
+    for chunk_codes, chunk_counts, chunk_other_counts, nr_sequences in chunk_counts:
+        summary["Barcodes read"] += nr_sequences
+        summary["Barcodes not encoded"] += sum(chunk_other_counts.values())
+        other_counts.update(chunk_other_counts)
+        codes.append(chunk_codes)
+        counts.append(chunk_counts)
+        pending += len(chunk_codes)
+        if pending >= max_pending:
+            merged_codes, merged_counts = _merge(codes, counts)
+            codes, counts = [merged_codes], [merged_counts]
+            pending = 0
+
+    return (*_merge(codes, counts), other_counts)
+
+
+def _merge(codes, counts):
+    codes = np.concatenate(codes)
+    counts = np.concatenate(counts)
+    unique_codes, inverse = np.unique(codes, return_inverse=True)
+    return unique_codes, np.bincount(inverse, weights=counts, minlength=len(unique_codes)).astype(np.int64)
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "uncorrected_barcodes",
+        help="FASTQ/FASTA for uncorrected barcodes."
+    )
+    parser.add_argument(
+        "-o", "--output", default="-",
+        help="Output tab-separated file with barcode sequence and count. Default: write to stdout."
+    )
+    parser.add_argument(
+        "-t", "--threads", type=int, default=1,
+        help="Number of worker processes used to count barcodes. Default: %(default)s."
+    )
+    parser.add_argument(
+        "--buffer-size", type=int, default=4 * 1024 ** 2,
+        help="Size in bytes of input chunks counted by a worker. Default: %(default)s."
+    )
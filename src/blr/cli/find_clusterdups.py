@@ -11,7 +11,8 @@ Condition to call cluster duplicate:
 """
 
 from argparse import ArgumentError
-from collections import deque, OrderedDict, defaultdict
+from collections import deque, OrderedDict, defaultdict, namedtuple
+import heapq
 import logging
 from math import ceil
 import pickle
@@ -84,23 +85,31 @@ def find_barcode_sets(input, barcode_tag, min_mapq, non_acceptable_overlap, quan
     pos_prev = 0
     BUFFER_SIZE = 200
     barcode_sets = UnionFind()
+    # Barcodes are interned to ints in order of appearance, barcodes[barcode_id] gives the barcode sequence.
+    barcode_ids = {}
+    barcodes = []
     for read, mate in tqdm(paired_reads(input, min_mapq, summary), desc="Reading pairs"):
         barcode = get_bamtag(read, barcode_tag)
         if not barcode:
             summary["Non tagged reads"] += 2
             continue
 
-        orientation = "F" if mate.is_read1 and read.is_read2 else "R"
+        barcode_id = barcode_ids.get(barcode)
+        if barcode_id is None:
+            barcode_id = barcode_ids[barcode] = len(barcodes)
+            barcodes.append(barcode)
+
+        reverse = not (mate.is_read1 and read.is_read2)
 
         summary["Reads analyzed"] += 2
 
         chrom_new = read.reference_name
         pos_new = read.reference_start
 
-        # Store position (5'-ends of R1 and R2) and orientation ('F' or 'R') which is used to group
+        # Store position (5'-ends of R1 and R2) and orientation (forward or reverse) which is used to group
         # duplicates. Based on picard MarkDuplicates definition, see
         # https://sourceforge.net/p/samtools/mailman/message/25062576/
-        current_position = (mate.reference_start, read.reference_end, orientation)
+        current_position = encode_position(mate.reference_start, read.reference_end, reverse)
 
         if abs(pos_new - pos_prev) > BUFFER_SIZE or chrom_new != chrom_prev:
             find_duplicate_positions(positions, dup_positions)
@@ -121,7 +130,10 @@ def find_barcode_sets(input, barcode_tag, min_mapq, non_acceptable_overlap, quan
 
             pos_prev = pos_new
 
-        positions.setdefault(current_position, PositionTracker(current_position)).add_barcode(barcode)
+        tracked_position = positions.get(current_position)
+        if tracked_position is None:
+            tracked_position = positions[current_position] = PositionTracker(current_position)
+        tracked_position.add_barcode(barcode_id)
 
     # Process last chunk
     find_duplicate_positions(positions, dup_positions)
@@ -132,33 +144,84 @@ def find_barcode_sets(input, barcode_tag, min_mapq, non_acceptable_overlap, quan
     logger.info(f"Removing duplicate positions with >= {threshold} barcodes for {chrom_prev}")
     query_barcode_duplicates(dup_positions, barcode_sets, threshold, window, non_acceptable_overlap, summary)
 
-    return barcode_sets
+    return decode_barcode_sets(barcode_sets, barcodes)
+
+
+def encode_position(start: int, end: int, reverse: bool) -> int:
+    """Pack position (start, end, orientation) into a single int fitting in int64. Coordinates must be < 2**31."""
+    return start << 32 | end << 1 | reverse
+
+
+def decode_position(position: int):
+    """Return (start, end, reverse) for position packed using encode_position"""
+    return position >> 32, (position >> 1) & 0x7FFFFFFF, bool(position & 1)
+
+
+def decode_barcode_sets(barcode_sets, barcodes):
+    """
+    Translate UnionFind of barcode ids to UnionFind of barcode sequences. Each set is named by its lexicographically
+    smallest barcode as for UnionFind.union.
+    """
+    roots = {}
+    for component in barcode_sets.connected_components():
+        root = min(barcodes[barcode_id] for barcode_id in component)
+        for barcode_id in component:
+            roots[barcode_id] = root
+
+    return UnionFind({barcodes[barcode_id]: roots[barcode_id] for barcode_id in barcode_sets})
+
+
+# Fields of the first read in a pair used by find_barcode_sets once the mate is found.
+CachedRead = namedtuple("CachedRead", ["reference_start", "next_reference_start", "is_read1", "is_reverse"])
 
 
 def paired_reads(path: str, min_mapq: int, summary):
     """
-    Yield (forward_read, reverse_read) pairs for all properly paired read pairs in the input file.
+    Yield (read, mate) pairs for all properly paired read pairs in the input file. The mate is the first read
+    of the pair in the file and only the fields in CachedRead are kept for it.
+
+    Reads are cached until their mate is found. Since the input is coordinate-sorted, a cached read is evicted once the
+    scan has moved past the position of its mate (next_reference_start) or to another reference as the mate will not
+    be found, e.g. if it was filtered or is missing from the file.
 
     :param path: str, path to SAM file
     :param min_mapq: int
     :param summary: dict
-    :return: read, mate: both as pysam AlignedSegment objects.
+    :return: read, mate: pysam AlignedSegment and CachedRead.
     """
     cache = {}
+    mate_positions = []  # Heap of (next_reference_start, query_name) for cached reads
+    reference_id = None
     save = set_verbosity(0)  # Fix for https://github.com/pysam-developers/pysam/issues/939
     with AlignmentFile(path) as openin:
         for read in openin:
             summary["Total reads"] += 1
+            if read.reference_id != reference_id:
+                summary["Reads with missing mate"] += len(cache)
+                cache.clear()
+                mate_positions.clear()
+                reference_id = read.reference_id
+
+            while mate_positions and mate_positions[0][0] < read.reference_start:
+                position, name = heapq.heappop(mate_positions)
+                cached = cache.get(name)
+                if cached is not None and cached.next_reference_start == position:
+                    del cache[name]
+                    summary["Reads with missing mate"] += 1
+
             # Requirements: read mapped, mate mapped and read has barcode tag
             # Cache read if matches requirements, continue with pair.
             if read.query_name in cache:
                 mate = cache.pop(read.query_name)
             else:
                 if pair_is_mapped_and_proper(read, min_mapq, summary):
-                    cache[read.query_name] = read
+                    cache[read.query_name] = CachedRead(read.reference_start, read.next_reference_start,
+                                                        read.is_read1, read.is_reverse)
+                    heapq.heappush(mate_positions, (read.next_reference_start, read.query_name))
                 continue
             if pair_orientation_is_fr(read, mate, summary):
                 yield read, mate
+    summary["Reads with missing mate"] += len(cache)
     set_verbosity(save)
 
 
@@ -182,7 +245,7 @@ def pair_is_mapped_and_proper(read: AlignedSegment, min_mapq: int, summary) -> b
     return True
 
 
-def pair_orientation_is_fr(read: AlignedSegment, mate: AlignedSegment, summary) -> bool:
+def pair_orientation_is_fr(read: AlignedSegment, mate: CachedRead, summary) -> bool:
     # Proper layout of read pair.
     # PAIR      |       mate            read
     # ALIGNMENTS|    ---------->      <--------
@@ -226,14 +289,14 @@ def query_barcode_duplicates(dup_positions, barcode_sets, threshold: float, wind
     """
     Query barcode duplicates from list of duplicate positions. Position are filtered using the set threshold.
     """
-    buffer_dup_pos = deque()
+    buffer_dup_pos = DuplicatePositionBuffer()
     for _, tracked_position in tqdm(dup_positions.items(), desc="Seeding dups"):
         if len(tracked_position.barcodes) < threshold:
             summary["Filtered barcode duplicate positions"] += 1
             seed_duplicates(
                 barcode_sets=barcode_sets,
                 buffer_dup_pos=buffer_dup_pos,
-                position=tracked_position.position,
+                position=decode_position(tracked_position.position),
                 position_barcodes=tracked_position.barcodes,
                 window=window,
                 non_acceptable_overlap=non_acceptable_overlap,
@@ -250,17 +313,18 @@ def get_non_acceptable_overlap_func(library_type: str):
 
 class PositionTracker:
     """
-    Stores barcodes related to a position. The position is considered duplicate if more than one barcode is present.
+    Stores barcode ids related to a position encoded using encode_position. The position is considered duplicate if
+    more than one barcode is present.
     """
-    def __init__(self, position):
+    __slots__ = ("position", "barcodes", "has_updated_barcodes")
+
+    def __init__(self, position: int):
         self.position = position
-        self.reads = 0
         self.barcodes = set()
         self.has_updated_barcodes = False
 
-    def add_barcode(self, barcode: str):
+    def add_barcode(self, barcode: int):
         self.has_updated_barcodes = barcode not in self.barcodes
-        self.reads += 2
         self.barcodes.add(barcode)
 
     def is_duplicate(self) -> bool:
@@ -273,34 +337,81 @@ def seed_duplicates(barcode_sets, buffer_dup_pos, position, position_barcodes, w
     to construct a graph. For Tn5 type libraries, overlapping positions are not compared unless they are allowed by Tn5
     tagmentation (i.e overlap 9±1 bp).
     :param barcode_sets: dict: Tracks which barcodes should be merged.
-    :param buffer_dup_pos: list: Tracks previous duplicate positions and their barcode sets.
+    :param buffer_dup_pos: DuplicatePositionBuffer: Tracks previous duplicate positions and their barcode sets.
     :param position: tuple: Positions (start, stop) to be analyzed and subsequently saved to buffer.
-    :param position_barcodes: seq: Barcodes at analyzed position
+    :param position_barcodes: set: Barcode ids at analyzed position
     :param window: int: Max distance allowed between postions to call barcode duplicate.
     """
-    # Loop over list to get the positions closest to the analyzed position first. When positions
-    # are out of the window size of the remaining buffer is removed.
     if not barcode_sets.same_component(*position_barcodes):
-        for index, (compared_position, compared_barcodes) in enumerate(buffer_dup_pos):
-            distance = position[0] - compared_position[1]
+        buffer_dup_pos.evict(position[0] - window)
+
+        # Only positions sharing at least two barcodes can be connected so other positions are not compared.
+        for compared_stop, compared_barcodes in buffer_dup_pos.shared(position_barcodes):
+            distance = position[0] - compared_stop
 
             if non_acceptable_overlap(distance):
                 continue
 
-            if distance <= window:
-                barcode_intersect = position_barcodes & compared_barcodes
+            barcode_sets.union(*(position_barcodes & compared_barcodes))
+
+        buffer_dup_pos.add(position[1], position_barcodes)
 
-                # If two or more unique barcodes are found, update merge dict
-                if len(barcode_intersect) >= 2:
-                    barcode_sets.union(*barcode_intersect)
-            else:
-                # Remove positions outside of window (at end of list) since positions are sorted.
-                for _ in range(len(buffer_dup_pos) - index):
-                    buffer_dup_pos.pop()
-                break
 
-        # Add new position at the start of the list.
-        buffer_dup_pos.appendleft((position, position_barcodes))
+class DuplicatePositionBuffer:
+    """
+    Buffer of previous duplicate positions within the window with an inverted index from barcode id to positions.
+
+    Positions are evicted the same way as when scanning the buffer from the newest position, i.e. once a position stops
+    before the window all positions added before it are evicted as well.
+    """
+    __slots__ = ("index", "stops", "nr_added", "last_evicted")
+
+    def __init__(self):
+        self.index = {}  # Barcode id -> deque of (number, stop, barcodes) in the order positions were added
+        self.stops = []  # Heap of (stop, number, barcodes)
+        self.nr_added = 0
+        self.last_evicted = -1  # Positions numbered up to and including this are evicted
+
+    def add(self, stop: int, barcodes):
+        entry = (self.nr_added, stop, barcodes)
+        for barcode in barcodes:
+            positions = self.index.get(barcode)
+            if positions is None:
+                positions = self.index[barcode] = deque()
+            positions.append(entry)
+        heapq.heappush(self.stops, (stop, self.nr_added, barcodes))
+        self.nr_added += 1
+
+    def evict(self, min_stop: int):
+        """Evict positions stopping before min_stop and all positions added before these."""
+        expired = []
+        while self.stops and self.stops[0][0] < min_stop:
+            _, number, barcodes = heapq.heappop(self.stops)
+            self.last_evicted = max(self.last_evicted, number)
+            expired.append(barcodes)
+
+        for barcodes in expired:
+            for barcode in barcodes:
+                self._trim(barcode)
+
+    def shared(self, barcodes):
+        """Yield (stop, barcodes) for positions with at least two barcodes in common with barcodes."""
+        counts = {}
+        for barcode in barcodes:
+            for number, stop, compared_barcodes in self._trim(barcode):
+                count = counts.get(number, 0) + 1
+                counts[number] = count
+                if count == 2:
+                    yield stop, compared_barcodes
+
+    def _trim(self, barcode):
+        """Remove evicted positions for barcode and return the remaining"""
+        positions = self.index.get(barcode, ())
+        while positions and positions[0][0] <= self.last_evicted:
+            positions.popleft()
+        if not positions and barcode in self.index:
+            del self.index[barcode]
+        return positions
 
 
 class UnionFind:
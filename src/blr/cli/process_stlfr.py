@@ -4,20 +4,28 @@ Process stLFR reads with existing barcodes in header.
 Barcodes of type '21_325_341' where numbers correspond to barcode sequences are translated to unique DNA strings-type
 barcode of length 16 nt (similar to 10x barcode format)
 """
-
+from array import array
 from contextlib import ExitStack
+import io
 from itertools import product
 import logging
+from multiprocessing import get_context
 import sys
 from pathlib import Path
 
 import dnaio
+import numpy as np
+from xopen import xopen
 
 from blr.utils import Summary, ACCEPTED_READ_MAPPERS, tqdm
-from blr.cli.tagfastq import Output, ChunkHandler, write_ema_output, write_lariat_output
+from blr.cli.tagfastq import Output, BucketHandler, write_ema_output, write_lariat_output, add_output_arguments, UBAM
 
 logger = logging.getLogger(__name__)
 
+# Number of consecutive heaps grouped into the same bucket when sorting output for ema and lariat. The total number of
+# barcodes is not known beforehand so a fixed width is used.
+HEAPS_PER_BUCKET = 65536
+
 
 def main(args):
     run_process_stlfr(
@@ -33,6 +41,11 @@ def main(args):
         barcode_tag=args.barcode_tag,
         mapper=args.mapper,
         sample_number=args.sample_nr,
+        tmpdir=args.tmpdir,
+        sort_memory=args.sort_memory,
+        compression_threads=args.compression_threads,
+        output_ubam=args.output_ubam,
+        workers=args.workers,
     )
 
 
@@ -49,19 +62,29 @@ def run_process_stlfr(
         barcode_tag: str,
         mapper: str,
         sample_number: int,
+        tmpdir: str = None,
+        sort_memory: float = 1,
+        compression_threads: int = 0,
+        output_ubam: str = None,
+        workers: int = 1,
 ):
     logger.info("Starting")
 
     summary = Summary()
 
-    barcodes = BarcodeGenerator()
+    barcodes = BarcodeGenerator(record_translations=output_translations is not None)
 
     in_interleaved = not input2
     logger.info(f"Input detected as {'interleaved' if in_interleaved else 'paired'} FASTQ.")
 
     special_fmt = False
     out_interleaved = not output2 or not output1
-    if output_bins is not None:
+    if output_ubam is not None:
+        if mapper in ["ema", "lariat"]:
+            sys.exit(f"Output as unaligned BAM is not available for mapper '{mapper}'.")
+        logger.info(f"Writing output as unaligned BAM to {output_ubam}.")
+        output1, output2 = None, None
+    elif output_bins is not None:
         logger.info(f"Writing output as binned interleaved FASTQ to {output_bins}.")
         output_bins = Path(output_bins)
         output_bins.mkdir(exist_ok=True)
@@ -78,18 +101,36 @@ def run_process_stlfr(
         logger.warning(f"Writing non barcoded reads to {output_nobc1} is only available with option '--mapper ema'.")
         output_nobc1, output_nobc2 = None, None
 
+    # Read pairs processed by workers are written directly as FASTQ unless they need further handling by the Output.
+    raw = workers > 1 and mapper not in ["ema", "lariat"] and output_bins is None and output_ubam is None
+
     # Parse input FASTA/FASTQ for read1 and read2, uncorrected barcodes and write output
     with ExitStack() as stack:
-        reader = stack.enter_context(dnaio.open(input1, file2=input2, interleaved=in_interleaved, mode="r"))
         writer = stack.enter_context(Output(file1=output1, file2=output2, interleaved=out_interleaved, mapper=mapper,
                                             file_nobc1=output_nobc1, file_nobc2=output_nobc2, bins_dir=output_bins,
-                                            nr_bins=nr_bins))
-        chunks = None
+                                            nr_bins=nr_bins, compression_threads=compression_threads, raw=raw,
+                                            ubam=output_ubam, barcode_tag=barcode_tag, sample_number=sample_number))
+        buckets = None
         if mapper == "lariat" or (mapper == "ema" and output_bins is None):
-            chunks = stack.enter_context(ChunkHandler(chunk_size=1_000_000))
+            buckets = stack.enter_context(BucketHandler(HEAPS_PER_BUCKET, memory=int(sort_memory * 1024 ** 3),
+                                                        tmpdir=tmpdir))
             heaps = BarcodeHeap()
 
-        for read1, read2, barcode in parse_stlfr_reads(reader, barcodes, barcode_tag, mapper, summary, special_fmt):
+        naming = UBAM if output_ubam is not None else mapper
+        if workers > 1:
+            logger.info(f"Processing reads using {workers} workers.")
+            read_pairs = parse_stlfr_reads_parallel(input1, input2, barcodes, barcode_tag, naming, summary,
+                                                    special_fmt, workers, raw=raw, interleaved=out_interleaved)
+            if raw:
+                for data1, data2 in read_pairs:
+                    writer.write_raw(data1, data2)
+                read_pairs = []
+        else:
+            reader = stack.enter_context(dnaio.open(input1, file2=input2, interleaved=in_interleaved, mode="r"))
+            read_pairs = parse_stlfr_reads(tqdm(reader, desc="Read pairs processed"), barcodes, barcode_tag, naming,
+                                           summary, special_fmt)
+
+        for read1, read2, barcode in read_pairs:
             if barcode is None:
                 summary["Read pairs missing barcode"] += 1
 
@@ -107,35 +148,35 @@ def run_process_stlfr(
                 writer.write_ema_special(read1, read2, barcode)
                 summary["Read pairs written"] += 1
             elif mapper == "ema":
-                chunks.build_chunk(
-                    f"{heaps.get_heap(barcode)}\t"
-                    f"{read1.name}\t"
-                    f"{read1.sequence}\t"
-                    f"{read1.qualities}\t"
-                    f"{read2.sequence}\t"
-                    f"{read2.qualities}\n"
+                buckets.add(
+                    heaps.get_heap(barcode),
+                    (
+                        read1.name,
+                        read1.sequence,
+                        read1.qualities,
+                        read2.sequence,
+                        read2.qualities,
+                    )
                 )
             elif mapper == "lariat":
-                chunks.build_chunk(
-                    f"{heaps.get_heap(barcode)}\t"
-                    f"@{read1.name}\t"
-                    f"{read1.sequence}\t"
-                    f"{read1.qualities}\t"
-                    f"{read2.sequence}\t"
-                    f"{read2.qualities}\t"
-                    f"{barcode}-{sample_number}\t"
-                    f"KKKKKKKKKKKKKKKK\t"
-                    "AAAAAA\t"
-                    "KKKKKK\n"
+                buckets.add(
+                    heaps.get_heap(barcode),
+                    (
+                        f"@{read1.name}",
+                        read1.sequence,
+                        read1.qualities,
+                        read2.sequence,
+                        read2.qualities,
+                        f"{barcode}-{sample_number}",
+                        "KKKKKKKKKKKKKKKK",
+                        "AAAAAA",
+                        "KKKKKK",
+                    )
                 )
             else:
                 summary["Read pairs written"] += 1
                 writer.write(read1, read2)
 
-        # Empty final cache
-        if chunks is not None:
-            chunks.write_chunk()
-
         if mapper == "lariat" and output_bins is not None:
             remaining_reads = summary["Read pairs read"] - summary["Reads missing barcode"] - summary["Read pairs written"]  # noqa: E501
             bin_size = remaining_reads // nr_bins
@@ -143,27 +184,29 @@ def run_process_stlfr(
             writer.set_bin_size(bin_size)
 
         if mapper == "ema" and output_bins is None:
-            write_ema_output(chunks, writer, summary)
+            write_ema_output(buckets, writer, summary)
         elif mapper == "lariat":
-            write_lariat_output(chunks, writer, summary)
+            write_lariat_output(buckets, writer, summary)
 
     if output_translations is not None:
         with open(output_translations, "w") as f:
-            for index, barcode in barcodes.translate_barcode.items():
-                print(f"{index},{barcode}", file=f)
+            for index_string, barcode in barcodes.translations():
+                print(f"{index_string},{barcode}", file=f)
 
     summary.print_stats(__name__)
     logger.info("Finished")
 
 
 def parse_stlfr_reads(reader, barcodes, barcode_tag, mapper, summary, special_fmt):
-    for read1, read2 in tqdm(reader, desc="Read pairs processed"):
+    for read1, read2 in reader:
         summary["Read pairs read"] += 1
 
         name = read1.name.split("\t")[0]
 
         # Remove '/1' from read name and split to get barcode_indices
-        name, barcode_indices = name.strip("/1").split("#")
+        if name.endswith("/1"):
+            name = name[:-2]
+        name, barcode_indices = name.split("#")
 
         barcode = translate_indeces(barcode_indices, barcodes, summary)
 
@@ -171,6 +214,9 @@ def parse_stlfr_reads(reader, barcodes, barcode_tag, mapper, summary, special_fm
             barcode_id = f"{barcode_tag}:Z:{barcode}"
             if special_fmt:
                 pass
+            elif mapper == UBAM:
+                # Barcode is added as SAM tag in the read comment which is converted to a proper tag in the uBAM.
+                name = f"{name} {barcode_id}"
             elif mapper == "ema":
                 # The EMA aligner requires reads in 10x FASTQ format e.g.
                 # @READNAME:AAAAAAAATATCTACGCTCA BX:Z:AAAAAAAATATCTACGCTCA
@@ -183,6 +229,90 @@ def parse_stlfr_reads(reader, barcodes, barcode_tag, mapper, summary, special_fm
         yield read1, read2, barcode
 
 
+# Read-only state shared with worker processes. This is set before the worker pool is created so that workers
+# inherit it on fork rather than having it pickled and sent with each chunk.
+_worker_state = {}
+
+
+def parse_stlfr_reads_parallel(input1, input2, barcodes, barcode_tag, mapper, summary, special_fmt, workers, raw,
+                               interleaved, buffer_size=4 * 1024 ** 2):
+    """
+    Process chunks of read pairs using multiple worker processes. Chunks are returned in input order so that the
+    result is identical to processing the reads serially. If raw is True, the FASTQ formatted bytes for read1 and
+    read2 of each chunk are generated, otherwise read1, read2 and barcode for each read pair as for
+    parse_stlfr_reads.
+    """
+    _worker_state.update(barcode_tag=barcode_tag, mapper=mapper, special_fmt=special_fmt, raw=raw,
+                         interleaved=interleaved, record_translations=barcodes.record_translations)
+    try:
+        chunks = read_chunks(input1, input2, buffer_size)
+        with get_context("fork").Pool(workers) as pool:
+            for chunk_summary, recorded, result in tqdm(pool.imap(_process_chunk, chunks), desc="Chunks processed"):
+                summary.update(chunk_summary)
+                barcodes.update_recorded(recorded)
+                if raw:
+                    yield result
+                else:
+                    yield from result
+    finally:
+        _worker_state.clear()
+
+
+def read_chunks(input1, input2, buffer_size):
+    """Generate chunks of complete read pairs as bytes from paired or interleaved FASTQ"""
+    with ExitStack() as stack:
+        file1 = stack.enter_context(xopen(input1, mode="rb"))
+        if input2:
+            file2 = stack.enter_context(xopen(input2, mode="rb"))
+            for chunk1, chunk2 in dnaio.read_paired_chunks(file1, file2, buffer_size):
+                yield bytes(chunk1), bytes(chunk2)
+            return
+
+        remainder = b""
+        for chunk in dnaio.read_chunks(file1, buffer_size):
+            chunk = remainder + bytes(chunk)
+            if not chunk.endswith(b"\n"):
+                chunk += b"\n"
+            # FASTQ records have four lines so an odd number of records leaves a read1 to pair with the next chunk.
+            remainder = b""
+            if chunk.count(b"\n") % 8:
+                start = len(chunk) - 1
+                for _ in range(4):
+                    start = chunk.rindex(b"\n", 0, start)
+                chunk, remainder = chunk[:start + 1], chunk[start + 1:]
+            if chunk:
+                yield chunk, None
+
+        if remainder:
+            yield remainder, None
+
+
+def _process_chunk(chunk):
+    """Process chunk of read pairs in worker process"""
+    chunk1, chunk2 = chunk
+    summary = Summary()
+    barcodes = BarcodeGenerator(record_translations=_worker_state["record_translations"])
+    file2 = io.BytesIO(chunk2) if chunk2 is not None else None
+    with dnaio.open(io.BytesIO(chunk1), file2=file2, interleaved=file2 is None, mode="r") as reader:
+        read_pairs = parse_stlfr_reads(reader, barcodes, _worker_state["barcode_tag"], _worker_state["mapper"],
+                                       summary, _worker_state["special_fmt"])
+        if not _worker_state["raw"]:
+            read_pairs = list(read_pairs)
+            return summary, barcodes.recorded(), read_pairs
+
+        out1 = []
+        out2 = out1 if _worker_state["interleaved"] else []
+        for read1, read2, barcode in read_pairs:
+            if barcode is None:
+                summary["Read pairs missing barcode"] += 1
+            summary["Read pairs written"] += 1
+            out1.append(read1.fastq_bytes())
+            out2.append(read2.fastq_bytes())
+
+    result = b"".join(out1), b"" if _worker_state["interleaved"] else b"".join(out2)
+    return summary, barcodes.recorded(), result
+
+
 def translate_indeces(index_string, barcodes, summary):
     if index_string == "0_0_0":  # stLFR reads are tagged with 0_0_0 if the barcode could not be identified.
         summary["Skipped barcode type 0_0_0"] += 1
@@ -190,38 +320,92 @@ def translate_indeces(index_string, barcodes, summary):
     elif len(index_string.split("_")) < 3:
         summary["Skipped barcode of incorrect length"] += 1
         return None
-    return barcodes.get(index_string)
+
+    barcode = barcodes.get(index_string)
+    if barcode is None:
+        summary["Skipped barcode with invalid index"] += 1
+    return barcode
 
 
 class BarcodeGenerator:
     """
-    Generate 16 nt unique barcode barcodes for particular stLFR index string, e.g. '1_2_4'
-     """
-    def __init__(self,):
-        self._barcode_generator = self._generate_barcodes()
-        # Skip first entry which is AAAAAAAAAAAAAAAA. Reads tagged with this barcode causes
-        # error `Segmentation fault: 11` in ema.
-        _ = next(self._barcode_generator)
-        self.translate_barcode = {}
-
-    def get(self, index_string):
-        if index_string in self.translate_barcode:
-            return self.translate_barcode[index_string]
+    Translate stLFR index string, e.g. '1_2_4', to unique 16 nt barcode.
 
-        barcode = next(self._barcode_generator)
-        self.translate_barcode[index_string] = barcode
-        return barcode
+    The three indices, each in range 0-1536, are combined into a single number which is written in base 4 using the
+    bases 'ATCG'. The number is offset by one to skip AAAAAAAAAAAAAAAA as reads tagged with this barcode causes error
+    `Segmentation fault: 11` in ema. The translation is deterministic so no mapping needs to be stored. If
+    record_translations is True, the translated indices are recorded for output using the translations method.
+    """
+    # Note: Theoretical barcode numbers.
+    #   Possible stLFR barcodes including index 0: 1537*1537*1537 = 3,630,961,153
+    #   Possible barcodes of len 16:               4^16 =           4,294,967,296
+    NR_INDICES = 1537
+    # Lookup table for the barcode halves of 8 nt.
+    _HALVES = ["".join(bases) for bases in product("ATCG", repeat=8)]
+
+    def __init__(self, record_translations=False):
+        self.record_translations = record_translations
+        self._recorded = array("Q") if record_translations else None
+        self._max_recorded = 10_000_000
 
-    @staticmethod
-    def _generate_barcodes():
-        """
-        Iterator to generate unique 16 nt barcode
-        """
-        # Note: Theortical barcode numbers.
-        #   Possible stLFR barcodes: 1536*1536*1536 = 3,623,878,656
-        #   Possible barcodes of len 16: 4^16 =       4,294,967,296
-        for barcode in product("ATCG", repeat=16):
-            yield "".join(barcode)
+    def get(self, index_string):
+        """Return barcode for index string or None if the index string is not valid"""
+        number = self.to_number(index_string)
+        if number is None:
+            return None
+
+        if self._recorded is not None:
+            self._record(number)
+        return self.to_barcode(number)
+
+    @classmethod
+    def to_number(cls, index_string):
+        try:
+            a, b, c = map(int, index_string.split("_"))
+        except ValueError:
+            return None
+
+        if not (0 <= a < cls.NR_INDICES and 0 <= b < cls.NR_INDICES and 0 <= c < cls.NR_INDICES):
+            return None
+        return (a * cls.NR_INDICES + b) * cls.NR_INDICES + c + 1
+
+    @classmethod
+    def to_barcode(cls, number):
+        return cls._HALVES[number >> 16] + cls._HALVES[number & 0xFFFF]
+
+    @classmethod
+    def to_index_string(cls, number):
+        number, c = divmod(number - 1, cls.NR_INDICES)
+        a, b = divmod(number, cls.NR_INDICES)
+        return f"{a}_{b}_{c}"
+
+    def _record(self, number):
+        self._recorded.append(number)
+        if len(self._recorded) >= self._max_recorded:
+            self._compact()
+
+    def _compact(self):
+        self._recorded = array("Q", self.recorded().tobytes())
+        # Allow the recorded numbers to grow before compacting again.
+        self._max_recorded = max(self._max_recorded, 2 * len(self._recorded))
+
+    def recorded(self):
+        """Return array of unique recorded numbers, see to_number"""
+        if self._recorded is None:
+            return np.zeros(0, dtype=np.uint64)
+        return np.unique(np.frombuffer(self._recorded, dtype=np.uint64))
+
+    def update_recorded(self, numbers):
+        """Record array of numbers, e.g. from the recorded method of another BarcodeGenerator"""
+        if self._recorded is not None and len(numbers) > 0:
+            self._recorded.frombytes(numbers.astype(np.uint64).tobytes())
+            if len(self._recorded) >= self._max_recorded:
+                self._compact()
+
+    def translations(self):
+        """Generate index string and barcode for recorded indices in order of the index"""
+        for number in self.recorded().tolist():
+            yield self.to_index_string(number), self.to_barcode(number)
 
 
 class BarcodeHeap:
@@ -229,11 +413,11 @@ class BarcodeHeap:
         self._heap = 0
         self._barcodes = {}
 
-    def get_heap(self, barcode: str) -> str:
+    def get_heap(self, barcode: str) -> int:
         heap = self._barcodes.setdefault(barcode, self._heap + 1)
         if heap > self._heap:
             self._heap += 1
-        return str(heap)
+        return heap
 
 
 def add_arguments(parser):
@@ -274,6 +458,12 @@ def add_arguments(parser):
         help=f"Output barcoded reads to bins named '{Output.BIN_FASTQ_TEMPLATE}' in the provided directory. Only "
              f"used for ema mapping and uses ema special format."
     )
+    output.add_argument(
+        "--output-ubam",
+        help="Output read pairs to unaligned BAM with barcodes stored as SAM tags rather than in the read names. "
+             "The barcode tag includes the sample number so the output does not need processing by `blr tagbam`. "
+             "Not available for mappers ema and lariat."
+    )
     parser.add_argument(
         "--nr-bins", type=int, default=100,
         help="Number of bins to split reads into when using the '--output-bins' alternative. Default: %(default)s."
@@ -294,3 +484,9 @@ def add_arguments(parser):
         "--sample-nr", type=int, default=1,
         help="Sample number to append to barcode string. Default: %(default)s."
     )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="Number of worker processes used to process reads. Input is split into chunks of read pairs that are "
+             "processed in parallel and written in input order. Input must be FASTQ. Default: %(default)s."
+    )
+    add_output_arguments(parser)
@@ -1,22 +1,18 @@
 """
 Parse molecule information from BAM and output stats
 """
+from heapq import heappop, heappush, heapreplace
 import logging
 import sys
 from contextlib import ExitStack
 
 import pysam
-import numpy as np
 
-from blr.cli.buildmolecules import Molecule, DEFAULT_MOLECULE_ID
-from blr.utils import get_bamtag, Summary, tqdm, ACCEPTED_LIBRARY_TYPES, LastUpdatedOrderedDict, calculate_N50
+from blr.cli.buildmolecules import Molecule, MoleculeStore, DEFAULT_MOLECULE_ID, update_summary_from_molecule_stats
+from blr.utils import get_bamtag, Summary, tqdm, ACCEPTED_LIBRARY_TYPES
 
 logger = logging.getLogger(__name__)
 
-# This constant should be larger than the maximum possible molecules one could expect. The largest count I have
-# seen so far is about 60k so this takes some additional height to this. It could be expanded further if needed.
-MAX_MOLECULE_COUNT = 1_000_000_000
-
 
 def main(args):
     run_readmolecules(
@@ -27,7 +23,8 @@ def main(args):
         barcode_tag=args.barcode_tag,
         molecule_tag=args.molecule_tag,
         min_mapq=args.min_mapq,
-        library_type=args.library_type
+        library_type=args.library_type,
+        window=args.window,
     )
 
 
@@ -39,53 +36,39 @@ def run_readmolecules(
     barcode_tag: str,
     molecule_tag: str,
     min_mapq: int,
-    library_type: str
+    library_type: str,
+    window: int = 30000,
 ):
 
     summary = Summary()
-    stats = np.empty((MAX_MOLECULE_COUNT, 2))
-    i = 0
+    molecules = MoleculeStore()
     # Read molecules from BAM
     save = pysam.set_verbosity(0)  # Fix for https://github.com/pysam-developers/pysam/issues/939
-    with ExitStack() as stack:
-        infile = stack.enter_context(pysam.AlignmentFile(input, "rb"))
+    with pysam.AlignmentFile(input, "rb") as infile:
+        for molecule in parse_molecules(openbam=infile, barcode_tag=barcode_tag, molecule_tag=molecule_tag,
+                                        library_type=library_type, min_mapq=min_mapq, summary=summary,
+                                        window=window):
+            summary["Molecules candidate"] += 1
+            if molecule.nr_reads >= threshold:
+                summary["Molecules called"] += 1
+                molecules.append(molecule)
 
+    pysam.set_verbosity(save)
+
+    with ExitStack() as stack:
         # Setup TSV
         if output_tsv is None:
             tsv = sys.stdout
         else:
             tsv = stack.enter_context(open(output_tsv, "w"))
-        print("MoleculeID", "Barcode", "Reads", "Length", "BpCovered", sep="\t", file=tsv)
+        molecules.write_tsv(tsv)
 
         # Setup BED
         if bed_file:
             bed = stack.enter_context(open(bed_file, "w"))
+            molecules.write_bed(bed)
 
-        for molecule in parse_molecules(openbam=infile, barcode_tag=barcode_tag, molecule_tag=molecule_tag,
-                                        library_type=library_type, min_mapq=min_mapq, summary=summary):
-            summary["Molecules candidate"] += 1
-            if molecule.nr_reads >= threshold:
-                summary["Molecules called"] += 1
-
-                stats[i, 0] = molecule.length()
-                stats[i, 1] = molecule.bp_covered
-                i += 1
-
-                print(molecule.to_tsv(), file=tsv)
-                if bed_file:
-                    print(molecule.to_bed(), file=bed)
-
-    pysam.set_verbosity(save)
-
-    if i > 0:
-        stats.resize((i, 2))
-        coverage = 100 * stats[:, 1] / stats[:, 0]
-        summary["Fragment N50 (bp)"] = calculate_N50(stats[:, 0])
-        summary["Mean fragment size (bp)"] = np.mean(stats[:, 0])
-        summary["Median fragment size (bp)"] = np.median(stats[:, 0])
-        summary["Longest fragment (bp)"] = np.max(stats[:, 0])
-        summary["Mean fragment read coverage (%)"] = np.mean(coverage)
-        summary["Median fragment read coverage (%)"] = np.median(coverage)
+    update_summary_from_molecule_stats(molecules, summary)
 
     summary.print_stats(name=__name__)
 
@@ -114,40 +97,52 @@ def parse_reads(openbam, barcode_tag, molecule_tag, min_mapq, summary):
         yield barcode, molecule_id, read
 
 
-def parse_molecules(openbam, barcode_tag, molecule_tag, library_type, min_mapq, summary):
-    molecules = LastUpdatedOrderedDict()
+def parse_molecules(openbam, barcode_tag, molecule_tag, library_type, min_mapq, summary, window=30000):
+    """
+    Yield molecules from reads tagged with barcode and molecule index. A molecule is closed once the current position
+    is more than window past its stop. Open molecules are kept in a heap keyed on stop position so that finished
+    molecules are found without scanning the others. Reads sharing a molecule index can still be further apart than
+    window, e.g. mates, so closed molecules are kept without their read names until the end of the chromosome and
+    reopened if their molecule index is seen again.
+    """
+    molecules = {}
+    closed = {}
+    stops = []
     prev_chrom = openbam.references[0]
-    MAX_DIST = 300_000
-    BUFFER_STEP = 1000
-    buffer_pos = MAX_DIST + BUFFER_STEP
     for barcode, molecule_id, read in parse_reads(openbam, barcode_tag, molecule_tag, min_mapq, summary):
         if not prev_chrom == read.reference_name:
+            yield from closed.values()
             yield from molecules.values()
             molecules.clear()
+            closed.clear()
+            stops.clear()
             prev_chrom = read.reference_name
 
+        # Heap entries are only updated with the molecule stop position when reaching the top of the heap.
+        window_start = read.reference_start - window
+        while stops and stops[0][0] < window_start:
+            index = stops[0][1]
+            molecule = molecules[index]
+            if molecule.stop < window_start:
+                heappop(stops)
+                # Read names are only used to allow overlaps within pairs, which cannot occur for closed molecules.
+                molecule.read_headers.clear()
+                closed[index] = molecules.pop(index)
+            else:
+                heapreplace(stops, (molecule.stop, index))
+
         index = (barcode, molecule_id)
+        if index in closed:
+            molecules[index] = closed.pop(index)
+            heappush(stops, (molecules[index].stop, index))
+
         if index not in molecules:
             molecules[index] = Molecule(read, barcode, index=molecule_id)
+            heappush(stops, (molecules[index].stop, index))
         elif molecules[index].has_acceptable_overlap(read, library_type, summary):
             molecules[index].add_read(read)
-            molecules.move_to_end(index)
-
-        if read.reference_start > buffer_pos:
-            # Leap to current position if ahead of buffer
-            buffer_pos = max(read.reference_start, buffer_pos + BUFFER_STEP)
-
-            # Loop over molecules in order of last updated. Get indexes of molecules who are outside MAX_DIST
-            # from current position and stop looping if within this distance.
-            molcules_to_report = []
-            for i, molecule in molecules.items():
-                if abs(molecule.stop - read.reference_start) > MAX_DIST:
-                    molcules_to_report.append(i)
-                else:
-                    break
-
-            yield from (molecules.pop(i) for i in molcules_to_report)
 
+    yield from closed.values()
     yield from molecules.values()
 
 
@@ -186,3 +181,9 @@ def add_arguments(parser):
         "-l", "--library-type", default="blr", choices=ACCEPTED_LIBRARY_TYPES,
         help="Select library type from currently available technologies: %(choices)s. Default: %(default)s."
     )
+    parser.add_argument(
+        "-w", "--window", type=int, default=30000,
+        help="Window size used when building molecules. Molecules are closed once reads are further than this "
+             "from their end and are reopened if their molecule index is seen again on the same chromosome. "
+             "Default: %(default)s."
+    )
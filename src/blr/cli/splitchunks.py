@@ -0,0 +1,157 @@
+"""
+Split BAM into chunks of contigs in a single pass while transferring barcode information from read names to SAM tags.
+
+Each chunk is defined by a BED file covering whole contigs, see rule make_chunk_beds in the Snakefile. Alignments are
+written to the BAM of the chunk containing their contig and unplaced unmapped reads to a separate BAM. Read names are
+processed as in 'blr tagbam'. This replaces running 'samtools view -L <chunk.bed>' and 'blr tagbam' for each chunk.
+"""
+import logging
+from pathlib import Path
+import sys
+
+from blr.cli.tagbam import get_mode, mode_void
+from blr.utils import Summary, PySAMIO, tqdm
+
+logger = logging.getLogger(__name__)
+
+
+def main(args):
+    run_splitchunks(
+        input=args.input,
+        beds=args.beds,
+        unmapped=args.unmapped,
+        suffix=args.suffix,
+        sample_number=args.sample_nr,
+        barcode_tag=args.barcode_tag,
+        skip_tagging=args.skip_tagging,
+        threads=args.threads,
+        compression_level=args.compression_level,
+    )
+
+
+def run_splitchunks(
+        input: str,
+        beds,
+        unmapped: str,
+        suffix: str = ".sorted.tag.bam",
+        sample_number: int = 1,
+        barcode_tag: str = "BX",
+        skip_tagging: bool = False,
+        threads: int = 1,
+        compression_level: int = None,
+):
+    logger.info("Starting")
+    summary = Summary()
+
+    # Each file has its own htslib thread pool. Input is sorted by position so only one output at a time is busy
+    # compressing, threads are therefore split between decompression and compression and divided between chunk outputs.
+    io_threads = max(1, threads // 2)
+    chunk_threads = max(1, (threads - io_threads) // len(beds))
+    io = PySAMIO(input, unmapped, __name__, threads=io_threads, compression_level=compression_level)
+    with io as (infile, unmapped_file):
+        contig_lengths = dict(zip(infile.references, infile.lengths))
+
+        # Output file for each reference id. Unplaced reads have reference id -1 and use the last entry.
+        outfiles = [None] * (infile.nreferences + 1)
+        outfiles[-1] = unmapped_file
+        for bed in beds:
+            contigs = parse_bed_contigs(bed, contig_lengths)
+            output = output_name(bed, suffix)
+            logger.info(f"Writing {len(contigs)} contigs in {bed} to {output}")
+            outfile = io.open_output(output, threads=chunk_threads)
+            for contig in contigs:
+                tid = infile.get_tid(contig)
+                if outfiles[tid] is not None:
+                    sys.exit(f"Contig {contig} in {bed} is already part of another chunk.")
+                outfiles[tid] = outfile
+
+        parser = infile.fetch(until_eof=True)
+        if skip_tagging:
+            processing_function = mode_void
+        else:
+            processing_function, parser = get_mode(parser, barcode_tag=barcode_tag)
+
+        summary["Total reads"] = 0
+        total_reads = 0
+        skipped_reads = 0
+        for read in tqdm(parser, desc="Processing reads", unit=" reads"):
+            total_reads += 1
+            outfile = outfiles[read.reference_id]
+            if outfile is None:
+                skipped_reads += 1
+                continue
+
+            processing_function(read, sample_number, barcode_tag, summary)
+            outfile.write(read)
+
+        summary["Total reads"] = total_reads
+        summary["Reads not in any chunk"] = skipped_reads
+
+    summary.print_stats(name=__name__)
+    logger.info("Finished")
+
+
+def parse_bed_contigs(bed: str, contig_lengths):
+    """Return list of contigs in BED file. Each interval must span a whole contig in contig_lengths."""
+    contigs = []
+    with open(bed) as file:
+        for line in file:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            contig, start, end = line.split("\t")[:3]
+            if contig not in contig_lengths:
+                sys.exit(f"Contig {contig} in {bed} is not in the BAM header.")
+            if int(start) != 0 or int(end) < contig_lengths[contig]:
+                sys.exit(f"Interval {contig}:{start}-{end.strip()} in {bed} does not span the whole contig. Only "
+                         f"chunks of whole contigs are supported.")
+            contigs.append(contig)
+    return contigs
+
+
+def output_name(bed: str, suffix: str) -> str:
+    """Return output BAM for chunk by replacing the '.bed' extension with suffix"""
+    bed = Path(bed)
+    if bed.suffix == ".bed":
+        bed = bed.with_suffix("")
+    return str(bed) + suffix
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "input",
+        help="Coordinate-sorted BAM file with SAM tag info in header. To read from stdin use '-'."
+    )
+    parser.add_argument(
+        "beds", nargs="+",
+        help="BED files defining chunks of whole contigs. Output BAM for each chunk is named after the BED file with "
+             "'.bed' replaced by the output suffix."
+    )
+    parser.add_argument(
+        "-u", "--unmapped", required=True,
+        help="Output BAM for unplaced unmapped reads."
+    )
+    parser.add_argument(
+        "--suffix", default=".sorted.tag.bam",
+        help="Suffix for chunk output BAM files. Default: %(default)s."
+    )
+    parser.add_argument(
+        "-s", "--sample-nr", default=1, type=int,
+        help="Add sample number to each barcode. Default: %(default)s."
+    )
+    parser.add_argument(
+        "-b", "--barcode-tag", default="BX",
+        help="SAM tag for storing the error corrected barcode. Default: %(default)s."
+    )
+    parser.add_argument(
+        "--skip-tagging", action="store_true", default=False,
+        help="Only split reads into chunks without processing read names as in 'blr tagbam'."
+    )
+    parser.add_argument(
+        "-t", "--threads", type=int, default=1,
+        help="Number of threads used for BAM decompression and compression. Half of the threads are used for the "
+             "input and unmapped output and the rest are divided between chunk outputs. Default: %(default)s."
+    )
+    parser.add_argument(
+        "-l", "--compression-level", type=int, choices=range(10),
+        help="Compression level for output BAMs from 0 (uncompressed) to 9. Default: htslib default."
+    )
@@ -2,6 +2,7 @@
 Strips headers from tags and depending on mode, set the appropriate SAM tag.
 """
 
+from functools import lru_cache
 import logging
 from itertools import chain
 import re
@@ -10,7 +11,7 @@ from blr.utils import Summary, PySAMIO, get_bamtag, tqdm
 
 logger = logging.getLogger(__name__)
 
-DNA_BASES = {"A", "T", "C", "G"}
+DNA_BASES = "ATCG"
 
 
 def main(args):
@@ -19,6 +20,8 @@ def main(args):
         output=args.output,
         sample_number=args.sample_nr,
         barcode_tag=args.barcode_tag,
+        threads=args.threads,
+        compression_level=args.compression_level,
     )
 
 
@@ -56,21 +59,27 @@ def run_tagbam(
         output: str,
         sample_number: int,
         barcode_tag: str,
+        threads: int = 1,
+        compression_level: int = None,
 ):
     logger.info("Starting analysis")
 
     summary = Summary()
 
     # Read SAM/BAM files and transfer barcode information from alignment name to SAM tag
-    with PySAMIO(input, output, __name__) as (infile, outfile):
+    with PySAMIO(input, output, __name__, threads=threads, compression_level=compression_level) as (infile, outfile):
         parser = infile.fetch(until_eof=True)
         processing_function, parser = get_mode(parser, barcode_tag=barcode_tag)
 
+        summary["Total reads"] = 0
+        total_reads = 0
+        write = outfile.write
         for read in tqdm(parser, desc="Processing reads", unit=" reads"):
             # Strips header from tag and depending on script mode, possibly sets SAM tag
-            summary["Total reads"] += 1
+            total_reads += 1
             processing_function(read, sample_number, barcode_tag, summary)
-            outfile.write(read)
+            write(read)
+        summary["Total reads"] = total_reads
 
     summary.print_stats(name=__name__)
     logger.info("Finished")
@@ -84,22 +93,29 @@ def mode_samtags_underline_separation(read, sample_nr, barcode_tag, summary):
         header:name:with:stuff_<tag1>:<type1>:<seq1>_<tag2>:<type2>:<seq2>....
     """
     # Strip header
-    header = read.query_name.split("_")
-    read.query_name = header[0]
+    name, _, tags = read.query_name.partition("_")
+    if not tags:
+        return
+    read.query_name = name
 
     # Set SAM tags
-    for tag in header[1:]:
-        tag, tag_type, val = tag.split(":")
+    for tag in tags.split("_"):
+        tag, tag_type, val = tag.split(":", 2)
 
         # Input from 10x has "-1" attached to the barcode which needs to be removed.
-        val = val.split("-")[0]
+        val = val.partition("-")[0]
         assert is_sequence(val)
 
         if tag == barcode_tag:
             val = f"{val}-{sample_nr}"
 
         read.set_tag(tag, val, value_type=tag_type)
-        summary[f"Reads with tag {tag}"] += 1
+        summary[_tag_summary_key(tag)] += 1
+
+
+@lru_cache(maxsize=None)
+def _tag_summary_key(tag):
+    return f"Reads with tag {tag}"
 
 
 def mode_ema(read, sample_nr, barcode_tag, _):  # summary is passed to this function but is not used
@@ -131,7 +147,8 @@ def mode_void(*args, **kwargs):
 
 def is_sequence(string: str) -> bool:
     """Check if string is DNA sequence"""
-    return set(string).issubset(DNA_BASES)
+    # Stripping bases leaves an empty string only if all characters are bases.
+    return not string.strip(DNA_BASES)
 
 
 def add_arguments(parser):
@@ -151,3 +168,11 @@ def add_arguments(parser):
         "-b", "--barcode-tag", default="BX",
         help="SAM tag for storing the error corrected barcode. Default: %(default)s."
     )
+    parser.add_argument(
+        "-t", "--threads", type=int, default=1,
+        help="Number of threads used for BAM compression and decompression. Default: %(default)s."
+    )
+    parser.add_argument(
+        "-l", "--compression-level", type=int, choices=range(10),
+        help="Compression level for output BAM from 0 (uncompressed) to 9. Default: htslib default."
+    )
@@ -19,39 +19,45 @@ the read by including it in the header.
 
     <HEADER> ==> <RAW_BARCODE> ==> <CORRECTED_BARCODE>
 """
+from array import array
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack
-from heapq import merge
-from itertools import islice, cycle
+from functools import lru_cache
+from hashlib import blake2b
+import io
+from itertools import chain, islice, cycle
 import logging
+from multiprocessing import get_context
 from pathlib import Path
+import re
+import shutil
+import struct
 import sys
 import tempfile
+import zlib
 
 import dnaio
-import pandas as pd
+import numpy as np
+import pysam
 from xopen import xopen
 
-from blr.utils import tqdm, Summary, ACCEPTED_READ_MAPPERS
+from blr.utils import tqdm, Summary, ACCEPTED_READ_MAPPERS, IUPAC, encode_sequence, decode_sequence, parse_clstr
 
 logger = logging.getLogger(__name__)
 
-IUPAC = {
-    "A": "A",
-    "C": "C",
-    "G": "G",
-    "T": "T",
-    "R": "AG",
-    "Y": "CT",
-    "M": "AC",
-    "K": "GT",
-    "S": "CG",
-    "W": "AT",
-    "H": "ACT",
-    "B": "CGT",
-    "V": "ACG",
-    "D": "AGT",
-    "N": "ACGT"
-}
+# Value used in place of mapper when tagging reads for unaligned BAM output.
+UBAM = "ubam"
+# Number of buckets to group heaps into when sorting output for ema and lariat.
+NR_HEAP_BUCKETS = 256
+# Header of compressed blocks in bucket files with compressed size, number of records and fields per record.
+BLOCK_HEADER = struct.Struct("<III")
+# Number of records per block written when splitting bucket files.
+BLOCK_SIZE = 10_000
+SPILL_COMPRESSION_LEVEL = 1
+# Block size and compression level used when compressing gzip output in parallel.
+BLOCK_BYTES = 1024 ** 2
+COMPRESSION_LEVEL = 1
 
 
 def main(args):
@@ -72,6 +78,12 @@ def main(args):
         min_count=args.min_count,
         pattern_match=args.pattern_match,
         sample_number=args.sample_nr,
+        workers=args.workers,
+        tmpdir=args.tmpdir,
+        sort_memory=args.sort_memory,
+        index_barcodes=args.index_barcodes,
+        compression_threads=args.compression_threads,
+        output_ubam=args.output_ubam,
     )
 
 
@@ -92,6 +104,12 @@ def run_tagfastq(
         min_count: int,
         pattern_match: str,
         sample_number: int,
+        workers: int = 1,
+        tmpdir: str = None,
+        sort_memory: float = 1,
+        index_barcodes: bool = False,
+        compression_threads: int = 0,
+        output_ubam: str = None,
 ):
     logger.info("Starting")
     summary = Summary()
@@ -99,13 +117,18 @@ def run_tagfastq(
     # canonical sequence.
     logger.info("Map clusters")
     template = [set(IUPAC[base]) for base in pattern_match] if pattern_match else []
-    seq_to_barcode, heap = map_corrected_barcodes(corrected_barcodes, summary, mapper, template, min_count)
+    seq_to_barcode = map_corrected_barcodes(corrected_barcodes, summary, mapper, template, min_count)
 
     in_interleaved = not input2
     logger.info(f"Input detected as {'interleaved' if in_interleaved else 'paired'} FASTQ.")
 
     out_interleaved = not output2 or not output1
-    if output_bins is not None:
+    if output_ubam is not None:
+        if mapper in ["ema", "lariat"]:
+            sys.exit(f"Output as unaligned BAM is not available for mapper '{mapper}'.")
+        logger.info(f"Writing output as unaligned BAM to {output_ubam}.")
+        output1, output2 = None, None
+    elif output_bins is not None:
         logger.info(f"Writing output as binned interleaved FASTQ to {output_bins}.")
         output_bins = Path(output_bins)
         output_bins.mkdir(exist_ok=True)
@@ -121,64 +144,84 @@ def run_tagfastq(
         logger.warning(f"Writing non barcoded reads to {output_nobc1} is only available with option '--mapper ema'.")
         output_nobc1, output_nobc2 = None, None
 
+    if workers > 1 and (mapper in ["ema", "lariat"] or output_bins is not None or output_ubam is not None):
+        logger.warning(f"Using multiple workers is not available for mapper '{mapper}', binned or uBAM output. "
+                       f"Running with a single worker.")
+        workers = 1
+
     # Parse input FASTA/FASTQ for read1 and read2, uncorrected barcodes and write output
     with ExitStack() as stack:
         reader = stack.enter_context(dnaio.open(input1, file2=input2, interleaved=in_interleaved, mode="r"))
         writer = stack.enter_context(Output(file1=output1, file2=output2, interleaved=out_interleaved,
                                             file_nobc1=output_nobc1, file_nobc2=output_nobc2, mapper=mapper,
-                                            bins_dir=output_bins))
-        uncorrected_barcode_reader = stack.enter_context(BarcodeReader(uncorrected_barcodes))
-        chunks = None
-        if mapper in ["ema", "lariat"]:
-            chunks = stack.enter_context(ChunkHandler(chunk_size=1_000_000))
-
-        for read1, read2, corrected_barcode_seq in parse_reads(reader, seq_to_barcode, uncorrected_barcode_reader,
-                                                               barcode_tag, sequence_tag, mapper):
-            summary["Read pairs read"] += 1
-            if corrected_barcode_seq is None:
-                summary["Reads missing barcode"] += 1
+                                            bins_dir=output_bins, raw=workers > 1,
+                                            compression_threads=compression_threads, ubam=output_ubam,
+                                            barcode_tag=barcode_tag, sample_number=sample_number))
+        if index_barcodes:
+            uncorrected_barcode_reader = stack.enter_context(IndexedBarcodeReader(uncorrected_barcodes, tmpdir=tmpdir))
+        else:
+            uncorrected_barcode_reader = stack.enter_context(BarcodeReader(uncorrected_barcodes))
 
-                # Write non barcoded reads to separate file if exists for ema.
-                if mapper == "ema" and output_nobc1 is not None:
+        if workers > 1:
+            logger.info(f"Tagging reads using {workers} workers.")
+            tag_reads_parallel(reader, writer, seq_to_barcode, uncorrected_barcode_reader, barcode_tag, sequence_tag,
+                               mapper, summary, workers=workers, interleaved=out_interleaved)
+        else:
+            buckets = None
+            if mapper in ["ema", "lariat"]:
+                heaps_per_bucket = -(-seq_to_barcode.nr_canonical // NR_HEAP_BUCKETS)
+                buckets = stack.enter_context(BucketHandler(heaps_per_bucket, memory=int(sort_memory * 1024 ** 3),
+                                                            tmpdir=tmpdir))
+
+            naming = UBAM if output_ubam is not None else mapper
+            for read1, read2, corrected_barcode_seq, heap in parse_reads(reader, seq_to_barcode,
+                                                                         uncorrected_barcode_reader, barcode_tag,
+                                                                         sequence_tag, naming):
+                summary["Read pairs read"] += 1
+                if corrected_barcode_seq is None:
+                    summary["Reads missing barcode"] += 1
+
+                    # Write non barcoded reads to separate file if exists for ema.
+                    if mapper == "ema" and output_nobc1 is not None:
+                        summary["Read pairs written"] += 1
+                        writer.write_nobc(read1, read2)
+                        continue
+
+                    # EMA and lairat aligner cannot handle reads without barcodes so these are skipped.
+                    if mapper in ["ema", "lariat"]:
+                        continue
+
+                # Write to out
+                if mapper == "ema":
+                    buckets.add(
+                        heap,
+                        (
+                            read1.name,
+                            read1.sequence,
+                            read1.qualities,
+                            read2.sequence,
+                            read2.qualities,
+                        )
+                    )
+                elif mapper == "lariat":
+                    corrected_barcode_qual = "K" * len(corrected_barcode_seq)
+                    buckets.add(
+                        heap,
+                        (
+                            f"@{read1.name}",
+                            read1.sequence,
+                            read1.qualities,
+                            read2.sequence,
+                            read2.qualities,
+                            f"{corrected_barcode_seq}-{sample_number}",
+                            corrected_barcode_qual,
+                            "AAAAAA",
+                            "KKKKKK",
+                        )
+                    )
+                else:
                     summary["Read pairs written"] += 1
-                    writer.write_nobc(read1, read2)
-                    continue
-
-                # EMA and lairat aligner cannot handle reads without barcodes so these are skipped.
-                if mapper in ["ema", "lariat"]:
-                    continue
-
-            # Write to out
-            if mapper == "ema":
-                chunks.build_chunk(
-                    f"{str(heap[corrected_barcode_seq])}\t"
-                    f"{read1.name}\t"
-                    f"{read1.sequence}\t"
-                    f"{read1.qualities}\t"
-                    f"{read2.sequence}\t"
-                    f"{read2.qualities}\n"
-                )
-            elif mapper == "lariat":
-                corrected_barcode_qual = "K" * len(corrected_barcode_seq)
-                chunks.build_chunk(
-                    f"{str(heap[corrected_barcode_seq])}\t"
-                    f"@{read1.name}\t"
-                    f"{read1.sequence}\t"
-                    f"{read1.qualities}\t"
-                    f"{read2.sequence}\t"
-                    f"{read2.qualities}\t"
-                    f"{corrected_barcode_seq}-{sample_number}\t"
-                    f"{corrected_barcode_qual}\t"
-                    "AAAAAA\t"
-                    "KKKKKK\n"
-                )
-            else:
-                summary["Read pairs written"] += 1
-                writer.write(read1, read2)
-
-        # Empty final cache
-        if chunks is not None:
-            chunks.write_chunk()
+                    writer.write(read1, read2)
 
         if output_bins is not None:
             bin_size = (summary["Read pairs read"] - summary["Reads missing barcode"]) // nr_bins
@@ -186,133 +229,315 @@ def run_tagfastq(
             writer.set_bin_size(bin_size)
 
         if mapper == "ema":
-            write_ema_output(chunks, writer, summary)
+            write_ema_output(buckets, writer, summary)
         elif mapper == "lariat":
-            write_lariat_output(chunks, writer, summary)
+            write_lariat_output(buckets, writer, summary)
 
     summary.print_stats(__name__)
 
     logger.info("Finished")
 
 
-def write_ema_output(chunks, writer, summary):
-    for entry in chunks.parse_chunks():
-        r1 = dnaio.Sequence(*entry[1:4])
-        r2 = dnaio.Sequence(entry[1], *entry[4:6])
-        writer.write(r1, r2, heap=entry[0])
+def write_ema_output(buckets, writer, summary):
+    for heap, entry in buckets.parse_buckets():
+        r1 = dnaio.Sequence(*entry[0:3])
+        r2 = dnaio.Sequence(entry[0], *entry[3:5])
+        writer.write(r1, r2, heap=heap)
         summary["Read pairs written"] += 1
 
 
-def write_lariat_output(chunks, writer, summary):
-    for entry in chunks.parse_chunks():
-        lines = "\n".join(entry[1:]) + "\n"
-        writer.write(lines, heap=entry[0])
+def write_lariat_output(buckets, writer, summary):
+    for heap, entry in buckets.parse_buckets():
+        lines = "\n".join(entry) + "\n"
+        writer.write(lines, heap=heap)
         summary["Read pairs written"] += 1
 
 
-def parse_reads(reader, corrected_barcodes, uncorrected_barcode_reader, barcode_tag, sequence_tag, mapper):
-    for read1, read2 in tqdm(reader, desc="Read pairs processed"):
-        # Header parsing
-        # TODO Handle reads with single header
-        name_and_pos, nr_and_index1 = read1.name.split(maxsplit=1)
+def parse_reads(reader, corrected_barcodes, uncorrected_barcode_reader, barcode_tag, sequence_tag, mapper,
+                batch_size=1000):
+    reader = tqdm(reader, desc="Read pairs processed")
+    for batch in iter_batches(reader, uncorrected_barcode_reader, batch_size):
+        yield from tag_batch(batch, corrected_barcodes, barcode_tag, sequence_tag, mapper)
 
-        uncorrected_barcode_seq = uncorrected_barcode_reader.get_barcode(name_and_pos)
-        corrected_barcode_seq = corrected_barcodes.get(uncorrected_barcode_seq, None)
 
-        # Check if barcode was found and update header with barcode info.
+def tag_batch(batch, corrected_barcodes, barcode_tag, sequence_tag, mapper):
+    """
+    Lookup the corrected barcodes for a batch of (read1, read2, uncorrected_barcode_seq) entries and update the read
+    names with barcode information depending on mapper. Yields read1, read2, the corrected barcode (None if not found)
+    and the index of the corrected barcode (-1 if not found).
+    """
+    indices = corrected_barcodes.lookup([uncorrected_barcode_seq for _, _, uncorrected_barcode_seq in batch])
+    canonical_seqs = corrected_barcodes.canonical_sequences(indices)
+    for (read1, read2, uncorrected_barcode_seq), corrected_barcode_seq, index in zip(batch, canonical_seqs, indices):
         if corrected_barcode_seq is not None:
-            corr_barcode_id = f"{barcode_tag}:Z:{corrected_barcode_seq}"
-
-            # Create new name with barcode information.
-            if mapper == "ema":
-                # The EMA aligner requires reads in 10x format e.g.
-                # @READNAME:AAAAAAAATATCTACGCTCA BX:Z:AAAAAAAATATCTACGCTCA
-                read1.name = f"{name_and_pos}:{corrected_barcode_seq} {corr_barcode_id}"
-                read2.name = read1.name
-            elif mapper != "lariat":
-                _, nr_and_index2 = read2.name.split(maxsplit=1)
-                raw_barcode_id = f"{sequence_tag}:Z:{uncorrected_barcode_seq}"
-                read1.name = f"{name_and_pos}_{raw_barcode_id}_{corr_barcode_id} {nr_and_index1}"
-                read2.name = f"{name_and_pos}_{raw_barcode_id}_{corr_barcode_id} {nr_and_index2}"
-
-        yield read1, read2, corrected_barcode_seq
+            tag_read_pair(read1, read2, uncorrected_barcode_seq, corrected_barcode_seq, barcode_tag, sequence_tag,
+                          mapper)
+        yield read1, read2, corrected_barcode_seq, index
+
+
+def tag_read_pair(read1, read2, uncorrected_barcode_seq, corrected_barcode_seq, barcode_tag, sequence_tag, mapper):
+    """Update the read names with barcode information depending on mapper."""
+    # TODO Handle reads with single header
+    name_and_pos, nr_and_index1 = read1.name.split(maxsplit=1)
+    corr_barcode_id = f"{barcode_tag}:Z:{corrected_barcode_seq}"
+
+    # Create new name with barcode information.
+    if mapper == UBAM:
+        # Barcodes are added as SAM tags in the read comment which are converted to proper tags in the uBAM output.
+        _, nr_and_index2 = read2.name.split(maxsplit=1)
+        tags = f"{sequence_tag}:Z:{uncorrected_barcode_seq}\t{corr_barcode_id}"
+        read1.name = f"{name_and_pos} {tags}"
+        read2.name = f"{name_and_pos} {tags}"
+    elif mapper == "ema":
+        # The EMA aligner requires reads in 10x format e.g.
+        # @READNAME:AAAAAAAATATCTACGCTCA BX:Z:AAAAAAAATATCTACGCTCA
+        read1.name = f"{name_and_pos}:{corrected_barcode_seq} {corr_barcode_id}"
+        read2.name = read1.name
+    elif mapper != "lariat":
+        _, nr_and_index2 = read2.name.split(maxsplit=1)
+        raw_barcode_id = f"{sequence_tag}:Z:{uncorrected_barcode_seq}"
+        read1.name = f"{name_and_pos}_{raw_barcode_id}_{corr_barcode_id} {nr_and_index1}"
+        read2.name = f"{name_and_pos}_{raw_barcode_id}_{corr_barcode_id} {nr_and_index2}"
+
+
+# Read-only state shared with worker processes. This is set before the worker pool is created so that workers
+# inherit it on fork rather than having it pickled and sent with each batch.
+_worker_state = {}
+
+
+def tag_reads_parallel(reader, writer, corrected_barcodes, uncorrected_barcode_reader, barcode_tag, sequence_tag,
+                       mapper, summary, workers, interleaved, batch_size=10_000):
+    """
+    Tag read pairs in batches using multiple worker processes. Batches are written to the output in input order so
+    that the result is identical to tagging the reads serially.
+    """
+    _worker_state.update(corrected_barcodes=corrected_barcodes, barcode_tag=barcode_tag, sequence_tag=sequence_tag,
+                         mapper=mapper, interleaved=interleaved)
+    try:
+        batches = iter_batches(reader, uncorrected_barcode_reader, batch_size)
+        with get_context("fork").Pool(workers) as pool:
+            for data1, data2, nr_pairs, nr_missing in tqdm(pool.imap(_tag_batch, batches), desc="Batches processed"):
+                writer.write_raw(data1, data2)
+                summary["Read pairs read"] += nr_pairs
+                if nr_missing:
+                    summary["Reads missing barcode"] += nr_missing
+                summary["Read pairs written"] += nr_pairs
+    finally:
+        _worker_state.clear()
+
+
+def iter_batches(reader, uncorrected_barcode_reader, batch_size):
+    """Group read pairs into lists of (read1, read2, uncorrected_barcode_seq) entries of size batch_size"""
+    batch = []
+    for read1, read2 in reader:
+        name_and_pos = read1.name.split(maxsplit=1)[0]
+        batch.append((read1, read2, uncorrected_barcode_reader.get_barcode(name_and_pos)))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def _tag_batch(batch):
+    """Tag a batch of read pairs in worker process and return the output as FASTQ formatted bytes"""
+    corrected_barcodes = _worker_state["corrected_barcodes"]
+    barcode_tag = _worker_state["barcode_tag"]
+    sequence_tag = _worker_state["sequence_tag"]
+    mapper = _worker_state["mapper"]
+    interleaved = _worker_state["interleaved"]
+
+    out1 = []
+    out2 = out1 if interleaved else []
+    nr_missing = 0
+    for read1, read2, corrected_barcode_seq, _ in tag_batch(batch, corrected_barcodes, barcode_tag, sequence_tag,
+                                                            mapper):
+        if corrected_barcode_seq is None:
+            nr_missing += 1
+
+        out1.append(read1.fastq_bytes())
+        out2.append(read2.fastq_bytes())
+
+    return b"".join(out1), b"" if interleaved else b"".join(out2), len(batch), nr_missing
 
 
 def map_corrected_barcodes(file, summary, mapper, template, min_count=0):
     """
-    Parse starcode cluster output and return a dictionary with raw sequences pointing to a
-    corrected canonical sequence
+    Parse starcode cluster output and return a BarcodeMap with raw sequences pointing to a
+    corrected canonical sequence. For mappers ema and lariat the canonical sequences are ordered
+    so that their index can be used as heap index.
     :param open_file: starcode tabular output file.
     :param summary: collections.Counter object
     :param min_count: int. Skip clusters with fewer than min_count reads.
-    :return: dict: raw sequences pointing to a corrected canonical sequence.
+    :return: BarcodeMap: raw sequences pointing to a corrected canonical sequence.
     """
-    df = pd.read_csv(file, sep="\t", dtype={"canonical_seq": str, "size": int, "cluster_seqs": str},
-                     names=["canonical_seq", "size", "cluster_seqs"])
-
-    summary["Corrected barcodes"] = len(df)
-    summary["Reads with corrected barcodes"] = sum(df["size"])
-
-    if template:
-        df = df[(df["size"] >= min_count) & (df["canonical_seq"].apply(match_template, template=template))]
-    else:
-        df = df[df["size"] >= min_count]
-
-    summary["Barcodes not passing filters"] = summary["Corrected barcodes"] - len(df)
-    summary["Reads with barcodes not passing filters"] = summary["Reads with corrected barcodes"] - sum(df["size"])
-
-    corrected_barcodes = {
-        s: canonical for canonical, seqs in zip(df["canonical_seq"], df["cluster_seqs"]) for s in seqs.split(",")
-    }
-    canonical_seqs = df["canonical_seq"].tolist()
+    corrected_barcodes = BarcodeMap.from_clusters(
+        (cluster.canonical, cluster.sequences)
+        for cluster in parse_clstr(file, min_count=min_count, template=template, summary=summary)
+    )
 
-    heap_index = {}
     if mapper in ["ema", "lariat"]:
+        # The index of each canonical sequence in corrected_barcodes is used as heap index for sorting.
         logger.info("Creating heap index for sorting barcodes for ema mapping.")
-        canonical_seqs = df["canonical_seq"].tolist()
         # Scramble seqs to ensure no seqs sharing 16-bp prefix are neighbours for ema.
         if mapper == "ema":
-            scramble(canonical_seqs, maxiter=100)
-
-        heap_index = {seq: nr for nr, seq in enumerate(canonical_seqs)}
-
-    return corrected_barcodes, heap_index
-
-
-def scramble(seqs, maxiter=10):
-    """Scramble sequences by moving pairs with similar prefix appart. Loosely based on bubble sort"""
-    swapped = True
-    iteration = 1
-    start_from = 0
-    while swapped and iteration < maxiter:
-        iteration += 1
-        swapped = False
-        swap_pos = []
-        for i in range(start_from, len(seqs) - 2):
-            # Compare 16 first bases of both seqs
-            if seqs[i][:16] == seqs[i + 1][:16]:
-                swap_pos.append(i)
-                # Swap the next-comming elements
-                seqs[i + 2], seqs[i + 1] = seqs[i + 1], seqs[i + 2]
-                # Set the flag to True so we'll loop again
-                swapped = True
-
-        start_from = min(swap_pos) if swap_pos else 0
-
-    if not swapped:
-        logger.info("Scrambling done!")
+            canonical_seqs = corrected_barcodes.canonical_sequences()
+            scramble(canonical_seqs)
+            corrected_barcodes.reorder(canonical_seqs)
+
+    return corrected_barcodes
+
+
+def scramble(seqs, prefix_length=16) -> int:
+    """
+    Scramble sequences in place so that no neighbouring sequences share the same prefix, as required for ema.
+
+    Sequences are grouped by prefix and the groups, ordered from largest to smallest, are laid out over every second
+    position starting with the even positions followed by the odd positions. This separates all sequences sharing
+    prefix in O(n) time if possible, i.e. if no prefix is shared by more than half the sequences. Otherwise the largest
+    group is interleaved with all other sequences. Returns the number of neighbouring sequences that still share
+    prefix.
+    """
+    groups = {}
+    for seq in seqs:
+        groups.setdefault(seq[:prefix_length], []).append(seq)
+
+    # Counting sort of groups by size, largest first. Groups of equal size are kept in order of first occurrence.
+    groups_by_size = [[] for _ in range(max(map(len, groups.values()), default=0) + 1)]
+    for group in groups.values():
+        groups_by_size[len(group)].append(group)
+
+    ordered_groups = [group for same_size_groups in reversed(groups_by_size) for group in same_size_groups]
+    if ordered_groups and 2 * len(ordered_groups[0]) > len(seqs) + 1:
+        # The largest group cannot be separated, instead separate as many as possible using all other sequences.
+        largest, others = ordered_groups[0], list(chain.from_iterable(ordered_groups[1:]))
+        seqs[:2 * len(others)] = chain.from_iterable(zip(largest, others))
+        seqs[2 * len(others):] = largest[len(others):]
+    else:
+        positions = chain(range(0, len(seqs), 2), range(1, len(seqs), 2))
+        for seq, position in zip(chain.from_iterable(ordered_groups), positions):
+            seqs[position] = seq
+
+    collisions = sum(s1[:prefix_length] == s2[:prefix_length] for s1, s2 in zip(seqs[:-1], seqs[1:]))
+    if collisions:
+        logger.warning(f"Scrambling could not separate {collisions} neighbouring sequences sharing "
+                       f"{prefix_length}-bp prefix")
     else:
-        logger.warning("Scrambling reached maxiter")
+        logger.info("Scrambling done!")
+    return collisions
 
 
-def match_template(sequence: str, template) -> bool:
-    if len(sequence) != len(template):
-        return False
+class BarcodeMap:
+    """
+    Compact mapping of raw barcode sequences to corrected canonical sequences.
 
-    for base, accepted_bases in zip(sequence, template):
-        if base not in accepted_bases:
-            return False
-    return True
+    Raw barcodes are stored 2-bit encoded (see blr.utils.encode_sequence) in a sorted uint64 array together with an
+    array of indices into the array of canonical sequences. Lookups are binary searches using numpy.searchsorted
+    which requires about 12 bytes per raw barcode compared to the >100 bytes used by a dict with string keys and
+    values. Raw barcodes that cannot be encoded, e.g. containing N, are kept in a separate dict.
+    """
+    def __init__(self, codes, indices, canonical_seqs, other=None):
+        """
+        :param codes: array of encoded raw barcodes.
+        :param indices: array of same length as codes with index of the canonical sequence for each raw barcode.
+        :param canonical_seqs: list of canonical sequences.
+        :param other: dict of raw barcodes that cannot be encoded pointing to the index of the canonical sequence.
+        """
+        codes = np.asarray(codes, dtype=np.uint64)
+        indices = np.asarray(indices, dtype=np.int64)
+
+        # Sort by code. If a raw barcode is present multiple times the last entry is kept.
+        order = np.argsort(codes, kind="stable")
+        codes = codes[order]
+        keep = np.append(codes[1:] != codes[:-1], True) if codes.size > 0 else np.ones(0, dtype=bool)
+        self._codes = codes[keep]
+        self._indices = indices[order][keep].astype(np.uint32)
+        self._canonical = np.array(canonical_seqs, dtype=bytes)
+        self._other = other if other is not None else {}
+
+    @classmethod
+    def from_clusters(cls, clusters):
+        """Build map from iterable of (canonical_seq, raw_seqs) tuples"""
+        codes = array("Q")
+        indices = array("I")
+        canonical_seqs = []
+        other = {}
+        for index, (canonical_seq, raw_seqs) in enumerate(clusters):
+            canonical_seqs.append(canonical_seq)
+            for seq in raw_seqs:
+                code = encode_sequence(seq)
+                if code is None:
+                    other[seq] = index
+                else:
+                    codes.append(code)
+                    indices.append(index)
+
+        return cls(np.frombuffer(codes, dtype=np.uint64), np.frombuffer(indices, dtype=np.uint32), canonical_seqs,
+                   other)
+
+    def __len__(self):
+        return len(self._codes) + len(self._other)
+
+    def __contains__(self, seq):
+        return self.lookup([seq])[0] >= 0
+
+    def __getitem__(self, seq):
+        value = self.get(seq)
+        if value is None:
+            raise KeyError(seq)
+        return value
+
+    def get(self, seq, default=None):
+        value = self.canonical_sequences(self.lookup([seq]))[0]
+        return default if value is None else value
+
+    def values(self):
+        """Iterate over the canonical sequence for each raw barcode"""
+        yield from self.canonical_sequences(self._indices)
+        yield from self.canonical_sequences(list(self._other.values()))
+
+    @property
+    def nr_canonical(self):
+        return len(self._canonical)
+
+    def lookup(self, seqs):
+        """Return list with index of the canonical sequence for each raw sequence in seqs, -1 if not found."""
+        indices = [-1] * len(seqs)
+        if len(self._codes) > 0:
+            # Sequences that cannot be encoded get code 0 which does not match any encoded sequence.
+            codes = np.fromiter((encode_sequence(seq) or 0 if seq else 0 for seq in seqs), dtype=np.uint64,
+                                count=len(seqs))
+            positions = np.searchsorted(self._codes, codes)
+            np.minimum(positions, len(self._codes) - 1, out=positions)
+            found = self._codes[positions] == codes
+            indices = np.where(found, self._indices[positions], -1).tolist()
+
+        if self._other:
+            for i, seq in enumerate(seqs):
+                if seq in self._other:
+                    indices[i] = self._other[seq]
+        return indices
+
+    def canonical_sequences(self, indices=None):
+        """Return list of canonical sequences for the given indices, None for negative indices. If indices is not
+        given, all canonical sequences are returned in index order."""
+        if indices is None:
+            return [seq.decode() for seq in self._canonical.tolist()]
+        return [self._canonical[i].decode() if i >= 0 else None for i in indices]
+
+    def reorder(self, canonical_seqs):
+        """Reorder the canonical sequences so that the index of each corresponds to its position in canonical_seqs."""
+        new_canonical = np.array(canonical_seqs, dtype=self._canonical.dtype)
+        sorter = np.argsort(self._canonical)
+        order = sorter[np.searchsorted(self._canonical, new_canonical, sorter=sorter)]
+
+        # Update indices from old position to new position
+        new_index = np.empty(len(order), dtype=np.uint32)
+        new_index[order] = np.arange(len(order), dtype=np.uint32)
+        self._indices = new_index[self._indices]
+        self._other = {seq: int(new_index[index]) for seq, index in self._other.items()}
+        self._canonical = new_canonical
 
 
 class BarcodeReader:
@@ -344,6 +569,104 @@ class BarcodeReader:
         self._file.close()
 
 
+class IndexedBarcodeReader:
+    """
+    Barcode reader for input where barcodes and reads are not in the same order, e.g. if reads have been dropped or
+    reordered beyond the look-ahead of BarcodeReader.
+
+    An index of 64-bit read name hashes and 2-bit encoded barcodes (see blr.utils.encode_sequence) is built in a
+    single pass over the barcode file. Entries are partitioned by the top bits of the hash into temporary files so
+    that only one partition at a time needs to be sorted in memory. The sorted index is memory-mapped from disk and
+    lookups are binary searches within the partition of the hash. Barcodes that cannot be encoded, e.g. containing
+    N, are kept in a separate dict.
+    """
+    NR_PARTITIONS = 256
+    _PARTITION_SHIFT = 56
+
+    def __init__(self, filename, tmpdir=None, buffer_size=1_000_000):
+        """
+        :param filename: FASTA/FASTQ file with barcodes named by read.
+        :param tmpdir: Directory in which to create the index. Default is the system default.
+        :param buffer_size: Number of index entries to buffer in memory while building the index.
+        """
+        self._tmpdir = Path(tempfile.mkdtemp(prefix="barcode_index", dir=tmpdir))
+        self._other = {}
+        self._offsets, self._hashes, self._codes = self._build_index(filename, buffer_size)
+
+    def _build_index(self, filename, buffer_size):
+        logger.info(f"Building barcode index for {filename}")
+        partition_paths = [self._tmpdir / f"partition_{i}.bin" for i in range(self.NR_PARTITIONS)]
+        buffers = [array("Q") for _ in range(self.NR_PARTITIONS)]
+        buffered = 0
+        with dnaio.open(filename, mode="r") as file:
+            for barcode in file:
+                name = barcode.name.partition(" ")[0]
+                code = encode_sequence(barcode.sequence)
+                if code is None:
+                    self._other[name] = barcode.sequence
+                    continue
+
+                name_hash = _hash_name(name)
+                buffers[name_hash >> self._PARTITION_SHIFT].extend((name_hash, code))
+                buffered += 1
+                if buffered == buffer_size:
+                    self._write_partitions(partition_paths, buffers)
+                    buffered = 0
+        self._write_partitions(partition_paths, buffers)
+
+        # Sort partitions one at a time and write them consecutively to the index.
+        sizes = [path.stat().st_size // 16 if path.exists() else 0 for path in partition_paths]
+        offsets = np.zeros(self.NR_PARTITIONS + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        nr_entries = int(offsets[-1])
+        hashes = np.memmap(self._tmpdir / "hashes.bin", dtype=np.uint64, mode="w+", shape=max(nr_entries, 1))
+        codes = np.memmap(self._tmpdir / "codes.bin", dtype=np.uint64, mode="w+", shape=max(nr_entries, 1))
+        for path, start, stop in zip(partition_paths, offsets[:-1], offsets[1:]):
+            if start == stop:
+                continue
+            entries = np.fromfile(path, dtype=np.uint64).reshape(-1, 2)
+            path.unlink()
+            order = np.argsort(entries[:, 0], kind="stable")
+            hashes[start:stop] = entries[order, 0]
+            codes[start:stop] = entries[order, 1]
+        hashes.flush()
+        codes.flush()
+        logger.info(f"Barcode index built for {nr_entries:,} barcodes")
+        return offsets.tolist(), hashes, codes
+
+    @staticmethod
+    def _write_partitions(paths, buffers):
+        for path, buffer in zip(paths, buffers):
+            if buffer:
+                with open(path, "ab") as file:
+                    buffer.tofile(file)
+                del buffer[:]
+
+    def get_barcode(self, read_name):
+        name_hash = _hash_name(read_name)
+        partition = name_hash >> self._PARTITION_SHIFT
+        start, stop = self._offsets[partition], self._offsets[partition + 1]
+        i = start + int(self._hashes[start:stop].searchsorted(np.uint64(name_hash)))
+        if i < stop and self._hashes[i] == name_hash:
+            return decode_sequence(self._codes[i])
+        return self._other.get(read_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        del self._hashes, self._codes
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+
+def _hash_name(name: str) -> int:
+    """Stable 64-bit hash of read name"""
+    return int.from_bytes(blake2b(name.encode(), digest_size=8).digest(), "little")
+
+
 class Output:
     """
     Output handler for different output formats required by different mappers.
@@ -351,8 +674,18 @@ class Output:
     BIN_FASTQ_TEMPLATE = "ema-bin-*"  # Same name as in `ema preproc`.
 
     def __init__(self, file1=None, file2=None, interleaved=False, file_nobc1=None, file_nobc2=None, mapper=None,
-                 bins_dir=None, nr_bins=None):
+                 bins_dir=None, nr_bins=None, raw=False, compression_threads=0, ubam=None, barcode_tag=None,
+                 sample_number=None):
         self._mapper = mapper
+        self._raw = raw
+
+        # Gzip compressed output is compressed in blocks by a shared pool of threads if requested. Bins are always
+        # written as plain text as ema does not read compressed bins.
+        self._compression_pool = None
+        self._compression_threads = compression_threads
+        self._opened_files = []
+        if compression_threads > 0:
+            self._compression_pool = ThreadPoolExecutor(max_workers=compression_threads)
 
         self._bin_nr = 0
         self._reads_written = 0
@@ -367,13 +700,15 @@ class Output:
         self._post_write = lambda *args: None
 
         self._open_file = None
-        if file1 is not None:
+        if ubam is not None:
+            self._open_file = UnalignedBamWriter(ubam, barcode_tag, sample_number, threads=max(1, compression_threads))
+        elif file1 is not None:
             self._open_file = self._setup_single_output(file1, file2, interleaved)
         elif bins_dir is not None:
             self._pre_write = self._open_new_bin_if_full
             self._post_write = self._check_bin_full
         else:
-            sys.exit("Either file1 or bins_dir need to be provided.")
+            sys.exit("Either file1, bins_dir or ubam need to be provided.")
 
         self._open_file_nobc = None
         if file_nobc1 is not None:
@@ -392,13 +727,36 @@ class Output:
         self._bin_size = value
 
     def _setup_single_output(self, file1, file2, interleaved):
-        if self._mapper == "lariat":
+        if self._raw:
+            return RawFastqWriter(self._open(file1), self._open(file2) if file2 is not None else None)
+        elif self._mapper == "lariat":
             if file2 is not None:
                 Path(file2).touch()
-            return xopen(file1, mode='w')
+            return self._open(file1, mode="w")
         else:
+            if self._compression_pool is not None:
+                file1 = self._open(file1)
+                file2 = self._open(file2) if file2 is not None else None
             return dnaio.open(file1, file2=file2, interleaved=interleaved, mode="w", fileformat="fastq")
 
+    def _open(self, file, mode="wb"):
+        """
+        Open output file. Gzip compressed files are compressed in the compression pool if used. Opened files are
+        closed on exit. Binary streams such as sys.stdout.buffer are reopened for text output without closing them.
+        """
+        if not isinstance(file, (str, Path)):
+            if "b" in mode:
+                return file
+            file.flush()
+            opened = open(file.fileno(), mode, closefd=False)
+        elif self._compression_pool is not None and str(file).endswith(".gz"):
+            writer = ParallelGzipWriter(file, self._compression_pool, self._compression_threads)
+            opened = writer if "b" in mode else io.TextIOWrapper(writer)
+        else:
+            opened = xopen(file, mode)
+        self._opened_files.append(opened)
+        return opened
+
     def _get_bin_name(self):
         bin_nr_str = str(self._bin_nr).zfill(3)
         file_name = self._bins_dir / Output.BIN_FASTQ_TEMPLATE.replace("*", bin_nr_str)
@@ -410,7 +768,7 @@ class Output:
             self._open_file.close()
 
         file_name = self._get_bin_name()
-        self._open_file = dnaio.open(file_name, interleaved=True, mode="w", fileformat="fastq")
+        self._open_file = dnaio.open(self._open(file_name), interleaved=True, mode="w", fileformat="fastq")
 
     def _open_new_bin_if_full(self, heap):
         # Start a new bin if the current is full while not splitting heaps over separate bins
@@ -427,7 +785,7 @@ class Output:
             self._open_bins = []
             for i in range(self._nr_bins):
                 file_name = self._get_bin_name()
-                self._open_bins.append(xopen(file_name, "w"))
+                self._open_bins.append(self._open(file_name, "w"))
 
             self._open_bins = cycle(self._open_bins)
 
@@ -457,6 +815,10 @@ class Output:
 
         self._post_write()
 
+    def write_raw(self, data1, data2=b""):
+        """Write FASTQ formatted bytes. Requires Output to be setup with raw=True."""
+        self._open_file.write(data1, data2)
+
     def write_ema_special(self, read1, read2, barcode):
         assert self._nr_bins is not None, "Please set nr_bins to use ema special format"
         self._open_file = self._barcode_bin_map.get(barcode)
@@ -492,60 +854,300 @@ class Output:
                 else:
                     file.close()
 
+        for file in self._opened_files:
+            file.close()
 
-class ChunkHandler:
-    def __init__(self, chunk_size: int = 100_000):
-        # Required for ema sorted output
-        # Inspired by: https://stackoverflow.com/questions/56948292/python-sort-a-large-list-that-doesnt-fit-in-memory
-        self._output_chunk = []
-        self._chunk_size = chunk_size
-        self._chunk_id = 0
-        self._tmpdir = Path(tempfile.mkdtemp(prefix="tagfastq_sort"))
-        self._chunk_file_template = "chunk_*.tsv"
-        self._chunk_files = []
-        self._chunk_sep = "\t"
-        self._tmp_writer = self.create_writer()
+        if self._compression_pool is not None:
+            self._compression_pool.shutdown()
 
-    def __enter__(self):
-        return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self._tmp_writer.close()
+class RawFastqWriter:
+    """Write FASTQ formatted bytes to single (interleaved) or paired output files."""
+    def __init__(self, file1, file2=None):
+        self._file1 = file1 if hasattr(file1, "write") else xopen(file1, mode="wb")
+        self._file2 = file2
+        if file2 is not None and not hasattr(file2, "write"):
+            self._file2 = xopen(file2, mode="wb")
 
-    def create_writer(self):
-        if hasattr(self, "_tmp_writer"):
-            self._tmp_writer.close()
-        tmpfile = self._tmpdir / self._chunk_file_template.replace("*", str(self._chunk_id))
-        self._chunk_files.append(tmpfile)
-        self._chunk_id += 1
-        return open(tmpfile, "w")
+    def write(self, data1, data2=b""):
+        self._file1.write(data1)
+        if self._file2 is not None:
+            self._file2.write(data2)
 
-    def build_chunk(self, line: str):
-        """Add entry to write to temporary file, first argument should be the heap index"""
-        self._output_chunk.append(line)
+    def close(self):
+        self._file1.close()
+        if self._file2 is not None:
+            self._file2.close()
 
-        if len(self._output_chunk) > self._chunk_size:
-            self.write_chunk()
-            self._tmp_writer = self.create_writer()
 
-    def write_chunk(self):
-        self._output_chunk.sort(key=self._get_heap)
-        self._tmp_writer.writelines(self._output_chunk)
-        self._output_chunk *= 0  # Clear list faster than list.clear(). See https://stackoverflow.com/a/44349418
+class UnalignedBamWriter:
+    """
+    Write read pairs to unaligned BAM. SAM tags in the read comments, e.g. 'BX:Z:ACGT', are set as proper tags and
+    the sample number is appended to the barcode tag value as done by `blr tagbam`.
+    """
+    TAG_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9]:[AifZHB]:")
+
+    def __init__(self, filename, barcode_tag, sample_number, threads=1):
+        self._barcode_tag = barcode_tag
+        self._sample_number = sample_number
+        header = {"HD": {"VN": "1.6", "SO": "unsorted"}}
+        self._file = pysam.AlignmentFile(filename, "wb", header=header, threads=threads)
+
+    def write(self, read1, read2):
+        self._file.write(self._to_segment(read1, flag=77))
+        self._file.write(self._to_segment(read2, flag=141))
+
+    def _to_segment(self, read, flag):
+        name, _, comment = read.name.partition(" ")
+        segment = pysam.AlignedSegment(self._file.header)
+        segment.query_name = name
+        segment.flag = flag
+        segment.query_sequence = read.sequence
+        segment.query_qualities = pysam.qualitystring_to_array(read.qualities)
+        for field in comment.split("\t"):
+            if self.TAG_PATTERN.match(field):
+                tag, value_type, value = field.split(":", maxsplit=2)
+                if tag == self._barcode_tag:
+                    value = f"{value}-{self._sample_number}"
+                segment.set_tag(tag, _SAM_TAG_TYPES.get(value_type, str)(value), value_type=value_type)
+        return segment
 
-    def parse_chunks(self):
-        if not self._tmp_writer.closed:
-            self._tmp_writer.close()
+    def close(self):
+        self._file.close()
 
-        with ExitStack() as chunkstack:
-            logger.info("Opening chunks for merge")
-            chunks = [chunkstack.enter_context(chunk.open(mode="r")) for chunk in self._chunk_files]
-            logger.info("Merging chunks")
-            for entry in merge(*chunks, key=self._get_heap):
-                yield entry.strip().split(self._chunk_sep)
 
-    def _get_heap(self, x):
-        return int(x.split(self._chunk_sep)[0])
+_SAM_TAG_TYPES = {"i": int, "f": float}
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """
+    Binary file writer for gzip compressed output where compression is done by a pool of threads.
+
+    Written data is buffered into blocks that are compressed as separate gzip members by the pool and written to file
+    in order. A file consisting of concatenated gzip members is a valid gzip file. Compression with zlib releases the
+    GIL so blocks for one or several files are compressed in parallel with the calling thread.
+    """
+    def __init__(self, filename, pool, threads, block_size=BLOCK_BYTES, compresslevel=COMPRESSION_LEVEL,
+                 max_pending=None):
+        """
+        :param filename: Output file name.
+        :param pool: concurrent.futures.Executor used to compress blocks. Can be shared between writers.
+        :param threads: Number of threads in pool.
+        :param block_size: Size in bytes of uncompressed blocks.
+        :param compresslevel: Gzip compression level.
+        :param max_pending: Max number of blocks queued for compression before waiting for the oldest block to
+        complete. Default is twice the number of threads in the pool.
+        """
+        super().__init__()
+        self._file = open(filename, "wb")
+        self._pool = pool
+        self._block_size = block_size
+        self._compresslevel = compresslevel
+        self._max_pending = max_pending or 2 * threads
+        self._buffer = bytearray()
+        self._pending = deque()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self._block_size:
+            self._submit()
+        return len(data)
+
+    def _submit(self):
+        self._pending.append(self._pool.submit(_gzip_compress, bytes(self._buffer), self._compresslevel))
+        self._buffer.clear()
+        while len(self._pending) > self._max_pending:
+            self._file.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        if self._buffer:
+            self._submit()
+        while self._pending:
+            self._file.write(self._pending.popleft().result())
+        self._file.close()
+        super().close()
+
+
+def _gzip_compress(data: bytes, compresslevel: int) -> bytes:
+    # wbits=31 adds gzip header and trailer to deflate stream.
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class BucketHandler:
+    """
+    Group records by heap index, as required for ema and lariat output, using a counting sort.
+
+    Records are distributed into buckets that each cover a consecutive range of heap indexes. Buckets are kept in
+    memory until the memory budget is reached and are then appended to temporary bucket files. On output, buckets are
+    processed in heap order and records within a bucket are grouped per heap index, so no comparison sort or merge of
+    temporary files is needed. Records with the same heap index are kept in input order. Bucket files that are too
+    large for the memory budget are split into smaller buckets before being read.
+
+    Bucket files are written as zlib-compressed blocks of length-prefixed binary records, see write_block and
+    read_blocks.
+    """
+    # Approximate memory overhead per buffered record for the tuple, str objects and list entry.
+    RECORD_OVERHEAD = 64
+    FIELD_OVERHEAD = 56
+    # Maximum number of files to split an oversized bucket into at once.
+    MAX_SPLITS = 64
+
+    def __init__(self, heaps_per_bucket: int, memory: int = 1024 ** 3, tmpdir=None):
+        """
+        :param heaps_per_bucket: Number of consecutive heap indexes grouped into the same bucket.
+        :param memory: Memory budget in bytes for buffered records.
+        :param tmpdir: Directory in which to create temporary bucket files. Default is the system default.
+        """
+        self._heaps_per_bucket = max(1, heaps_per_bucket)
+        self._memory = memory
+        self._tmpdir = Path(tempfile.mkdtemp(prefix="tagfastq_sort", dir=tmpdir))
+        self._buffers = defaultdict(list)
+        self._buffered = 0
+        self._bucket_files = {}
+        # Uncompressed size of records in each bucket file
+        self._bucket_sizes = defaultdict(int)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+    def add(self, heap: int, fields: tuple):
+        """Add record given as tuple of string fields to group"""
+        self._buffers[heap // self._heaps_per_bucket].append((heap, fields))
+        self._buffered += self.RECORD_OVERHEAD + sum(len(field) + self.FIELD_OVERHEAD for field in fields)
+
+        if self._buffered > self._memory:
+            self.flush()
+
+    def flush(self):
+        """Append buffered records to bucket files"""
+        for bucket, records in self._buffers.items():
+            path = self._bucket_files.setdefault(bucket, self._tmpdir / f"bucket_{bucket}.bin")
+            with open(path, "ab") as file:
+                self._bucket_sizes[path] += write_block(file, records)
+
+        self._buffers.clear()
+        self._buffered = 0
+
+    def parse_buckets(self):
+        """Yield (heap, fields) for all records ordered by heap index"""
+        logger.info(f"Grouping records from {len(self._bucket_files)} bucket files")
+        for bucket in sorted(set(self._bucket_files) | set(self._buffers)):
+            start = bucket * self._heaps_per_bucket
+            stop = start + self._heaps_per_bucket
+            records = self._buffers.pop(bucket, [])
+            path = self._bucket_files.pop(bucket, None)
+            if path is None:
+                yield from self._counting_sort(records, start, stop)
+            else:
+                # Records in memory are newer than those on file and are appended to keep the input order.
+                with open(path, "ab") as file:
+                    self._bucket_sizes[path] += write_block(file, records)
+                del records
+                yield from self._sort_file(path, start, stop)
+
+    def _sort_file(self, path, start, stop):
+        """Yield (heap, fields) from bucket file with heap indexes in the range [start, stop) ordered by heap"""
+        size = self._bucket_sizes.pop(path)
+        if size * 2 < self._memory:
+            records = list(read_blocks(path))
+            path.unlink()
+            yield from self._counting_sort(records, start, stop)
+        elif stop - start == 1:
+            # All records in the bucket have the same heap index.
+            yield from read_blocks(path)
+            path.unlink()
+        else:
+            # Split bucket that does not fit in memory into smaller buckets
+            nr_splits = min(stop - start, self.MAX_SPLITS)
+            width = -(-(stop - start) // nr_splits)
+            split_paths = [path.with_name(f"{path.stem}_{i}.bin") for i in range(nr_splits)]
+            split_buffers = [[] for _ in range(nr_splits)]
+            buffered = 0
+            with ExitStack() as stack:
+                split_files = [stack.enter_context(open(split_path, "wb")) for split_path in split_paths]
+                for heap, fields in read_blocks(path):
+                    split_buffers[(heap - start) // width].append((heap, fields))
+                    buffered += 1
+                    if buffered == BLOCK_SIZE * nr_splits:
+                        self._write_splits(split_files, split_paths, split_buffers)
+                        buffered = 0
+                self._write_splits(split_files, split_paths, split_buffers)
+            path.unlink()
+
+            for i, split_path in enumerate(split_paths):
+                yield from self._sort_file(split_path, start + i * width, min(stop, start + (i + 1) * width))
+
+    def _write_splits(self, split_files, split_paths, split_buffers):
+        for file, path, records in zip(split_files, split_paths, split_buffers):
+            self._bucket_sizes[path] += write_block(file, records)
+            records.clear()
+
+    @staticmethod
+    def _counting_sort(records, start, stop):
+        groups = [[] for _ in range(stop - start)]
+        for heap, fields in records:
+            groups[heap - start].append(fields)
+
+        for heap, group in enumerate(groups, start=start):
+            for fields in group:
+                yield heap, fields
+
+
+def write_block(file, records) -> int:
+    """
+    Write records of (heap, fields) to binary file as a zlib-compressed block. Each record is stored as the heap
+    index and field lengths as unsigned 32-bit integers followed by the UTF-8 encoded fields. The block is prefixed
+    with the compressed size, number of records and number of fields per record, which must be the same for all
+    records. Returns the uncompressed size of the records.
+    """
+    if not records:
+        return 0
+
+    parts = []
+    for heap, fields in records:
+        encoded = [field.encode() for field in fields]
+        parts.append(_record_header(len(encoded)).pack(heap, *map(len, encoded)))
+        parts.extend(encoded)
+    data = b"".join(parts)
+    compressed = zlib.compress(data, SPILL_COMPRESSION_LEVEL)
+    file.write(BLOCK_HEADER.pack(len(compressed), len(records), len(fields)))
+    file.write(compressed)
+    return len(data)
+
+
+def read_blocks(path):
+    """Yield records of (heap, fields) from binary file written using write_block"""
+    with open(path, "rb") as file:
+        while True:
+            header = file.read(BLOCK_HEADER.size)
+            if not header:
+                break
+            compressed_size, nr_records, nr_fields = BLOCK_HEADER.unpack(header)
+            data = zlib.decompress(file.read(compressed_size))
+            record_header = _record_header(nr_fields)
+            offset = 0
+            for _ in range(nr_records):
+                heap, *lengths = record_header.unpack_from(data, offset)
+                offset += record_header.size
+                fields = []
+                for length in lengths:
+                    fields.append(data[offset:offset + length].decode())
+                    offset += length
+                yield heap, tuple(fields)
+
+
+@lru_cache(maxsize=None)
+def _record_header(nr_fields: int) -> struct.Struct:
+    return struct.Struct(f"<{nr_fields + 1}I")
 
 
 def add_arguments(parser):
@@ -595,6 +1197,12 @@ def add_arguments(parser):
         help=f"Output interleaved FASTQ split into bins named '{Output.BIN_FASTQ_TEMPLATE}' in the provided "
              f"directory. Entries will be grouped based on barcode. Only used for ema mapping."
     )
+    output.add_argument(
+        "--output-ubam",
+        help="Output read pairs to unaligned BAM with barcodes stored as SAM tags rather than in the read names. "
+             "The barcode tag includes the sample number so the output does not need processing by `blr tagbam`. "
+             "Not available for mappers ema and lariat."
+    )
     parser.add_argument(
         "--nr-bins", type=int, default=100,
         help="Number of bins to split reads into when using the '--output-bins' alternative. Default: %(default)s."
@@ -625,3 +1233,35 @@ def add_arguments(parser):
         "--sample-nr", type=int, default=1,
         help="Sample number to append to barcode string. Default: %(default)s."
     )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="Number of worker processes used to tag reads. Input is split into batches that are tagged in parallel "
+             "and written in input order. Only available for mappers bowtie2, bwa and minimap2. "
+             "Default: %(default)s."
+    )
+    parser.add_argument(
+        "--index-barcodes", action="store_true",
+        help="Build an on-disk index of the uncorrected barcodes for lookup by read name. Use if the reads and "
+             "barcodes are not in the same order, e.g. if reads have been dropped or reordered after barcode "
+             "extraction. The index is written to --tmpdir."
+    )
+    add_output_arguments(parser)
+
+
+def add_output_arguments(parser):
+    parser.add_argument(
+        "--tmpdir",
+        help="Directory for temporary files used when grouping reads by barcode for ema and lariat. Default: system "
+             "default temporary directory."
+    )
+    parser.add_argument(
+        "--sort-memory", type=float, default=1,
+        help="Memory in GB used to buffer reads when grouping reads by barcode for ema and lariat. "
+             "Default: %(default)s."
+    )
+    parser.add_argument(
+        "--compression-threads", type=int, default=0,
+        help="Number of threads in a pool shared by all gzip compressed outputs for compressing output in blocks. "
+             "If 0, outputs are compressed as determined by xopen. ema bins are never compressed. "
+             "Default: %(default)s."
+    )
@@ -30,7 +30,7 @@ rule trim:
         r1_fastq="reads.1.fastq.gz",
         r2_fastq="reads.2.fastq.gz",
     log: "trimmed.fastq.log"
-    threads: workflow.cores - 1  # rule tag needs one thread
+    threads: max(1, workflow.cores - 4)  # rule tag runs concurrently on the piped output using four threads
     params:
         read1_adapter = f"XNNN{config['h1']}{barcode_placeholder}{config['h2']};min_overlap={trim_len}...{config['h3']};optional",
         read2_adapter = config["h3"],
@@ -73,7 +73,7 @@ rule tag:
         uncorrected_barcodes="barcodes.fasta.gz",
         corrected_barcodes="barcodes.clstr.gz"
     log: "tagfastq.log"
-    threads: 1
+    threads: 4
     params:
         output = output_cmd,
         barcode_tag = config["cluster_tag"],
@@ -81,7 +81,13 @@ rule tag:
         mapper = config["read_mapper"],
         pattern = config["barcode"],
         sample_nr = config["sample_nr"],
-        min_count = config["min_count"]
+        min_count = config["min_count"],
+        tmpdir = " --tmpdir $TMPDIR" if "TMPDIR" in os.environ else "",
+        sort_memory = config["heap_space"],
+        index_barcodes = " --index-barcodes" if config["index_barcodes"] else "",
+        # Split threads between worker processes and gzip compression threads.
+        workers = lambda wc, threads: threads - threads // 2,
+        compression_threads = lambda wc, threads: threads // 2,
     shell:
         "blr tagfastq"
         " {params.output}"
@@ -91,6 +97,11 @@ rule tag:
         " --pattern-match {params.pattern}"
         " --sample-nr {params.sample_nr}"
         " --min-count {params.min_count}"
+        " --sort-memory {params.sort_memory}"
+        " --compression-threads {params.compression_threads}"
+        " --workers {params.workers}"
+        "{params.tmpdir}"
+        "{params.index_barcodes}"
         " {input.uncorrected_barcodes}"
         " {input.corrected_barcodes}"
         " {input.interleaved_fastq}"
@@ -121,26 +132,20 @@ rule extract_barcode:
         " > {log}"
 
 
-rule count_barcodes_in_chunks: 
-    input: 
-        "barcodes.fasta.gz"
-    output:
-        temp("barcodes.count_groups.txt")
-    params:
-        awk = """ awk -v OFS='\\t' '{{ if ( NR%2==0 ) {{ dbs[\$1]++i }} }} END {{for (i in dbs) print(i,dbs[i]) }}' """
-    shell:
-        " pigz -cd {input} | parallel --pipe -N20000000 \"{params.awk}\" >> {output}"
-
-
-rule merge_barcode_counts:
-    input:
-        "barcodes.count_groups.txt"
+rule count_barcodes:
+    """Count occurrences of each barcode sequence for clustering"""
     output:
         temp("barcodes.counts.txt")
-    params:
-        awk = """ awk -v OFS='\\t' '{ dbs[$1]+=$2 } END {for (i in dbs) print(i,dbs[i]) }' """
-    shell: 
-        "cat {input} | {params.awk} > {output} "
+    input:
+        "barcodes.fasta.gz"
+    threads: 4
+    log: "barcodes.counts.log"
+    shell:
+        "blr countbarcodes"
+        " {input}"
+        " -o {output}"
+        " -t {threads}"
+        " 2> {log}"
 
 
 rule starcode_clustering:
@@ -28,7 +28,7 @@ rule trim_stlfr:
         r1_fastq = "reads.1.fastq.gz",
         r2_fastq = "reads.2.fastq.gz",
     log: "trimmed.fastq.log",
-    threads: workflow.cores - 1
+    threads: max(1, workflow.cores - 4)  # rule tag_stlfr runs concurrently on the piped output using four threads
     params:
         adapter = config["stlfr_adapter"],
     shell:
@@ -67,11 +67,17 @@ rule tag_stlfr:
         tag_output
     input:
         interleaved_fastq = "trimmed.fastq",
+    threads: 4
     params:
         output = output_cmd,
         barcode_tag = config["cluster_tag"],
         mapper = config["read_mapper"],
         sample_nr = config["sample_nr"],
+        tmpdir = " --tmpdir $TMPDIR" if "TMPDIR" in os.environ else "",
+        sort_memory = config["heap_space"],
+        # Split threads between worker processes and gzip compression threads.
+        workers = lambda wc, threads: threads - threads // 2,
+        compression_threads = lambda wc, threads: threads // 2,
     log:
         log = "process_stlfr.log",
         csv = "process_stlfr.barcode_translations.csv"
@@ -81,6 +87,10 @@ rule tag_stlfr:
         " -b {params.barcode_tag}"
         " --mapper {params.mapper}"
         " --sample-nr {params.sample_nr}"
+        " --sort-memory {params.sort_memory}"
+        " --compression-threads {params.compression_threads}"
+        " --workers {params.workers}"
+        "{params.tmpdir}"
         " --output-translations {log.csv}"
         " {input.interleaved_fastq}"
         " 2> {log.log}"
@@ -17,8 +17,10 @@ rule tellseq_barcodes_correction:
         "barcodes.clstr.gz"
     input:
         "barcodes.fastq.gz"
-    threads: 20 if config["tellseq_correction"] == "cluster" else 1
+    threads: 20 if config["tellseq_correction"] == "cluster" else 4
     log: "barcodes.clstr.log"
+    params:
+        tmpdir = " --tmpdir $TMPDIR" if "TMPDIR" in os.environ else "",
     run:
         command = {
             "cluster":
@@ -31,6 +33,8 @@ rule tellseq_barcodes_correction:
             "correct_singles":
                 "blr correctbc"
                 " {input}"
+                " -t {threads}"
+                "{params.tmpdir}"
                 " -o -"
         }[config["tellseq_correction"]]
         shell(f"{command} 2> {log} | pigz - > {output}")
@@ -61,7 +65,7 @@ rule tag_tellseq_reads:
         uncorrected_barcodes="barcodes.fastq.gz",
         corrected_barcodes="barcodes.clstr.gz"
     log: "tagfastq.log"
-    threads: 1
+    threads: 4
     params:
         output = output_cmd,
         barcode_tag = config["cluster_tag"],
@@ -69,6 +73,12 @@ rule tag_tellseq_reads:
         mapper = config["read_mapper"],
         pattern = config["tellseq_barcode"],
         sample_nr = config["sample_nr"],
+        tmpdir = " --tmpdir $TMPDIR" if "TMPDIR" in os.environ else "",
+        sort_memory = config["heap_space"],
+        index_barcodes = " --index-barcodes" if config["index_barcodes"] else "",
+        # Split threads between worker processes and gzip compression threads.
+        workers = lambda wc, threads: threads - threads // 2,
+        compression_threads = lambda wc, threads: threads // 2,
     shell:
         "blr tagfastq"
         " {params.output}"
@@ -78,6 +88,11 @@ rule tag_tellseq_reads:
         " --pattern-match {params.pattern}"
         " --min-count 2"
         " --sample-nr {params.sample_nr}"
+        " --sort-memory {params.sort_memory}"
+        " --compression-threads {params.compression_threads}"
+        " --workers {params.workers}"
+        "{params.tmpdir}"
+        "{params.index_barcodes}"
         " {input.uncorrected_barcodes}"
         " {input.corrected_barcodes}"
         " {input.r1_fastq}"
@@ -10,44 +10,41 @@ Use indepentant from snakemake with command:
 
     python barcode_stats.py output.txt [input1.clstr [input2.clstr [...]]]
 """
-import pandas as pd
 import sys
-from collections import OrderedDict
+from collections import OrderedDict, Counter
 
 from blr import __version__
-from blr.utils import smart_open
+from blr.utils import smart_open, parse_clstr
 
 
 def main(clstrs, output):
-    # Process data
-    all_data = []
-    for nr, clstr in enumerate(clstrs):
-        data = pd.read_csv(clstr, sep="\t", names=["Canonical", "Reads", "Components"])
-        data["FileNr"] = nr
-        all_data.append(data)
+    # Process data. Clusters are streamed and only histograms of reads and components per barcode are kept.
+    reads_histogram = Counter()
+    components_per_barcode = Counter()
+    for clstr in clstrs:
+        for cluster in parse_clstr(clstr):
+            reads_histogram[cluster.size] += 1
+            components_per_barcode[len(cluster.sequences)] += 1
 
-    all_data = pd.concat(all_data)
-    all_data["Size"] = all_data["Components"].apply(lambda x: len(x.split(',')))
-    all_data["SeqLen"] = all_data["Canonical"].apply(len)
+    nr_barcodes = sum(reads_histogram.values())
+    total_reads = sum(reads * count for reads, count in reads_histogram.items())
 
     # Collect stats
     stats = OrderedDict()
-    stats["Barcodes raw"] = sum(all_data["Size"])
-    stats["Barcodes corrected"] = len(all_data)
-    stats["Barcodes corrected with > 3 read-pairs"] = len(all_data[all_data["Reads"] > 3])
-    stats["Maximum reads per barcode"] = all_data["Reads"].max()
-    stats["Mean reads per barcode"] = all_data["Reads"].mean()
-    stats["Median reads per barcode"] = all_data["Reads"].median()
+    stats["Barcodes raw"] = sum(size * count for size, count in components_per_barcode.items())
+    stats["Barcodes corrected"] = nr_barcodes
+    stats["Barcodes corrected with > 3 read-pairs"] = sum(c for reads, c in reads_histogram.items() if reads > 3)
+    stats["Maximum reads per barcode"] = max(reads_histogram, default=0)
+    stats["Mean reads per barcode"] = total_reads / nr_barcodes if nr_barcodes else float("nan")
+    stats["Median reads per barcode"] = median_from_histogram(reads_histogram)
 
     reads_per_barcode = []
-    total_reads = all_data["Reads"].sum()
-    for reads, group in all_data.groupby("Reads"):
-        nr_barcodes = len(group)
-        total = reads * nr_barcodes
+    for reads, count in sorted(reads_histogram.items()):
+        total = reads * count
         density = total / total_reads
-        reads_per_barcode.append((reads, nr_barcodes, total, density))
+        reads_per_barcode.append((reads, count, total, density))
 
-    components_per_barcode = OrderedDict(all_data.groupby("Size").apply(len))
+    components_per_barcode = OrderedDict(sorted(components_per_barcode.items()))
 
     # Write output. Format is based on `samtools stats`
     with smart_open(output) as f:
@@ -67,6 +64,24 @@ def main(clstrs, output):
             print("CB", size, count, sep="\t", file=f)
 
 
+def median_from_histogram(histogram):
+    """Calculate median from dict with values pointing to their count"""
+    total = sum(histogram.values())
+    if total == 0:
+        return float("nan")
+
+    # Find the value(s) at the middle position(s) (0-based) in the sorted data.
+    lower, upper = (total - 1) // 2, total // 2
+    lower_value = None
+    cumulative = 0
+    for value, count in sorted(histogram.items()):
+        cumulative += count
+        if lower_value is None and cumulative > lower:
+            lower_value = value
+        if cumulative > upper:
+            return (lower_value + value) / 2
+
+
 if __name__ == "__main__":
     if len(sys.argv) == 1:
         clstrs = [snakemake.input.clstr]  # noqa: F821
@@ -7,6 +7,7 @@ import numpy as np
 import os
 from collections import namedtuple, Counter, defaultdict, OrderedDict
 import contextlib
+from xopen import xopen
 
 from blr import __version__
 from snakemake.io import temp
@@ -21,6 +22,32 @@ else:
 ACCEPTED_LIBRARY_TYPES = ["dbs", "blr", "10x", "stlfr", "tellseq"]  # TODO Remove blr
 ACCEPTED_READ_MAPPERS = ["ema", "lariat", "bwa", "bowtie2", "minimap2"]
 
+IUPAC = {
+    "A": "A",
+    "C": "C",
+    "G": "G",
+    "T": "T",
+    "R": "AG",
+    "Y": "CT",
+    "M": "AC",
+    "K": "GT",
+    "S": "CG",
+    "W": "AT",
+    "H": "ACT",
+    "B": "CGT",
+    "V": "ACG",
+    "D": "AGT",
+    "N": "ACGT"
+}
+
+# Translation for 2-bit encoding of DNA sequences, see encode_sequence.
+_ENCODE_BASES = str.maketrans("ACGT", "0123")
+MAX_ENCODED_LENGTH = 31
+# Lookup table from ASCII code to base code used by encode_sequences.
+_INVALID_BASE = 255
+_BASE_CODES = np.full(256, _INVALID_BASE, dtype=np.uint8)
+_BASE_CODES[np.frombuffer(b"ACGT", dtype=np.uint8)] = np.arange(4)
+
 
 def is_1_2(s, t):
     """
@@ -60,6 +87,131 @@ def guess_paired_path(path: Path):
     return None
 
 
+def encode_sequence(sequence: str):
+    """
+    Encode DNA sequence as integer using 2 bits per base (A=0, C=1, G=2, T=3). The encoded bases are prefixed with a
+    single set bit marking the sequence length so that e.g. 'A' and 'AA' get different codes. Sequences of up to
+    MAX_ENCODED_LENGTH bases therefore fit in an unsigned 64-bit integer. Return None if the sequence contains other
+    characters than 'ACGT' or is too long.
+
+    >>> encode_sequence("ACGT")
+    283
+    """
+    if len(sequence) > MAX_ENCODED_LENGTH:
+        return None
+    try:
+        return int("1" + sequence.translate(_ENCODE_BASES), 4)
+    except ValueError:
+        return None
+
+
+def decode_sequence(code: int) -> str:
+    """
+    Decode integer from encode_sequence back to DNA sequence.
+
+    >>> decode_sequence(283)
+    'ACGT'
+    """
+    code = int(code)
+    length = (code.bit_length() - 1) // 2
+    return "".join("ACGT"[(code >> 2 * i) & 3] for i in reversed(range(length)))
+
+
+def encode_sequences(sequences) -> np.ndarray:
+    """
+    Vectorized version of encode_sequence for a list of sequences given as str or bytes. Returns an array of unsigned
+    64-bit integers where sequences that cannot be encoded get code 0, which is not a valid code.
+    """
+    codes = np.zeros(len(sequences), dtype=np.uint64)
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    for length in np.unique(lengths):
+        if length > MAX_ENCODED_LENGTH:
+            continue
+
+        # Sequences of the same length are joined and viewed as a matrix with one sequence per row.
+        indices = np.flatnonzero(lengths == length)
+        selected = sequences if len(indices) == len(sequences) else [sequences[i] for i in indices]
+        if isinstance(selected[0], bytes):
+            data = b"".join(selected)
+        else:
+            data = "".join(selected).encode("ascii", errors="replace")
+        bases = _BASE_CODES[np.frombuffer(data, dtype=np.uint8)].reshape(len(indices), length)
+        valid = (bases != _INVALID_BASE).all(axis=1)
+        length_codes = np.ones(len(indices), dtype=np.uint64)
+        for column in bases.T.astype(np.uint64):
+            length_codes <<= np.uint64(2)
+            length_codes |= column
+        codes[indices[valid]] = length_codes[valid]
+    return codes
+
+
+_LENGTH_BITS = np.array([1 << 2 * length for length in range(MAX_ENCODED_LENGTH + 1)], dtype=np.uint64)
+
+
+def code_lengths(codes: np.ndarray) -> np.ndarray:
+    """Sequence lengths for array of codes from encode_sequences"""
+    return np.searchsorted(_LENGTH_BITS, codes, side="right") - 1
+
+
+def decode_sequences(codes: np.ndarray):
+    """Vectorized version of decode_sequence for an array of codes. Returns a list of sequences."""
+    sequences = [None] * len(codes)
+    lengths = code_lengths(codes)
+    for length in np.unique(lengths).tolist():
+        indices = np.flatnonzero(lengths == length)
+        shifts = np.arange(2 * (length - 1), -1, -2, dtype=np.uint64)
+        bases = (codes[indices, None] >> shifts[None, :]) & np.uint64(3)
+        data = np.frombuffer(b"ACGT", dtype=np.uint8)[bases.astype(np.intp)].tobytes().decode()
+        for i, index in enumerate(indices.tolist()):
+            sequences[index] = data[i * length:(i + 1) * length]
+    return sequences
+
+
+def match_template(sequence: str, template) -> bool:
+    if len(sequence) != len(template):
+        return False
+
+    for base, accepted_bases in zip(sequence, template):
+        if base not in accepted_bases:
+            return False
+    return True
+
+
+BarcodeCluster = namedtuple("BarcodeCluster", ["canonical", "size", "sequences"])
+
+
+def parse_clstr(file, min_count: int = 0, template=None, summary=None):
+    """
+    Stream barcode clusters from starcode CLSTR file (optionally gzipped) with three tab-separated columns: canonical
+    sequence, read count and comma-separated component sequences. Clusters with fewer than min_count reads or a
+    canonical sequence not matching the template (see match_template) are skipped. Yields BarcodeCluster instances.
+
+    :param file: str. Path to CLSTR file.
+    :param min_count: int. Skip clusters with fewer than min_count reads.
+    :param template: list of sets with accepted bases for each position in the canonical sequence.
+    :param summary: dict for stats collection.
+    """
+    summary = summary if summary is not None else Counter()
+    for key in ["Corrected barcodes", "Reads with corrected barcodes", "Barcodes not passing filters",
+                "Reads with barcodes not passing filters"]:
+        summary[key] += 0
+
+    with xopen(file) as f:
+        for line in f:
+            canonical, size, sequences = line.rstrip("\n").split("\t")
+            size = int(size)
+
+            summary["Corrected barcodes"] += 1
+            summary["Reads with corrected barcodes"] += size
+
+            if size < min_count or (template and not match_template(canonical, template)):
+                summary["Barcodes not passing filters"] += 1
+                summary["Reads with barcodes not passing filters"] += size
+                continue
+
+            yield BarcodeCluster(canonical, size, sequences.split(","))
+
+
 def get_bamtag(pysam_read: pysam.AlignedSegment, tag: str, default=None):
     """
     Fetches tags from bam files. Return default value of the same type if not found.
@@ -103,70 +255,97 @@ class Summary(Counter):
 class PySAMIO:
     """ Reader and writer for BAM/SAM files that automatically attaches processing step information to header """
 
-    def __init__(self, inname: str, outname: str, name: str, inmode: str = "rb", outmode: str = "wb"):
+    def __init__(self, inname: str, outname: str, name: str, inmode: str = "rb", outmode: str = "wb",
+                 threads: int = 1, compression_level: int = None):
         """
         :param inname: Path to input SAM/BAM file.
         :param outname: Path to output SAM/BAM file.
         :param name: __name__ variable from script.
         :param inmode: Reading mode for input file. 'r' for SAM and 'rb' for BAM.
         :param outmode: Reading mode for output file. 'r' for SAM and 'rb' for BAM.
+        :param threads: Number of htslib threads used for BGZF decompression and compression of each file.
+        :param compression_level: Compression level 0-9 for BAM output. Default is the htslib default.
         """
+        # Compression level is set using the htslib output format option, as for 'samtools --output-fmt-option'.
+        self._format_options = [f"level={compression_level}"] if compression_level is not None else None
+        self._outmode = outmode
+        self._threads = threads
+        self._extra_outfiles = []
         self._save = pysam.set_verbosity(0)  # Fix for https://github.com/pysam-developers/pysam/issues/939
-        self.infile = pysam.AlignmentFile(inname, inmode)
+        self.infile = pysam.AlignmentFile(inname, inmode, threads=threads)
         self.header = self._make_header(name)
-        self.outfile = pysam.AlignmentFile(outname, outmode, header=self.header)
+        self.outfile = pysam.AlignmentFile(outname, outmode, header=self.header, threads=threads,
+                                           format_options=self._format_options)
+
+    def open_output(self, outname: str, threads: int = None):
+        """
+        Open additional output file with the same header and settings as the output file. Closed on exit. Use threads
+        to set the number of htslib threads used for compression instead of the threads of the output file.
+        """
+        outfile = pysam.AlignmentFile(outname, self._outmode, header=self.header,
+                                      threads=threads if threads is not None else self._threads,
+                                      format_options=self._format_options)
+        self._extra_outfiles.append(outfile)
+        return outfile
 
     def __enter__(self):
         return self.infile, self.outfile
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.infile.close(), self.outfile.close()
+        for outfile in self._extra_outfiles:
+            outfile.close()
         pysam.set_verbosity(self._save)
         return isinstance(exc_val, OSError)
 
     def _make_header(self, name):
-        """
-        Create SAM header dict with new tool and command line argument information based on template file. Appends
-        new PG entry with tool name (ID), software name (PN), command line arguments (CL) to track the tools applied
-        to the file. Use in output SAM/BAM file as 'header' attribute.
+        return make_header(self.infile, name)
 
-        :param name: string. Pass '__name__' variable to be used to get program and tool name.
-        :return: pysam.AlignmentHeader object
-        """
 
-        def make_unique(identifier, prev_entries):
-            """
-            Compare idenifier to other identifiers in header and make unique if neccessary by adding suffix.
-            :param identifier: string. Program record identifier.
-            :param prev_entries: dict. Dictionary of "PG" header entries from pysam.AlignmentFile header.
-            :return: string. Updated identifier
-            """
-            nr = 0
-            updated_identifier = identifier
-            while any(updated_identifier == e["ID"] for e in prev_entries):
-                nr += 1
-                updated_identifier = ".".join([identifier, str(nr)])
-            return updated_identifier
-
-        # Process info strings for header
-        id_name = name.split(".")[-1]
-        program_name = name.split(".")[0]
-        cmd_line = f"\"{' '.join(sys.argv)}\""
-
-        header = self.infile.header.to_dict()
-        pg_entries = header["PG"]
-        # Make sure id_name is unique by adding numbers at end if needed.
-        id_name = make_unique(id_name, pg_entries)
-
-        pg_entries.append({
-            "ID": id_name,       # Program record identifier. Must be unique
-            "PN": program_name,  # Program name
-            "CL": cmd_line,      # Command line arguments string.
-            "VN": __version__    # Version information
-        })
-        header["PG"] = pg_entries
-
-        return pysam.AlignmentHeader.from_dict(header)
+def make_header(infile, name):
+    """
+    Create SAM header dict with new tool and command line argument information based on template file. Appends
+    new PG entry with tool name (ID), software name (PN), command line arguments (CL) to track the tools applied
+    to the file. Use in output SAM/BAM file as 'header' attribute.
+
+    :param infile: pysam.AlignmentFile used as template.
+    :param name: string. Pass '__name__' variable to be used to get program and tool name.
+    :return: pysam.AlignmentHeader object
+    """
+
+    def make_unique(identifier, prev_entries):
+        """
+        Compare idenifier to other identifiers in header and make unique if neccessary by adding suffix.
+        :param identifier: string. Program record identifier.
+        :param prev_entries: dict. Dictionary of "PG" header entries from pysam.AlignmentFile header.
+        :return: string. Updated identifier
+        """
+        nr = 0
+        updated_identifier = identifier
+        while any(updated_identifier == e["ID"] for e in prev_entries):
+            nr += 1
+            updated_identifier = ".".join([identifier, str(nr)])
+        return updated_identifier
+
+    # Process info strings for header
+    id_name = name.split(".")[-1]
+    program_name = name.split(".")[0]
+    cmd_line = f"\"{' '.join(sys.argv)}\""
+
+    header = infile.header.to_dict()
+    pg_entries = header["PG"]
+    # Make sure id_name is unique by adding numbers at end if needed.
+    id_name = make_unique(id_name, pg_entries)
+
+    pg_entries.append({
+        "ID": id_name,       # Program record identifier. Must be unique
+        "PN": program_name,  # Program name
+        "CL": cmd_line,      # Command line arguments string.
+        "VN": __version__    # Version information
+    })
+    header["PG"] = pg_entries
+
+    return pysam.AlignmentHeader.from_dict(header)
 
 
 def calculate_N50(lengths):
@@ -188,6 +367,87 @@ def calculate_N50(lengths):
     return lengths[ind[0][0]]
 
 
+class FragmentStats:
+    """
+    Streaming accumulator for fragment (molecule) lengths, bases covered by reads and read counts. Values are stored
+    in growable typed arrays so no upper bound on the number of fragments is needed.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._size = 0
+        self._lengths = np.empty(capacity, dtype=np.int64)
+        self._bp_covered = np.empty(capacity, dtype=np.int64)
+        self._reads = np.empty(capacity, dtype=np.int64)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return self._lengths[:self._size]
+
+    @property
+    def bp_covered(self) -> np.ndarray:
+        return self._bp_covered[:self._size]
+
+    @property
+    def reads(self) -> np.ndarray:
+        return self._reads[:self._size]
+
+    def add(self, length: int, bp_covered: int, reads: int = 0):
+        """Add single fragment"""
+        self._reserve(self._size + 1)
+        self._lengths[self._size] = length
+        self._bp_covered[self._size] = bp_covered
+        self._reads[self._size] = reads
+        self._size += 1
+
+    def extend(self, lengths, bp_covered, reads=0):
+        """Add fragments from arrays of lengths, bases covered and read counts"""
+        size = self._size + len(lengths)
+        self._reserve(size)
+        self._lengths[self._size:size] = lengths
+        self._bp_covered[self._size:size] = bp_covered
+        self._reads[self._size:size] = reads
+        self._size = size
+
+    def _reserve(self, size: int):
+        capacity = len(self._lengths)
+        if size <= capacity:
+            return
+
+        capacity = max(capacity, 1)
+        while capacity < size:
+            capacity *= 2
+        for name in ("_lengths", "_bp_covered", "_reads"):
+            array = np.empty(capacity, dtype=np.int64)
+            array[:self._size] = getattr(self, name)[:self._size]
+            setattr(self, name, array)
+
+    def coverage(self) -> np.ndarray:
+        """Return percentage of each fragment covered by reads"""
+        return 100 * self.bp_covered / self.lengths
+
+    def dna_fraction_longer_than(self, min_length: int) -> float:
+        """Return percentage of total fragment length in fragments longer than min_length"""
+        lengths = self.lengths
+        return 100 * lengths[lengths > min_length].sum() / lengths.sum()
+
+    def update_summary(self, summary):
+        """Add fragment length and read coverage stats to summary if there are any fragments"""
+        if self._size == 0:
+            return
+
+        lengths = self.lengths
+        coverage = self.coverage()
+        summary["Fragment N50 (bp)"] = calculate_N50(lengths)
+        summary["Mean fragment size (bp)"] = np.mean(lengths)
+        summary["Median fragment size (bp)"] = np.median(lengths)
+        summary["Longest fragment (bp)"] = np.max(lengths)
+        summary["Mean fragment read coverage (%)"] = np.mean(coverage)
+        summary["Median fragment read coverage (%)"] = np.median(coverage)
+
+
 class ReadGroup:
     """
     Read group information for read tagging.
@@ -0,0 +1,144 @@
+import io
+from multiprocessing import get_context
+
+import pysam
+
+from blr.cli.buildmolecules import run_buildmolecules, Molecule, MoleculeStore, find_regions, _init_worker
+
+from .utils import BAM_HEADER, build_read, write_bam, write_molecule_bam
+
+
+def run(input_bam, output_bam, stats_tsv, streaming, window=30000, threads=1):
+    run_buildmolecules(str(input_bam), str(output_bam), threshold=4, window=window, barcode_tag="BX",
+                       stats_tsv=stats_tsv, bed_file=None, molecule_tag="MI", min_mapq=0, library_type="dbs",
+                       streaming=streaming, threads=threads)
+
+
+def read_molecule_tags(path):
+    with pysam.AlignmentFile(path) as file:
+        return [(read.query_name, read.flag, read.get_tag("MI")) for read in file]
+
+
+def read_stats(path):
+    with open(path) as file:
+        return [line.split("\t")[1:] for line in file]
+
+
+def relative_molecule_tags(path):
+    # Molecule IDs depend on the class-level counter and threads so are numbered in the order they first appear.
+    tags = read_molecule_tags(path)
+    numbers = {-1: -1}
+    for *_, tag in tags:
+        numbers.setdefault(tag, len(numbers) - 1)
+    return [(name, flag, numbers[tag]) for name, flag, tag in tags]
+
+
+def test_streaming_same_as_two_pass(tmp_path):
+    input_bam = tmp_path / "input.bam"
+    write_molecule_bam(input_bam)
+
+    run(input_bam, tmp_path / "two_pass.bam", tmp_path / "two_pass.tsv", streaming=False)
+    run(input_bam, tmp_path / "streaming.bam", tmp_path / "streaming.tsv", streaming=True)
+
+    assert any(tag != -1 for *_, tag in read_molecule_tags(tmp_path / "two_pass.bam"))
+    assert relative_molecule_tags(tmp_path / "two_pass.bam") == relative_molecule_tags(tmp_path / "streaming.bam")
+    assert read_stats(tmp_path / "two_pass.tsv") == read_stats(tmp_path / "streaming.tsv")
+
+
+def write_discordant_mate_bam(path, starts, mate_start):
+    # Molecule of a read at each start where the mate of the last read maps far away in a molecule of its own.
+    tags = {"BX": "ACGTACGTACGTACGTACGT-1"}
+    reads = [dict(name=f"read{i}", reference_id=0, start=start, tags=tags) for i, start in enumerate(starts)]
+    reads.append(dict(name=f"read{len(starts) - 1}", reference_id=0, start=mate_start, tags=tags))
+    write_bam(path, reads)
+
+
+def test_streaming_discordant_mate(tmp_path):
+    input_bam = tmp_path / "input.bam"
+    write_discordant_mate_bam(input_bam, [1000, 2000, 3000, 4000], mate_start=100000)
+
+    run(input_bam, tmp_path / "two_pass.bam", tmp_path / "two_pass.tsv", streaming=False)
+    run(input_bam, tmp_path / "streaming.bam", tmp_path / "streaming.tsv", streaming=True)
+
+    # All reads of the molecule are tagged, but the mate is not as it is further than a window from the molecule.
+    two_pass_tags = relative_molecule_tags(tmp_path / "two_pass.bam")
+    streaming_tags = relative_molecule_tags(tmp_path / "streaming.bam")
+    assert [tag for *_, tag in streaming_tags[:4]] == [0, 0, 0, 0]
+    assert streaming_tags[:4] == two_pass_tags[:4]
+    assert streaming_tags[4] == ("read3", 0, -1)
+    assert read_stats(tmp_path / "two_pass.tsv") == read_stats(tmp_path / "streaming.tsv")
+
+
+def test_threads_same_as_streaming(tmp_path):
+    input_bam = tmp_path / "input.bam"
+    write_molecule_bam(input_bam)
+    pysam.index(str(input_bam))
+
+    # A small window gives gaps to split contigs into several regions at.
+    run(input_bam, tmp_path / "streaming.bam", tmp_path / "streaming.tsv", streaming=True, window=1000)
+    run(input_bam, tmp_path / "threads.bam", tmp_path / "threads.tsv", streaming=False, window=1000, threads=2)
+
+    assert relative_molecule_tags(tmp_path / "streaming.bam") == relative_molecule_tags(tmp_path / "threads.bam")
+    assert sorted(read_stats(tmp_path / "streaming.tsv")) == sorted(read_stats(tmp_path / "threads.tsv"))
+
+
+def test_threads_discordant_mate_in_other_region(tmp_path):
+    input_bam = tmp_path / "input.bam"
+    write_discordant_mate_bam(input_bam, [248000, 249000, 250000, 251000], mate_start=400000)
+    pysam.index(str(input_bam))
+
+    # With a window of 1000 bp contigs are split at a gap between the molecule and the mate.
+    run(input_bam, tmp_path / "streaming.bam", tmp_path / "streaming.tsv", streaming=True, window=1000)
+    run(input_bam, tmp_path / "threads.bam", tmp_path / "threads.tsv", streaming=False, window=1000, threads=2)
+
+    assert [tag for *_, tag in relative_molecule_tags(tmp_path / "threads.bam")] == [0, 0, 0, 0, -1]
+    assert relative_molecule_tags(tmp_path / "streaming.bam") == relative_molecule_tags(tmp_path / "threads.bam")
+    assert read_stats(tmp_path / "streaming.tsv") == read_stats(tmp_path / "threads.tsv")
+
+
+def test_find_regions(tmp_path):
+    input_bam = tmp_path / "input.bam"
+    write_molecule_bam(input_bam)
+    pysam.index(str(input_bam))
+
+    with get_context("fork").Pool(1, initializer=_init_worker,
+                                  initargs=(str(input_bam), BAM_HEADER, str(tmp_path), {"window": 1000})) as workers:
+        regions = find_regions(str(input_bam), 1000, 100000, workers)
+
+    segments = [segment for region in regions for segment in region]
+    assert len(regions) > 2
+    assert segments[-1] == ("*", None, None)
+    for contig in ["chr1", "chr2"]:
+        bounds = [(start, stop) for name, start, stop in segments if name == contig]
+        assert bounds[0][0] == 0 and bounds[-1][1] == 1000000
+        assert all(stop == next_start for (_, stop), (next_start, _) in zip(bounds, bounds[1:]))
+
+
+def test_molecule_store():
+    header = pysam.AlignmentHeader.from_dict(BAM_HEADER)
+    molecules = MoleculeStore(capacity=1)
+    for i, (reference_id, start) in enumerate([(1, 500), (0, 300), (1, 100)]):
+        molecule = Molecule(build_read(header, f"read{i}", reference_id, start), f"BARCODE{i % 2}", index=i)
+        molecule.add_read(build_read(header, f"read{i}", reference_id, start + 200))
+        molecules.append(molecule)
+
+    assert len(molecules) == 3
+    assert molecules.lengths().tolist() == [300, 300, 300]
+    assert molecules.barcodes == ["BARCODE0", "BARCODE1"]
+
+    tsv = io.StringIO()
+    molecules.write_tsv(tsv)
+    assert tsv.getvalue().splitlines() == [
+        "MoleculeID\tBarcode\tReads\tLength\tBpCovered",
+        "0\tBARCODE0\t2\t300\t200",
+        "1\tBARCODE1\t2\t300\t200",
+        "2\tBARCODE0\t2\t300\t200",
+    ]
+
+    bed = io.StringIO()
+    molecules.write_bed(bed, order=molecules.sorted_by_position())
+    assert [line.split("\t")[:4] for line in bed.getvalue().splitlines()] == [
+        ["chr1", "300", "600", "1"],
+        ["chr2", "100", "400", "2"],
+        ["chr2", "500", "800", "0"],
+    ]
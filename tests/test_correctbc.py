@@ -0,0 +1,100 @@
+from argparse import Namespace
+
+import pytest
+
+from blr.cli.correctbc import main
+
+
+def run_correctbc(tmp_path, barcodes, threads=1, max_dist=1, records=None, filename="barcodes.fasta"):
+    input_file = tmp_path / filename
+    input_file.write_text(records or "".join(f">r{i}\n{barcode}\n" for i, barcode in enumerate(barcodes)))
+    output_file = tmp_path / "barcodes.clstr"
+    main(Namespace(uncorrected_barcodes=str(input_file), output=str(output_file), threads=threads, max_dist=max_dist,
+                   nr_shards=3, tmpdir=str(tmp_path)))
+    return output_file.read_text().splitlines()
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_correct_singles(tmp_path, threads):
+    barcodes = {
+        "AAAAAAAA": 5,
+        "CCCCCCCC": 3,
+        "AAAAAAAC": 1,  # Single hamming distance one from AAAAAAAA
+        "AAAAAAAN": 1,  # Single with N that can be corrected to AAAAAAAA
+        "CCCCACCC": 1,  # Single hamming distance one from CCCCCCCC
+        "GGGGGGGG": 1,  # Single without match
+        "AAAAAAA": 1,  # Single of different length
+        "CCCCCCCA": 2,
+        "CCCCCCCT": 1,  # Single matching both CCCCCCCC and CCCCCCCA
+    }
+    output = run_correctbc(tmp_path, [barcode for barcode, count in barcodes.items() for _ in range(count)],
+                           threads=threads)
+
+    assert output == [
+        "AAAAAAAA\t7\tAAAAAAAA,AAAAAAAC,AAAAAAAN",
+        "CCCCCCCC\t4\tCCCCCCCC,CCCCACCC",
+        "CCCCCCCA\t2\tCCCCCCCA",
+        "GGGGGGGG\t1\tGGGGGGGG",
+        "AAAAAAA\t1\tAAAAAAA",
+        "CCCCCCCT\t1\tCCCCCCCT",
+    ]
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_correct_singles_max_dist_two(tmp_path, threads):
+    barcodes = {
+        "AAAAAAAA": 5,
+        "CCCCCCCC": 3,
+        "AAAAAAGG": 2,
+        "AAAAAAAC": 1,  # Single closest to AAAAAAAA
+        "AAAAGGAA": 1,  # Single hamming distance two from AAAAAAAA
+        "CCCCANCC": 1,  # Single with N hamming distance two from CCCCCCCC
+        "AAAAAAGC": 1,  # Single closest to AAAAAAGG
+        "AAAAAATT": 1,  # Single hamming distance two from both AAAAAAAA and AAAAAAGG
+        "GGGGGGGG": 1,  # Single without match
+    }
+    output = run_correctbc(tmp_path, [barcode for barcode, count in barcodes.items() for _ in range(count)],
+                           threads=threads, max_dist=2)
+
+    assert output == [
+        "AAAAAAAA\t7\tAAAAAAAA,AAAAAAAC,AAAAGGAA",
+        "CCCCCCCC\t4\tCCCCCCCC,CCCCANCC",
+        "AAAAAAGG\t3\tAAAAAAGG,AAAAAAGC",
+        "AAAAAATT\t1\tAAAAAATT",
+        "GGGGGGGG\t1\tGGGGGGGG",
+    ]
+
+
+def test_correct_singles_unordered_input(tmp_path):
+    barcodes = ["AAAAAAAA"] * 3 + ["CCCCCCCC", "AAAAAAAC", "GGGGGGGG", "CCCCCCCC", "AAAANAAA", "AAAANAAA", "CCNCCCCC",
+                                   "AAAAAAA", "TTTTTTTT", "AAAAGGAA", "CCCCCCCA", "CCCCCCCA", "CCCCCCCT", "GNNGGGGG"]
+    output = run_correctbc(tmp_path, barcodes)
+
+    # Clusters are sorted by count and singles that are not corrected are kept in the order first seen.
+    assert output == [
+        "AAAAAAAA\t4\tAAAAAAAA,AAAAAAAC",
+        "CCCCCCCC\t3\tCCCCCCCC,CCNCCCCC",
+        "AAAANAAA\t2\tAAAANAAA",
+        "CCCCCCCA\t2\tCCCCCCCA",
+        "GGGGGGGG\t1\tGGGGGGGG",
+        "AAAAAAA\t1\tAAAAAAA",
+        "TTTTTTTT\t1\tTTTTTTTT",
+        "AAAAGGAA\t1\tAAAAGGAA",
+        "CCCCCCCT\t1\tCCCCCCCT",
+        "GNNGGGGG\t1\tGNNGGGGG",
+    ]
+
+
+@pytest.mark.parametrize("filename,record", [
+    ("barcodes.fastq", lambda barcode: f"@r\n{barcode}\n+\n{'I' * len(barcode)}\n"),
+    ("barcodes.fasta", lambda barcode: f">r\n{barcode[:4]}\n{barcode[4:]}\n"),  # Wrapped sequence lines
+])
+def test_correctbc_input_formats(tmp_path, filename, record):
+    barcodes = ["AAAAAAAA"] * 2 + ["AAAAAAAC", "GGGGGGGG"]
+    records = "".join(record(barcode) for barcode in barcodes)
+    output = run_correctbc(tmp_path, barcodes, records=records, filename=filename)
+
+    assert output == [
+        "AAAAAAAA\t3\tAAAAAAAA,AAAAAAAC",
+        "GGGGGGGG\t1\tGGGGGGGG",
+    ]
@@ -0,0 +1,41 @@
+import pytest
+
+from blr.cli.countbarcodes import run_countbarcodes, count_chunk, merge_counts
+from blr.utils import Summary, decode_sequence
+
+from .utils import tempinput
+
+
+BARCODES = ["GATTACCA", "GATTACCA", "TTTTCCCC", "GATTNCCA", "GATTACCA", "GATTNCCA", "ACGT"]
+
+
+def fasta_records(barcodes):
+    return "".join(f">read{i}\n{barcode}\n" for i, barcode in enumerate(barcodes)).encode()
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_countbarcodes(tmp_path, threads):
+    output = tmp_path / "counts.txt"
+    with tempinput(fasta_records(BARCODES)) as f:
+        run_countbarcodes(f, str(output), threads=threads, buffer_size=32)
+
+    counts = dict(line.split("\t") for line in output.read_text().splitlines())
+    assert counts == {"GATTACCA": "3", "TTTTCCCC": "1", "GATTNCCA": "2", "ACGT": "1"}
+
+
+def test_merge_counts_bounded():
+    chunk_counts = [count_chunk(fasta_records(BARCODES[i:i + 2])) for i in range(0, len(BARCODES), 2)]
+    summary = Summary()
+    codes, counts, other_counts = merge_counts(chunk_counts, summary, max_pending=1)
+    assert {decode_sequence(code): count for code, count in zip(codes, counts)} == \
+        {"GATTACCA": 3, "TTTTCCCC": 1, "ACGT": 1}
+    assert other_counts == {b"GATTNCCA": 2}
+    assert summary["Barcodes read"] == len(BARCODES)
+
+
+def test_count_chunk_fastq():
+    fastq = b"@read1\nGATTACCA\n+\nIIIIIIII\n@read2\nGATTACCA\n+\nIIIIIIII\n"
+    codes, counts, other_counts, nr_sequences = count_chunk(fastq)
+    assert [decode_sequence(code) for code in codes] == ["GATTACCA"]
+    assert list(counts) == [2]
+    assert nr_sequences == 2
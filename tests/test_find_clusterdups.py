@@ -1,7 +1,10 @@
 import pytest
 
-from blr.utils import ACCEPTED_LIBRARY_TYPES
-from blr.cli.find_clusterdups import get_non_acceptable_overlap_func, UnionFind
+from blr.utils import ACCEPTED_LIBRARY_TYPES, Summary
+from blr.cli.find_clusterdups import get_non_acceptable_overlap_func, UnionFind, paired_reads, \
+    encode_position, decode_position, decode_barcode_sets, DuplicatePositionBuffer
+
+from .utils import write_bam
 
 
 @pytest.mark.parametrize("library_type", ACCEPTED_LIBRARY_TYPES)
@@ -42,3 +45,57 @@ def test_union_find_update():
 def test_union_find_from_dict():
     uf = UnionFind.from_dict({"A": "A", "B": "A", "C": "A"})
     assert uf.same_component("A", "C")
+
+
+def test_decode_barcode_sets():
+    barcodes = ["GG", "TT", "AA", "CC"]
+    uf = UnionFind()
+    uf.union(0, 1)
+    uf.union(1, 2)
+    uf[3]
+
+    named = decode_barcode_sets(uf, barcodes)
+    assert dict(named.items()) == {"GG": "AA", "TT": "AA", "AA": "AA", "CC": "CC"}
+
+
+@pytest.mark.parametrize("position", [(0, 0, False), (100, 350, True), (2 ** 31 - 2, 2 ** 31 - 1, True)])
+def test_encode_position(position):
+    encoded = encode_position(*position)
+    assert encoded < 2 ** 63
+    assert decode_position(encoded) == position
+
+
+def test_duplicate_position_buffer():
+    buffer = DuplicatePositionBuffer()
+    buffer.add(1000, {1, 2})
+    buffer.add(500, {1, 2, 3})
+    buffer.add(2000, {2, 3})
+    buffer.add(3000, {4, 5})
+    assert list(buffer.shared({1, 2, 3})) == [(1000, {1, 2}), (500, {1, 2, 3}), (2000, {2, 3})]
+
+    # Evicting position stopping at 500 also evicts the position added before it.
+    buffer.evict(600)
+    assert list(buffer.shared({1, 2, 3})) == [(2000, {2, 3})]
+    assert 1 not in buffer.index
+
+
+def test_paired_reads_evicts_missing_mates(tmp_path):
+    bam = tmp_path / "pairs.bam"
+    reads = [
+        ("pair1", 99, 0, 100, 300),
+        ("orphan1", 99, 0, 150, 200),
+        ("pair1", 147, 0, 300, 100),
+        ("orphan2", 99, 0, 400, 500),
+        ("pair2", 99, 1, 100, 100),
+        ("pair2", 147, 1, 100, 100),
+    ]
+    write_bam(bam, [dict(name=name, flag=flag, reference_id=reference_id, start=start, mate_start=mate_start)
+                    for name, flag, reference_id, start, mate_start in reads])
+    summary = Summary()
+    pairs = list(paired_reads(str(bam), 0, summary))
+
+    assert [(read.query_name, read.reference_start, mate.reference_start) for read, mate in pairs] == [
+        ("pair1", 300, 100),
+        ("pair2", 100, 100),
+    ]
+    assert summary["Reads with missing mate"] == 2
@@ -1,4 +1,6 @@
-from blr.cli.process_stlfr import BarcodeGenerator
+import pytest
+
+from blr.cli.process_stlfr import BarcodeGenerator, read_chunks, run_process_stlfr
 
 
 def test_generate_barcodes_no_reference():
@@ -7,3 +9,53 @@ def test_generate_barcodes_no_reference():
     barcodes = [index_to_barcode.get(i) for i in indexes]
     assert barcodes[0] != barcodes[1] != barcodes[2]
     assert barcodes[0] == barcodes[-1]
+
+
+def test_generate_barcodes_deterministic():
+    index_to_barcode = BarcodeGenerator()
+    assert index_to_barcode.get("0_0_0") == "AAAAAAAAAAAAAAAT"  # AAAAAAAAAAAAAAAA is skipped
+    assert index_to_barcode.get("1_2_3") == BarcodeGenerator().get("1_2_3")
+    assert len({index_to_barcode.get(f"{i}_{j}_1") for i in [1, 1536] for j in [1, 1536]}) == 4
+
+
+def test_generate_barcodes_invalid_index():
+    index_to_barcode = BarcodeGenerator()
+    assert index_to_barcode.get("1_2_1537") is None
+    assert index_to_barcode.get("1_2_") is None
+
+
+def test_generate_barcodes_translations():
+    index_to_barcode = BarcodeGenerator(record_translations=True)
+    barcodes = {index: index_to_barcode.get(index) for index in ["5_1_1", "1_1_1", "1536_1536_1536", "1_1_1"]}
+    indices = ["1_1_1", "5_1_1", "1536_1536_1536"]
+    assert list(index_to_barcode.translations()) == [(index, barcodes[index]) for index in indices]
+
+
+def write_stlfr_reads(path, nr_pairs):
+    with open(path, "w") as file:
+        for i in range(nr_pairs):
+            for nr in [1, 2]:
+                print(f"@read{i}#{i % 7}_{i % 5}_{i % 11}/{nr}\nACGTACGT\n+\nIIIIIIII", file=file)
+
+
+def test_read_chunks_keeps_pairs(tmp_path):
+    path = tmp_path / "reads.fastq"
+    write_stlfr_reads(path, 25)
+    chunks = [chunk for chunk, _ in read_chunks(path, None, buffer_size=300)]
+    assert len(chunks) > 1
+    assert all(chunk.count(b"\n") % 8 == 0 for chunk in chunks)
+    assert b"".join(chunks) == path.read_bytes()
+
+
+@pytest.mark.parametrize("mapper", ["bowtie2", "ema", "lariat"])
+def test_process_stlfr_workers_same_as_serial(tmp_path, mapper):
+    path = tmp_path / "reads.fastq"
+    write_stlfr_reads(path, 500)
+    for workers in [1, 2]:
+        run_process_stlfr(input1=path, input2=None, output1=tmp_path / f"out{workers}.fastq", output2=None,
+                          output_nobc1=None, output_nobc2=None, output_bins=None, nr_bins=1,
+                          output_translations=tmp_path / f"out{workers}.csv", barcode_tag="BX", mapper=mapper,
+                          sample_number=1, workers=workers)
+
+    for suffix in [".fastq", ".csv"]:
+        assert (tmp_path / f"out1{suffix}").read_text() == (tmp_path / f"out2{suffix}").read_text()
@@ -0,0 +1,59 @@
+import pysam
+
+from blr.cli.buildmolecules import run_buildmolecules
+from blr.cli.readmolecules import run_readmolecules, parse_molecules
+from blr.utils import Summary
+
+from .utils import write_bam, write_molecule_bam
+
+
+def read_rows(path):
+    with open(path) as file:
+        return sorted(line.split("\t")[:2] + line.split("\t")[3:] for line in file)
+
+
+def test_readmolecules_same_as_buildmolecules(tmp_path):
+    input_bam = tmp_path / "input.bam"
+    write_molecule_bam(input_bam)
+    tagged_bam = tmp_path / "tagged.bam"
+    run_buildmolecules(str(input_bam), str(tagged_bam), threshold=4, window=30000, barcode_tag="BX",
+                       stats_tsv=tmp_path / "build.tsv", bed_file=None, molecule_tag="MI", min_mapq=0,
+                       library_type="dbs")
+
+    run_readmolecules(str(tagged_bam), str(tmp_path / "read.tsv"), None, threshold=4, barcode_tag="BX",
+                      molecule_tag="MI", min_mapq=0, library_type="dbs", window=30000)
+
+    # Read counts may differ for molecules with overlapping reads so only the remaining columns are compared.
+    assert read_rows(tmp_path / "build.tsv") == read_rows(tmp_path / "read.tsv")
+
+
+def test_parse_molecules_splits_molecules_by_chromosome(tmp_path):
+    bam = tmp_path / "input.bam"
+    tags = {"BX": "ACGTACGTACGTACGTACGT-1", "MI": 1}
+    write_bam(bam, [dict(name=f"read{i}", reference_id=reference_id, start=position, tags=tags)
+                    for i, (reference_id, position) in enumerate([(0, 100), (0, 1000), (1, 500), (1, 900)])])
+
+    with pysam.AlignmentFile(bam) as openbam:
+        molecules = list(parse_molecules(openbam, "BX", "MI", "dbs", 0, Summary(), window=30000))
+
+    assert [(molecule.chromosome, molecule.start, molecule.stop, molecule.nr_reads) for molecule in molecules] == \
+           [("chr1", 100, 1100, 2), ("chr2", 500, 1000, 2)]
+
+
+def test_parse_molecules_merges_molecule_index_outside_window(tmp_path):
+    bam = tmp_path / "input.bam"
+    tags = {"BX": "ACGTACGTACGTACGTACGT-1", "MI": 1}
+    other_tags = {"BX": "TTTTACGTACGTACGTACGT-1", "MI": 2}
+    write_bam(bam, [
+        dict(name="pair", reference_id=0, start=100, flag=99, mate_start=80000, tags=tags),
+        dict(name="read1", reference_id=0, start=1000, tags=tags),
+        dict(name="read2", reference_id=0, start=50000, tags=other_tags),
+        dict(name="pair", reference_id=0, start=80000, flag=147, mate_start=100, tags=tags),
+    ])
+
+    with pysam.AlignmentFile(bam) as openbam:
+        molecules = list(parse_molecules(openbam, "BX", "MI", "dbs", 0, Summary(), window=30000))
+
+    # Molecule 1 is not split even though the mate is further than window from the molecule stop.
+    assert sorted((molecule.index, molecule.start, molecule.stop, molecule.nr_reads) for molecule in molecules) == \
+           [(1, 100, 80100, 3), (2, 50000, 50100, 1)]
@@ -0,0 +1,75 @@
+import pysam
+import pytest
+
+from blr.cli.splitchunks import run_splitchunks, output_name
+
+from .utils import write_bam
+
+HEADER = {
+    "HD": {"VN": "1.6", "SO": "coordinate"},
+    "SQ": [{"SN": "chr1", "LN": 10000}, {"SN": "chr2", "LN": 10000}, {"SN": "chr3", "LN": 10000}],
+    "PG": [{"ID": "bwa", "PN": "bwa"}],
+}
+
+
+def write_input_bam(path):
+    write_bam(path, [dict(name=f"myread:{i}_BX:Z:ACTGACTGACTGACTGACTG-1", reference_id=reference_id, start=start,
+                          length=40, mapping_quality=20)
+                     for i, (reference_id, start) in enumerate([(0, 100), (0, 200), (1, 300), (2, 400), (-1, -1),
+                                                                (-1, -1)])], header=HEADER)
+
+
+def write_bed(path, contigs):
+    with open(path, "w") as file:
+        for contig in contigs:
+            print(contig, 0, 10000, sep="\t", file=file)
+
+
+def read_bam(path):
+    with pysam.AlignmentFile(path, check_sq=False) as file:
+        return list(file)
+
+
+def test_output_name():
+    assert output_name("chunks/chr1.bed", ".sorted.tag.bam") == "chunks/chr1.sorted.tag.bam"
+
+
+def test_splitchunks(tmp_path):
+    input_bam = str(tmp_path / "input.bam")
+    write_input_bam(input_bam)
+    write_bed(tmp_path / "chr1.bed", ["chr1"])
+    write_bed(tmp_path / "chr2.bed", ["chr2", "chr3"])
+    unmapped = str(tmp_path / "unmapped.bam")
+
+    run_splitchunks(input_bam, [str(tmp_path / "chr1.bed"), str(tmp_path / "chr2.bed")], unmapped,
+                    sample_number=2, threads=2)
+
+    chunk1 = read_bam(tmp_path / "chr1.sorted.tag.bam")
+    chunk2 = read_bam(tmp_path / "chr2.sorted.tag.bam")
+    unmapped_reads = read_bam(unmapped)
+    assert [read.query_name for read in chunk1] == ["myread:0", "myread:1"]
+    assert [read.reference_name for read in chunk2] == ["chr2", "chr3"]
+    assert [read.query_name for read in unmapped_reads] == ["myread:4", "myread:5"]
+    assert all(read.get_tag("BX") == "ACTGACTGACTGACTGACTG-2" for read in chunk1 + chunk2 + unmapped_reads)
+
+
+def test_splitchunks_skip_tagging(tmp_path):
+    input_bam = str(tmp_path / "input.bam")
+    write_input_bam(input_bam)
+    write_bed(tmp_path / "chr1.bed", ["chr1", "chr2", "chr3"])
+
+    run_splitchunks(input_bam, [str(tmp_path / "chr1.bed")], str(tmp_path / "unmapped.bam"), skip_tagging=True)
+
+    reads = read_bam(tmp_path / "chr1.sorted.tag.bam")
+    assert len(reads) == 4
+    assert all(not read.has_tag("BX") and "_BX:Z:" in read.query_name for read in reads)
+
+
+def test_splitchunks_partial_contig_fails(tmp_path):
+    input_bam = str(tmp_path / "input.bam")
+    write_input_bam(input_bam)
+    with open(tmp_path / "chr1.bed", "w") as file:
+        print("chr1", 0, 5000, sep="\t", file=file)
+
+    with pytest.raises(SystemExit):
+        run_splitchunks(input_bam, [str(tmp_path / "chr1.bed")], str(tmp_path / "unmapped.bam"))
@@ -1,7 +1,7 @@
 from collections import Counter
 import pysam
 
-from blr.cli.tagbam import is_sequence, mode_ema, mode_samtags_underline_separation, get_mode, mode_void
+from blr.cli.tagbam import is_sequence, mode_ema, mode_samtags_underline_separation, get_mode, mode_void, run_tagbam
 
 
 def build_read(name, barcode=None):
@@ -28,6 +28,7 @@ def build_read(name, barcode=None):
 def test_is_sequence():
     assert is_sequence("ATGCTAGTC")
     assert not is_sequence("12318321")
+    assert not is_sequence("ATGCNATGC")
 
 
 # Typical for bowtie2, bwa, minimap2 mappers.
@@ -105,3 +106,21 @@ def test_get_mode_void():
 
     mode, _ = get_mode(iter([read]), "BX")
     assert mode.__name__ == mode_void.__name__
+
+
+def test_run_tagbam_threads_and_compression_level(tmp_path):
+    header = {"HD": {"VN": "1.6"}, "SQ": [{"SN": "chr1", "LN": 10000000}], "PG": [{"ID": "bwa", "PN": "bwa"}]}
+    input_bam = tmp_path / "input.bam"
+    with pysam.AlignmentFile(input_bam, "wb", header=header) as file:
+        for i in range(100):
+            read = build_read(f"myread:{i}_RX:Z:ACGTACGTACGTACGTACGT_BX:Z:ACTGACTGACTGACTGACTG-1")
+            file.write(pysam.AlignedSegment.from_dict(read.to_dict(), file.header))
+
+    output_bam = tmp_path / "output.bam"
+    run_tagbam(str(input_bam), str(output_bam), sample_number=2, barcode_tag="BX", threads=2, compression_level=1)
+    with pysam.AlignmentFile(output_bam) as file:
+        reads = list(file)
+
+    assert len(reads) == 100
+    assert all(read.get_tag("BX") == "ACTGACTGACTGACTGACTG-2" for read in reads)
+    assert reads[0].query_name == "myread:0"
@@ -1,7 +1,15 @@
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+
+import dnaio
+import pysam
+import pytest
 from pytest import raises
 
-from blr.cli.tagfastq import match_template, IUPAC, scramble, map_corrected_barcodes, BarcodeReader
+from blr.cli.tagfastq import scramble, map_corrected_barcodes, BarcodeReader, run_tagfastq, BarcodeMap, \
+    BucketHandler, IndexedBarcodeReader, ParallelGzipWriter, Output
+from blr.utils import match_template, IUPAC
 
 from .utils import tempinput
 
@@ -29,24 +37,133 @@ def test_scramble():
         assert all(s1[:16] != s2[:16] for s1, s2 in zip(sequences[:-1], sequences[1:]))
 
 
+def test_scramble_separates_shared_prefixes():
+    sequences = ["A" * 16 + f"{i:04d}" for i in range(5)] + ["C" * 16 + f"{i:04d}" for i in range(3)] + ["G" * 20]
+    scrambled_sequences = sequences.copy()
+    collisions = scramble(scrambled_sequences)
+    assert collisions == 0
+    assert sorted(scrambled_sequences) == sorted(sequences)
+    assert all(s1[:16] != s2[:16] for s1, s2 in zip(scrambled_sequences[:-1], scrambled_sequences[1:]))
+
+
+def test_scramble_reports_unresolved_collisions():
+    sequences = ["A" * 16 + f"{i:04d}" for i in range(5)] + ["C" * 20]
+    collisions = scramble(sequences)
+    # Five sequences sharing prefix among six can at best be placed with three neighbouring pairs sharing prefix.
+    assert collisions == 3
+
+
 def test_map_barcodes():
     filetext = b"AAAA\t3\tAAAA,AAAT\n" \
                b"TTAA\t2\tTTAG\n" \
                b"CGTG\t1\tCGTG\n"
 
     with tempinput(filetext) as file:
-        corrected_barcodes, _ = map_corrected_barcodes(file, summary=Counter(), mapper="bowtie2",
-                                                       template=None)
+        corrected_barcodes = map_corrected_barcodes(file, summary=Counter(), mapper="bowtie2", template=None)
         assert corrected_barcodes["AAAT"] == "AAAA"
         assert len(corrected_barcodes) == 4
         assert len(set(corrected_barcodes.values())) == 3
 
-        corrected_barcodes, _ = map_corrected_barcodes(file, summary=Counter(), mapper="bowtie2",
-                                                       template=None, min_count=2)
+        corrected_barcodes = map_corrected_barcodes(file, summary=Counter(), mapper="bowtie2", template=None,
+                                                    min_count=2)
         assert len(corrected_barcodes) == 3
         assert len(set(corrected_barcodes.values())) == 2
 
 
+@pytest.mark.parametrize("mapper", ["bowtie2", "ema"])
+def test_map_barcodes_all_filtered(mapper):
+    filetext = b"AAAA\t3\tAAAA,AAAT\n" \
+               b"TTAA\t2\tTTAG\n"
+
+    with tempinput(filetext) as file:
+        corrected_barcodes = map_corrected_barcodes(file, summary=Counter(), mapper=mapper, template=None,
+                                                    min_count=5)
+    assert len(corrected_barcodes) == 0
+    assert corrected_barcodes.get("AAAT") is None
+
+
+def test_barcode_map_empty():
+    barcode_map = BarcodeMap.from_clusters([])
+    assert len(barcode_map) == 0
+    assert barcode_map.nr_canonical == 0
+    assert list(barcode_map.values()) == []
+    assert barcode_map.lookup(["AAAA", None]) == [-1, -1]
+
+
+def test_barcode_map_only_unencodable():
+    barcode_map = BarcodeMap.from_clusters([("AANA", ["AANA", "ANNA"])])
+    assert len(barcode_map) == 2
+    assert barcode_map["ANNA"] == "AANA"
+    assert barcode_map.get("AAAA") is None
+
+
+def test_barcode_map():
+    barcode_map = BarcodeMap.from_clusters([
+        ("AAAA", ["AAAA", "AAAT", "AANA"]),
+        ("AAAAA", ["AAAAA"]),
+        ("CCCC", ["CCCC", "CCCCC"]),
+    ])
+    assert len(barcode_map) == 6
+    assert barcode_map.nr_canonical == 3
+    assert barcode_map["AANA"] == "AAAA"
+    assert barcode_map["AAAAA"] == "AAAAA"
+    assert barcode_map["CCCCC"] == "CCCC"
+    assert barcode_map.get("GGGG") is None
+    assert barcode_map.lookup(["AAAT", "GGGG", None, "CCCC"]) == [0, -1, -1, 2]
+
+    barcode_map.reorder(["CCCC", "AAAA", "AAAAA"])
+    assert barcode_map.lookup(["AAAT", "AANA", "CCCCC", "AAAAA"]) == [1, 1, 0, 2]
+    assert barcode_map["AAAT"] == "AAAA"
+
+
+@pytest.mark.parametrize("memory", [100_000, 1_000])
+def test_bucket_handler_groups_records_by_heap(tmp_path, memory):
+    records = [(heap, (f"read{i}", str(heap))) for i, heap in enumerate([5, 0, 3, 5, 9, 0, 7, 3, 1, 5] * 10)]
+    with BucketHandler(heaps_per_bucket=4, memory=memory, tmpdir=tmp_path) as buckets:
+        for heap, record in records:
+            buckets.add(heap, record)
+        grouped = list(buckets.parse_buckets())
+
+    # Records are grouped by heap in input order within each heap.
+    expected = sorted(records, key=lambda r: r[0])
+    assert grouped == expected
+    assert not any(tmp_path.iterdir())
+
+
+@pytest.mark.parametrize("max_pending", [1, None])
+def test_parallel_gzip_writer(tmp_path, max_pending):
+    filename = tmp_path / "out.txt.gz"
+    lines = [f"line{i}\n".encode() for i in range(1000)]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        with ParallelGzipWriter(filename, pool, threads=2, block_size=100, max_pending=max_pending) as writer:
+            for line in lines:
+                writer.write(line)
+
+    with gzip.open(filename) as file:
+        assert file.read() == b"".join(lines)
+
+
+def test_output_ema_bins_not_compressed(tmp_path):
+    with Output(mapper="ema", bins_dir=tmp_path, nr_bins=2, compression_threads=2) as output:
+        output.set_bin_size(1)
+        for heap in range(4):
+            read = dnaio.Sequence(f"read{heap}", "ACGT", "IIII")
+            output.write(read, read, heap=heap)
+
+    bins = sorted(tmp_path.iterdir())
+    assert [path.name for path in bins] == ["ema-bin-000", "ema-bin-001"]
+    assert bins[0].read_text().startswith("@read0\nACGT\n+\nIIII\n")
+
+
+def test_output_lariat_to_binary_stream(tmp_path):
+    path = tmp_path / "out.lariat.txt"
+    with open(path, "wb") as stream:
+        with Output(file1=stream, mapper="lariat") as output:
+            output.write("@read1\tACGT\n")
+        assert not stream.closed
+    assert path.read_text() == "@read1\tACGT\n"
+
+
 def test_barcode_parsing_split_header():
     fasta = b">MYHEADER EXTRA\nGATTACCA"
     with tempinput(fasta) as f:
@@ -61,3 +178,98 @@ def test_barcode_parsing_single_header():
         bcreader = BarcodeReader(f)
         barcode = bcreader.get_barcode("MYHEADER")
         assert barcode == "GATTACCA"
+
+
+def test_indexed_barcode_reader_any_order(tmp_path):
+    fasta = b">read1 extra\nGATTACCA\n>read2\nGATTNCCA\n>read3\nTTTTCCCC\n"
+    with tempinput(fasta) as f:
+        with IndexedBarcodeReader(f, tmpdir=tmp_path, buffer_size=2) as bcreader:
+            assert bcreader.get_barcode("read3") == "TTTTCCCC"
+            assert bcreader.get_barcode("read1") == "GATTACCA"
+            assert bcreader.get_barcode("read2") == "GATTNCCA"
+            assert bcreader.get_barcode("read4") is None
+    assert not any(tmp_path.iterdir())
+
+
+def write_tagfastq_input(tmp_path, nr_pairs=50):
+    barcodes = ["AAAACCCCGGGGTTTTAAAA", "CCCCGGGGTTTTAAAACCCC", "GGGGTTTTAAAACCCCGGGG"]
+    clstr = tmp_path / "barcodes.clstr"
+    clstr.write_text(f"{barcodes[0]}\t20\t{barcodes[0]}\n"
+                     f"{barcodes[1]}\t20\t{barcodes[1]},{barcodes[2]}\n")
+    uncorrected = tmp_path / "barcodes.fasta"
+    reads = tmp_path / "reads.fastq"
+    with open(uncorrected, "w") as bcs, open(reads, "w") as fastq:
+        for i in range(nr_pairs):
+            # Every fourth read pair has a barcode not in the CLSTR file.
+            barcode = "TTTTTTTTTTTTTTTTTTTT" if i % 4 == 3 else barcodes[i % 3]
+            print(f">read{i} extra\n{barcode}", file=bcs)
+            for nr in [1, 2]:
+                print(f"@read{i} {nr}:N:0:1\nACGTACGTAC\n+\nIIIIIIIIII", file=fastq)
+    return str(uncorrected), str(clstr), str(reads)
+
+
+def test_tagfastq_workers_same_output(tmp_path):
+    uncorrected, clstr, reads = write_tagfastq_input(tmp_path)
+    outputs = {}
+    for workers in [1, 3]:
+        output1 = tmp_path / f"out.{workers}.1.fastq"
+        output2 = tmp_path / f"out.{workers}.2.fastq"
+        run_tagfastq(uncorrected_barcodes=uncorrected, corrected_barcodes=clstr, input1=reads, input2=None,
+                     output1=str(output1), output2=str(output2), output_nobc1=None, output_nobc2=None,
+                     output_bins=None, nr_bins=1, barcode_tag="BX", sequence_tag="RX", mapper="bowtie2",
+                     min_count=0, pattern_match=None, sample_number=1, workers=workers)
+        outputs[workers] = (output1.read_text(), output2.read_text())
+
+    assert outputs[1][0].count("BX:Z:") > 0
+    assert outputs[1] == outputs[3]
+
+
+def test_tagfastq_index_barcodes_unsynced_input(tmp_path):
+    uncorrected, clstr, reads = write_tagfastq_input(tmp_path, nr_pairs=400)
+    reversed_uncorrected = tmp_path / "barcodes.reversed.fasta"
+    records = open(uncorrected).read().splitlines()
+    with open(reversed_uncorrected, "w") as file:
+        for i in reversed(range(0, len(records), 2)):
+            print(records[i], records[i + 1], sep="\n", file=file)
+
+    outputs = {}
+    for name, barcodes, index_barcodes in [("synced", uncorrected, False), ("indexed", reversed_uncorrected, True)]:
+        output1 = tmp_path / f"out.{name}.1.fastq"
+        output2 = tmp_path / f"out.{name}.2.fastq"
+        run_tagfastq(uncorrected_barcodes=str(barcodes), corrected_barcodes=clstr, input1=reads, input2=None,
+                     output1=str(output1), output2=str(output2), output_nobc1=None, output_nobc2=None,
+                     output_bins=None, nr_bins=1, barcode_tag="BX", sequence_tag="RX", mapper="bowtie2",
+                     min_count=0, pattern_match=None, sample_number=1, tmpdir=str(tmp_path),
+                     index_barcodes=index_barcodes)
+        outputs[name] = (output1.read_text(), output2.read_text())
+
+    assert outputs["synced"][0].count("BX:Z:") > 0
+    assert outputs["synced"] == outputs["indexed"]
+
+
+def test_tagfastq_output_ubam(tmp_path):
+    uncorrected, clstr, reads = write_tagfastq_input(tmp_path)
+    output1 = tmp_path / "out.1.fastq"
+    output_ubam = tmp_path / "out.bam"
+    for kwargs in [dict(output1=str(output1)), dict(output1=None, output_ubam=str(output_ubam))]:
+        run_tagfastq(uncorrected_barcodes=uncorrected, corrected_barcodes=clstr, input1=reads, input2=None,
+                     output2=None, output_nobc1=None, output_nobc2=None, output_bins=None, nr_bins=1,
+                     barcode_tag="BX", sequence_tag="RX", mapper="bowtie2", min_count=0, pattern_match=None,
+                     sample_number=2, **kwargs)
+
+    # Read names in FASTQ output have the format '<name>_RX:Z:<uncorrected>_BX:Z:<corrected>'
+    expected = []
+    with dnaio.open(str(output1)) as reader:
+        for read in reader:
+            name, *tags = read.name.split()[0].split("_")
+            tags = dict(tag.split(":Z:") for tag in tags)
+            if "BX" in tags:
+                tags["BX"] += "-2"
+            expected.append((name, read.sequence, tags))
+
+    with pysam.AlignmentFile(str(output_ubam), check_sq=False) as bam:
+        segments = list(bam)
+
+    assert all(segment.is_unmapped and segment.is_paired for segment in segments)
+    assert any("BX" in tags for _, _, tags in expected)
+    assert [(s.query_name, s.query_sequence, dict(s.get_tags())) for s in segments] == expected
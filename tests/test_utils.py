@@ -1,11 +1,13 @@
 from io import StringIO
 from blr.utils import parse_fai, FastaIndexRecord, chromosome_chunks, symlink_relpath, generate_chunks, get_bamtag
-from blr.utils import calculate_N50, parse_filters, NaibrSV, parse_naibr_tsv
+from blr.utils import calculate_N50, parse_filters, NaibrSV, parse_naibr_tsv, parse_clstr, IUPAC, Summary
+from blr.utils import encode_sequence, encode_sequences, decode_sequence, decode_sequences, FragmentStats
 from pathlib import Path
 import os
 import pytest
 
 from .test_tagbam import build_read
+from .utils import tempinput
 
 
 def test_parse_fai():
@@ -105,6 +107,34 @@ def test_calculate_N50():
     assert calculate_N50(values) == 8
 
 
+def test_fragment_stats():
+    stats = FragmentStats(capacity=1)
+    stats.add(100, 50, 2)
+    stats.extend([200, 400], [100, 100], [4, 6])
+    assert len(stats) == 3
+    assert stats.lengths.tolist() == [100, 200, 400]
+    assert stats.coverage().tolist() == [50, 50, 25]
+    assert stats.dna_fraction_longer_than(150) == pytest.approx(100 * 600 / 700)
+
+    summary = Summary()
+    stats.update_summary(summary)
+    assert summary["Fragment N50 (bp)"] == 400
+    assert summary["Median fragment size (bp)"] == 200
+    assert summary["Longest fragment (bp)"] == 400
+    assert summary["Median fragment read coverage (%)"] == 50
+
+    summary = Summary()
+    FragmentStats().update_summary(summary)
+    assert not summary
+
+
+def test_fragment_stats_zero_capacity():
+    stats = FragmentStats(capacity=0)
+    stats.add(100, 50, 2)
+    stats.extend([200], [100], [4])
+    assert stats.lengths.tolist() == [100, 200]
+
+
 def test_parse_filters():
     filter_command_ref = [
         "-e 'QUAL < 15' -s 'lowQUAL'",
@@ -140,3 +170,32 @@ def test_parse_naibr_tsv():
 
         with pytest.raises(StopIteration):
             next(parser)
+
+
+def test_parse_clstr():
+    filetext = b"AAAA\t3\tAAAA,AAAT\n" \
+               b"TTAA\t2\tTTAG\n" \
+               b"CGTG\t1\tCGTG\n"
+    with tempinput(filetext) as file:
+        clusters = list(parse_clstr(file))
+        assert [c.canonical for c in clusters] == ["AAAA", "TTAA", "CGTG"]
+        assert clusters[0].size == 3
+        assert clusters[0].sequences == ["AAAA", "AAAT"]
+
+        summary = Summary()
+        template = [set(IUPAC[base]) for base in "WWNN"]
+        clusters = list(parse_clstr(file, min_count=2, template=template, summary=summary))
+        assert [c.canonical for c in clusters] == ["AAAA", "TTAA"]
+        assert summary["Barcodes not passing filters"] == 1
+        assert summary["Reads with barcodes not passing filters"] == 1
+
+
+def test_encode_sequences_same_as_encode_sequence():
+    sequences = ["ACGT", "", "A", "GATTNCCA", "acgt", "T" * 31, "T" * 32, "CCGGAATT"]
+    codes = encode_sequences(sequences)
+    assert [int(code) or None for code in codes] == [encode_sequence(seq) for seq in sequences]
+
+
+def test_decode_sequences_same_as_decode_sequence():
+    codes = encode_sequences(["ACGT", "", "A", "T" * 31, "CCGGAATT", "GA"])
+    assert decode_sequences(codes) == [decode_sequence(code) for code in codes]
@@ -1,7 +1,16 @@
 import os
+import random
 import tempfile
 from contextlib import contextmanager
 
+import pysam
+
+BAM_HEADER = {
+    "HD": {"VN": "1.6", "SO": "coordinate"},
+    "SQ": [{"SN": "chr1", "LN": 1000000}, {"SN": "chr2", "LN": 1000000}],
+    "PG": [{"ID": "bwa", "PN": "bwa"}],
+}
+
 
 @contextmanager
 def tempinput(string: bytes):
@@ -14,3 +23,54 @@ def tempinput(string: bytes):
         yield temp.name
     finally:
         os.unlink(temp.name)
+
+
+def build_read(header, name, reference_id=-1, start=-1, flag=0, length=100, mapping_quality=60, mate_start=None,
+               tags=None):
+    """Build read of length bp aligned to reference_id at start. Reads with reference_id -1 are unmapped."""
+    read = pysam.AlignedSegment(header)
+    read.query_name = name
+    read.query_sequence = "ACGT" * (length // 4)
+    read.query_qualities = pysam.qualitystring_to_array("I" * (length // 4 * 4))
+    read.flag = flag
+    if reference_id == -1:
+        read.flag |= 4
+    else:
+        read.reference_id = reference_id
+        read.reference_start = start
+        read.mapping_quality = mapping_quality
+        read.cigartuples = ((0, length),)
+    if mate_start is not None:
+        read.next_reference_id = reference_id
+        read.next_reference_start = mate_start
+    for tag, value in (tags or {}).items():
+        read.set_tag(tag, value)
+    return read
+
+
+def write_bam(path, reads, header=None):
+    """Write reads given as dicts of build_read arguments to BAM file"""
+    with pysam.AlignmentFile(path, "wb", header=header or BAM_HEADER) as file:
+        for read in reads:
+            file.write(build_read(file.header, **read))
+
+
+def write_molecule_bam(path, nr_molecules=200, seed=1):
+    """Write BAM with read pairs from random molecules of 20 barcodes where about 5% of pairs are duplicates"""
+    rng = random.Random(seed)
+    barcodes = ["".join(rng.choice("ACGT") for _ in range(20)) + "-1" for _ in range(20)]
+    reads = []
+    for i in range(nr_molecules):
+        reference_id = rng.randrange(2)
+        start = rng.randrange(900000)
+        barcode = rng.choice(barcodes)
+        for j in range(rng.randint(1, 10)):
+            position = start + rng.randrange(50000)
+            duplicate = 1024 if rng.random() < 0.05 else 0
+            mate_position = position + rng.randint(100, 500)
+            pair = dict(name=f"read{i}:{j}", reference_id=reference_id, tags={"BX": barcode})
+            reads.append(dict(pair, start=position, flag=99 | duplicate))
+            reads.append(dict(pair, start=mate_position, flag=147 | duplicate))
+
+    reads.sort(key=lambda read: (read["reference_id"], read["start"]))
+    write_bam(path, reads)